@@ -0,0 +1,231 @@
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from time import perf_counter
+import numpy as np
+import pandas as pd
+
+from data import (load_data, load_party_embedding_store, load_party_embeddings, save_party_embedding_store,
+                  save_party_embeddings)
+from embeddings import calculate_party_embedding_matrix, calculate_party_embeddings
+from experiment import run_trials, run_trials_shared
+from gauntlet import generate_gauntlet_run_indices, generate_gauntlet_runs
+from generate_possible_parties import (generate_possible_parties, generate_possible_party_indices,
+                                       party_indices_to_names)
+from select_parties import select_parties_by_embeddings, select_party_indices_by_embeddings
+
+RUN_STYLES = ["Regular", "Typhoon", "Volcano", "Meteor"]
+BROKEN_JOBS = ["Summoner", "Black Mage", "Chemist"]
+
+
+def time_stage(function, repeat: int = 1) -> (float, object):
+    """ Time a function call, keeping the fastest of repeat calls. Anything the function prints is discarded.
+    :param function: the function to call, without arguments
+    :param repeat: the number of times to call the function
+    :return: the fastest time in seconds, and the result of the last call
+    """
+
+    best_seconds = float("inf")
+    result = None
+    for _ in range(repeat):
+        with redirect_stdout(io.StringIO()):
+            start = perf_counter()
+            result = function()
+            best_seconds = min(best_seconds, perf_counter() - start)
+    return best_seconds, result
+
+
+def make_synthetic_job_table(df_jobs: pd.DataFrame, num_jobs: int, seed: int = 0) -> pd.DataFrame:
+    """ Make a larger job table in the same format as df_jobs, to see how the pipeline scales with the number of
+    jobs. Mime and Freelancer are kept as they are. Every other job is a copy of a random job of df_jobs with a new
+    name, a random crystal, and each equipment flag flipped with probability 0.1.
+    :param df_jobs: the DataFrame of jobs data to base the new jobs on
+    :param num_jobs: the number of jobs in the new table, including Mime and Freelancer
+    :param seed: the random seed
+    :return: the new DataFrame of jobs data
+    """
+
+    rng = np.random.default_rng(seed)
+    df_regular = df_jobs[df_jobs["Crystal"] != "Misc"]
+    df_misc = df_jobs[df_jobs["Crystal"] == "Misc"]
+    num_new_jobs = num_jobs - len(df_misc)
+
+    df_new = df_regular.iloc[rng.integers(0, len(df_regular), size=num_new_jobs)].copy()
+    df_new.index = pd.Index([f"Job {i}" for i in range(num_new_jobs)], name=df_jobs.index.name)
+    crystals = ["Wind", "Water", "Fire", "Earth"]
+    df_new["Crystal"] = [crystals[i % len(crystals)] for i in rng.permutation(num_new_jobs)]
+    equip_cols = df_jobs.columns[6:]
+    flips = rng.random((num_new_jobs, len(equip_cols))) < 0.1
+    df_new[equip_cols] = np.where(flips, 1 - df_new[equip_cols].to_numpy(), df_new[equip_cols].to_numpy())
+
+    return pd.concat([df_new, df_misc])
+
+
+def benchmark_configuration(df_jobs: pd.DataFrame, run_style: str, duplicates: bool, settings: dict) -> list:
+    """ Time each stage of the pipeline for one job table and run style.
+    :param df_jobs: the DataFrame of jobs data
+    :param run_style: the run style
+    :param duplicates: flag to allow duplicates
+    :param settings: the benchmark settings from the command line
+    :return: a list of dicts, one per stage, with its time in seconds
+    """
+
+    results = []
+
+    def record(stage: str, seconds: float, **extra):
+        results.append({"stage": stage, "seconds": seconds, **extra})
+        print(f"  {stage:<40} {seconds:>10.4f} s")
+
+    seconds, valid_parties = time_stage(lambda: generate_possible_parties(run_style, df_jobs, duplicates))
+    record("generate_possible_parties", seconds, num_parties=len(valid_parties))
+    seconds, party_indices = time_stage(lambda: generate_possible_party_indices(run_style, df_jobs, duplicates),
+                                        settings["repeat"])
+    record("generate_possible_party_indices", seconds, num_parties=len(party_indices))
+
+    # The party by party embeddings are slow, so they are timed on a sample of parties
+    sample = valid_parties[:settings["embedding_sample"]]
+    seconds, _ = time_stage(lambda: calculate_party_embeddings(sample, df_jobs, [], BROKEN_JOBS,
+                                                               settings["equip_factor"]))
+    record("calculate_party_embeddings", seconds, num_parties=len(sample))
+    seconds, embedding_matrix = time_stage(lambda: calculate_party_embedding_matrix(
+        party_indices, df_jobs, BROKEN_JOBS, settings["equip_factor"]), settings["repeat"])
+    record("calculate_party_embedding_matrix", seconds, num_parties=len(party_indices))
+
+    party_names = party_indices_to_names(party_indices, df_jobs)
+    valid_parties_embeddings = list(zip(party_names, embedding_matrix))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        csv_filename = os.path.join(temp_dir, "embeddings.csv")
+        seconds, _ = time_stage(lambda: save_party_embeddings(csv_filename, valid_parties_embeddings))
+        record("save_party_embeddings", seconds, bytes=os.path.getsize(csv_filename))
+        seconds, _ = time_stage(lambda: load_party_embeddings(csv_filename))
+        record("load_party_embeddings", seconds)
+
+        store_filename = os.path.join(temp_dir, "embeddings.npy")
+        seconds, _ = time_stage(lambda: save_party_embedding_store(
+            store_filename, embedding_matrix, party_indices, list(df_jobs.index), run_style, duplicates,
+            settings["equip_factor"], BROKEN_JOBS))
+        record("save_party_embedding_store", seconds, bytes=os.path.getsize(store_filename))
+        seconds, _ = time_stage(lambda: load_party_embedding_store(store_filename)[0].sum(), settings["repeat"])
+        record("load_party_embedding_store", seconds)
+
+    num_parties, eps = settings["num_parties"], settings["eps"]
+    seconds, _ = time_stage(lambda: select_parties_by_embeddings(valid_parties_embeddings, num_parties, eps),
+                            settings["repeat"])
+    record("select_parties_by_embeddings", seconds)
+    seconds, _ = time_stage(lambda: select_party_indices_by_embeddings(embedding_matrix, num_parties, eps),
+                            settings["repeat"])
+    record("select_party_indices_by_embeddings", seconds)
+
+    for num_procs in settings["num_procs"]:
+        seconds, _ = time_stage(lambda: run_trials(valid_parties_embeddings, num_parties, settings["num_trials"],
+                                                   eps, select_parties_by_embeddings, num_procs=num_procs))
+        record("run_trials", seconds, num_procs=num_procs, num_trials=settings["num_trials"])
+        for batched in [False, True]:
+            seconds, _ = time_stage(lambda: run_trials_shared(embedding_matrix, party_names, num_parties,
+                                                              settings["num_trials"], eps, num_procs=num_procs,
+                                                              seed=0, batched=batched))
+            record("run_trials_shared" + ("_batched" if batched else ""), seconds, num_procs=num_procs,
+                   num_trials=settings["num_trials"])
+
+    return results
+
+
+def benchmark_gauntlets(df_jobs: pd.DataFrame, settings: dict) -> list:
+    """ Time generating gauntlet runs, one at a time and in bulk.
+    :param df_jobs: the DataFrame of jobs data
+    :param settings: the benchmark settings from the command line
+    :return: a list of dicts, one per stage, with its time in seconds
+    """
+
+    results = []
+    num_gauntlets = settings["num_gauntlets"]
+    for run_style in ["Regular", "Meteor"]:
+        seconds, _ = time_stage(lambda: [generate_gauntlet_runs(run_style, df_jobs) for _ in range(num_gauntlets)])
+        results.append({"stage": "generate_gauntlet_runs", "seconds": seconds, "run_style": run_style,
+                        "num_gauntlets": num_gauntlets})
+        seconds, _ = time_stage(lambda: generate_gauntlet_run_indices(run_style, df_jobs, num_gauntlets,
+                                                                      np.random.default_rng(0)), settings["repeat"])
+        results.append({"stage": "generate_gauntlet_run_indices", "seconds": seconds, "run_style": run_style,
+                        "num_gauntlets": num_gauntlets})
+    for result in results:
+        print(f"  {result['stage'] + ' ' + result['run_style']:<40} {result['seconds']:>10.4f} s")
+    return results
+
+
+def get_metadata() -> dict:
+    """ Describe the code and machine the benchmark ran on, so results from different versions can be compared.
+    :return: the metadata
+    """
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": commit,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each stage of the party selection pipeline.")
+    parser.add_argument("--jobs", default="data_jobs/job_data_embeddings.csv")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--run-styles", nargs="+", default=RUN_STYLES)
+    parser.add_argument("--synthetic-jobs", type=int, nargs="*", default=[30, 40],
+                        help="numbers of jobs of synthetic job tables to also run")
+    parser.add_argument("--max-parties", type=int, default=300000,
+                        help="skip configurations with more parties than this")
+    parser.add_argument("--equip-factor", type=float, default=0.5)
+    parser.add_argument("--num-parties", type=int, default=8)
+    parser.add_argument("--eps", type=float, default=4.0)
+    parser.add_argument("--num-trials", type=int, default=100)
+    parser.add_argument("--num-procs", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--num-gauntlets", type=int, default=10000)
+    parser.add_argument("--embedding-sample", type=int, default=1000,
+                        help="number of parties to time the party by party embeddings on")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    settings = vars(args)
+
+    seconds, (df_jobs, stat_cols) = time_stage(lambda: load_data(args.jobs), args.repeat)
+    results = [{"stage": "load_data", "seconds": seconds, "jobs_table": args.jobs, "num_jobs": len(df_jobs)}]
+
+    job_tables = [(args.jobs, df_jobs)]
+    job_tables += [(f"synthetic_{num_jobs}", make_synthetic_job_table(df_jobs, num_jobs))
+                   for num_jobs in args.synthetic_jobs]
+
+    for table_name, df_table in job_tables:
+        for run_style in args.run_styles:
+            for duplicates in [False, True]:
+                if run_style == "Regular" and duplicates:
+                    continue  # Duplicates don't do anything for Regular runs
+                num_parties = len(generate_possible_party_indices(run_style, df_table, duplicates))
+                if num_parties > args.max_parties:
+                    print(f"Skipping {table_name} {run_style} duplicates={duplicates}: {num_parties} parties")
+                    continue
+
+                print(f"{table_name} {run_style} duplicates={duplicates}: {num_parties} parties")
+                configuration = {"jobs_table": table_name, "num_jobs": len(df_table), "run_style": run_style,
+                                 "duplicates": duplicates}
+                for result in benchmark_configuration(df_table, run_style, duplicates, settings):
+                    results.append({**configuration, **result})
+
+    print("Gauntlets")
+    results += [{"jobs_table": args.jobs, "num_jobs": len(df_jobs), **result}
+                for result in benchmark_gauntlets(df_jobs, settings)]
+
+    with open(args.output, "w") as f:
+        json.dump({"metadata": get_metadata(), "settings": settings, "results": results}, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
@@ -0,0 +1,99 @@
+import argparse
+import numpy as np
+from time import perf_counter
+
+from data import load_data
+from embeddings import calculate_party_embedding_matrix
+from generate_possible_parties import generate_possible_party_indices
+from select_parties import calculate_distances
+from spatial_index import build_ball_tree, query_radius
+
+
+def benchmark_spatial_index(embedding_matrix: np.ndarray, num_parties_list: list, eps_list: list,
+                            num_queries: int = 20, leaf_size: int = 32, seed: int = 0) -> list:
+    """ Time eps-range queries with the ball tree against calculating the distance to every party. Each
+    number of parties uses a random subset of the rows of embedding_matrix.
+    :param embedding_matrix: the embeddings to sample parties from
+    :param num_parties_list: the numbers of parties to try
+    :param eps_list: the values of eps to try
+    :param num_queries: the number of queries to average over
+    :param leaf_size: the leaf size of the ball tree
+    :param seed: the random seed for picking subsets and queries
+    :return: a list of dicts with the timings, one per number of parties and eps
+    """
+
+    rng = np.random.default_rng(seed)
+    results = []
+
+    for num_parties in num_parties_list:
+        rows = rng.choice(len(embedding_matrix), size=min(num_parties, len(embedding_matrix)), replace=False)
+        subset = np.ascontiguousarray(embedding_matrix[rows])
+        queries = subset[rng.integers(0, len(subset), size=num_queries)]
+
+        start = perf_counter()
+        tree = build_ball_tree(subset, leaf_size=leaf_size)
+        build_seconds = perf_counter() - start
+
+        start = perf_counter()
+        for query in queries:
+            calculate_distances(subset, query)
+        brute_force_seconds = (perf_counter() - start) / num_queries
+
+        for eps in eps_list:
+            num_close = 0
+            start = perf_counter()
+            for query in queries:
+                num_close += len(query_radius(tree, subset, query, eps)[0])
+            tree_seconds = (perf_counter() - start) / num_queries
+
+            results.append({"num_parties": len(subset),
+                            "eps": eps,
+                            "fraction_close": num_close / (num_queries * len(subset)),
+                            "build_seconds": build_seconds,
+                            "brute_force_seconds": brute_force_seconds,
+                            "tree_seconds": tree_seconds,
+                            "speedup": brute_force_seconds / tree_seconds})
+
+    return results
+
+
+def find_crossover_eps(results: list) -> dict:
+    """ For each number of parties, find the largest eps where the ball tree is still faster than brute force.
+    :param results: the results from benchmark_spatial_index
+    :return: a dict from number of parties to the crossover eps, or None if the tree was never faster
+    """
+
+    crossover = {}
+    for result in results:
+        crossover.setdefault(result["num_parties"], None)
+        if result["speedup"] > 1.0:
+            crossover[result["num_parties"]] = max(result["eps"], crossover[result["num_parties"]] or 0.0)
+    return crossover
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare ball tree eps queries against brute force.")
+    parser.add_argument("--jobs", default="data_jobs/job_data_embeddings.csv")
+    parser.add_argument("--run-style", default="Meteor")
+    parser.add_argument("--duplicates", action="store_true")
+    parser.add_argument("--equip-factor", type=float, default=0.5)
+    parser.add_argument("--num-parties", type=int, nargs="+", default=[1000, 10000, 50000, 250000])
+    parser.add_argument("--eps", type=float, nargs="+", default=[0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 4.0])
+    parser.add_argument("--num-queries", type=int, default=20)
+    parser.add_argument("--leaf-size", type=int, default=32)
+    args = parser.parse_args()
+
+    df_jobs, stat_cols = load_data(args.jobs)
+    party_indices = generate_possible_party_indices(args.run_style, df_jobs, args.duplicates)
+    embedding_matrix = calculate_party_embedding_matrix(party_indices, df_jobs, ["Summoner", "Black Mage", "Chemist"],
+                                                        args.equip_factor)
+
+    results = benchmark_spatial_index(embedding_matrix, args.num_parties, args.eps, args.num_queries, args.leaf_size)
+    print(f"{'parties':>8} {'eps':>5} {'close':>6} {'build s':>8} {'brute ms':>9} {'tree ms':>8} {'speedup':>8}")
+    for result in results:
+        print(f"{result['num_parties']:>8} {result['eps']:>5.2f} {result['fraction_close']:>6.3f} "
+              f"{result['build_seconds']:>8.2f} {result['brute_force_seconds'] * 1000:>9.2f} "
+              f"{result['tree_seconds'] * 1000:>8.2f} {result['speedup']:>8.2f}")
+
+    for num_parties, eps in find_crossover_eps(results).items():
+        print(f"{num_parties} parties: the tree is faster up to eps = {eps}")
@@ -0,0 +1,224 @@
+import numpy as np
+from numpy.linalg import norm
+
+from instrumentation import stage
+
+
+@stage("calibrate_eps")
+def calibrate_eps(embedding_matrix: np.ndarray, num_parties: int, eps: float = None, num_pairs: int = 1000000,
+                  min_available_fraction: float = 0.05, decay: float = 0.8, capacity: int = 1024,
+                  seed: int = None) -> dict:
+    """ Recommend a starting eps for selecting num_parties parties from embedding_matrix, so the selection rarely
+    has to shrink eps. The distribution of distances between parties is estimated from num_pairs random pairs of
+    parties, kept in a quantile sketch so memory doesn't grow with num_pairs (see new_quantile_sketch).
+
+    The selection is modelled as if each selected party ruled out the parties closer than eps to it independently,
+    so after k picks a fraction (1 - F(eps))^k of the parties is still available, where F(eps) is the fraction of
+    distances below eps. The selected parties are spread out, so they rule out more parties than random ones would,
+    and eps is kept small enough that the model still has min_available_fraction of the parties available at the
+    last pick. In the Regular and Meteor runs, decays were rare with the default of 0.05 and started when the model
+    gave under about 1%.
+
+    :param embedding_matrix: the embedding of each party, of shape (number of parties, embedding size)
+    :param num_parties: the number of parties to select in each trial
+    :param eps: an eps to also report the expected decay rounds for, e.g. the one used today. If None, only the
+    recommended eps is reported.
+    :param num_pairs: the number of random pairs of parties to sample distances from
+    :param min_available_fraction: the fraction of parties the model keeps available at the last pick
+    :param decay: the factor eps is multiplied by when no party is available (0.8 in select_parties)
+    :param capacity: the capacity of the quantile sketch
+    :param seed: the random seed for sampling pairs
+    :return: a dict with the recommended "eps", the "expected_decay_rounds" and "expected_final_eps" when starting
+    from eps (or from the recommended eps if eps is None), the "distance_quantiles" at 0, 0.01, 0.05, 0.25, 0.5,
+    0.75, 0.95, 0.99 and 1, and the "num_pairs" sampled
+    """
+
+    rng = np.random.default_rng(seed)
+    sketch = sample_pairwise_distances(embedding_matrix, num_pairs, rng=rng,
+                                       sketch=new_quantile_sketch(capacity, rng=rng))
+
+    recommended_eps = recommend_eps(sketch, num_parties, min_available_fraction)
+    decay_rounds, final_eps = expected_decay_rounds(sketch, num_parties, recommended_eps if eps is None else eps,
+                                                    min_available_fraction, decay)
+
+    quantile_levels = [0.0, 0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99, 1.0]
+    return {"eps": recommended_eps,
+            "expected_decay_rounds": decay_rounds,
+            "expected_final_eps": final_eps,
+            "distance_quantiles": {q: quantile_sketch_quantile(sketch, q) for q in quantile_levels},
+            "num_pairs": sketch["count"]}
+
+
+def recommend_eps(sketch: dict, num_parties: int, min_available_fraction: float = 0.05) -> float:
+    """ Find the largest eps where the model of calibrate_eps still has min_available_fraction of the parties
+    available at the last pick, that is where (1 - F(eps))^(num_parties - 1) >= min_available_fraction.
+    :param sketch: the quantile sketch of the distances between parties
+    :param num_parties: the number of parties to select in each trial
+    :param min_available_fraction: the fraction of parties to keep available at the last pick
+    :return: the recommended eps
+    """
+
+    if num_parties <= 1:
+        return quantile_sketch_quantile(sketch, 1.0)
+
+    fraction_close = 1.0 - min_available_fraction ** (1.0 / (num_parties - 1))
+    return quantile_sketch_quantile(sketch, fraction_close)
+
+
+def expected_decay_rounds(sketch: dict, num_parties: int, eps: float, min_available_fraction: float = 0.05,
+                          decay: float = 0.8) -> (int, float):
+    """ Estimate how many times the selection of num_parties parties will shrink eps when it starts from eps,
+    using the model of calibrate_eps.
+    :param sketch: the quantile sketch of the distances between parties
+    :param num_parties: the number of parties to select in each trial
+    :param eps: the eps the selection starts with
+    :param min_available_fraction: the fraction of available parties below which eps shrinks
+    :param decay: the factor eps is multiplied by when it shrinks
+    :return: the number of decay rounds and the eps at the end of the selection
+    """
+
+    # Parties with the same embedding are always close, however small eps gets
+    zero_fraction = quantile_sketch_cdf(sketch, np.nextafter(0.0, 1.0))
+
+    num_decays = 0
+    for num_selected in range(1, num_parties):
+        while (1.0 - quantile_sketch_cdf(sketch, eps)) ** num_selected < min_available_fraction and \
+                quantile_sketch_cdf(sketch, eps) > zero_fraction:
+            eps *= decay
+            num_decays += 1
+
+    return num_decays, eps
+
+
+def sample_pairwise_distances(embedding_matrix: np.ndarray, num_pairs: int, rng: np.random.Generator = None,
+                              chunk_size: int = 65536, sketch: dict = None) -> dict:
+    """ Add the distances (2-norm) between num_pairs random pairs of different parties to a quantile sketch. Pairs
+    are sampled chunk_size at a time, so memory doesn't grow with num_pairs.
+    :param embedding_matrix: the embedding of each party
+    :param num_pairs: the number of pairs to sample
+    :param rng: the random generator. If None, a new one is made.
+    :param chunk_size: the number of pairs to sample at a time
+    :param sketch: the sketch to add the distances to. If None, a new one is made.
+    :return: the sketch
+    """
+
+    rng = np.random.default_rng() if rng is None else rng
+    sketch = new_quantile_sketch(rng=rng) if sketch is None else sketch
+    num_embeddings = len(embedding_matrix)
+    if num_embeddings < 2:
+        return sketch
+
+    for start in range(0, num_pairs, chunk_size):
+        size = min(chunk_size, num_pairs - start)
+        first = rng.integers(0, num_embeddings, size=size)
+        second = (first + rng.integers(1, num_embeddings, size=size)) % num_embeddings
+        update_quantile_sketch(sketch, norm(embedding_matrix[first] - embedding_matrix[second], ord=2, axis=1))
+
+    return sketch
+
+
+def new_quantile_sketch(capacity: int = 1024, rng: np.random.Generator = None) -> dict:
+    """ Make an empty streaming quantile sketch, which estimates the quantiles of a stream of values while keeping
+    at most about capacity values per level and log2(count / capacity) levels.
+
+    Level h holds values that each stand for 2^h values of the stream. When a level holds more than capacity values,
+    it is sorted and every other value (starting at a random one of the first two) moves up a level, standing for
+    twice as many values. Quantiles are then off by about log2(count / capacity) / capacity.
+
+    :param capacity: the largest number of values kept in a level
+    :param rng: the random generator for picking which values move up. If None, a new one is made.
+    :return: the sketch, as a dict
+    """
+
+    return {"capacity": capacity,
+            "levels": [np.zeros((0, ), dtype=float)],
+            "count": 0,
+            "rng": np.random.default_rng() if rng is None else rng}
+
+
+def update_quantile_sketch(sketch: dict, values: np.ndarray):
+    """ Add values to a quantile sketch.
+    :param sketch: the sketch from new_quantile_sketch
+    :param values: the values to add
+    """
+
+    values = np.asarray(values, dtype=float).ravel()
+    sketch["levels"][0] = np.concatenate([sketch["levels"][0], values])
+    sketch["count"] += len(values)
+    _compact_quantile_sketch(sketch)
+
+
+def merge_quantile_sketches(sketch: dict, other: dict):
+    """ Add the values of another quantile sketch, e.g. one filled in another process, to sketch.
+    :param sketch: the sketch to add to
+    :param other: the sketch to add
+    """
+
+    for level, values in enumerate(other["levels"]):
+        if level == len(sketch["levels"]):
+            sketch["levels"].append(np.zeros((0, ), dtype=float))
+        sketch["levels"][level] = np.concatenate([sketch["levels"][level], values])
+    sketch["count"] += other["count"]
+    _compact_quantile_sketch(sketch)
+
+
+def quantile_sketch_quantile(sketch: dict, q: float) -> float:
+    """ Estimate the q quantile of the values added to a quantile sketch.
+    :param sketch: the sketch
+    :param q: the quantile, between 0 and 1
+    :return: the estimated quantile, or nan if the sketch is empty
+    """
+
+    values, cumulative_weights = _weighted_sketch_values(sketch)
+    if len(values) == 0:
+        return float("nan")
+    position = np.searchsorted(cumulative_weights, q * cumulative_weights[-1], side="left")
+    return float(values[min(position, len(values) - 1)])
+
+
+def quantile_sketch_cdf(sketch: dict, x: float) -> float:
+    """ Estimate the fraction of the values added to a quantile sketch that are less than x.
+    :param sketch: the sketch
+    :param x: the value to compare to
+    :return: the estimated fraction, or nan if the sketch is empty
+    """
+
+    values, cumulative_weights = _weighted_sketch_values(sketch)
+    if len(values) == 0:
+        return float("nan")
+    position = np.searchsorted(values, x, side="left")
+    return float(cumulative_weights[position - 1] / cumulative_weights[-1]) if position > 0 else 0.0
+
+
+def _weighted_sketch_values(sketch: dict) -> (np.ndarray, np.ndarray):
+    """ Get the sorted values of a quantile sketch with the cumulative number of stream values they stand for.
+    :param sketch: the sketch
+    :return: the sorted values and their cumulative weights
+    """
+
+    values = np.concatenate(sketch["levels"])
+    weights = np.concatenate([np.full((len(level_values), ), 2.0**level)
+                              for level, level_values in enumerate(sketch["levels"])])
+    order = np.argsort(values, kind="stable")
+    return values[order], np.cumsum(weights[order])
+
+
+def _compact_quantile_sketch(sketch: dict):
+    """ Move every other value of each full level of a quantile sketch up a level, until no level is full.
+    :param sketch: the sketch
+    """
+
+    level = 0
+    while level < len(sketch["levels"]):
+        values = sketch["levels"][level]
+        if len(values) > sketch["capacity"]:
+            values = np.sort(values)
+            # An odd value out stays at this level, so the total weight doesn't change
+            num_kept = len(values) % 2
+            offset = sketch["rng"].integers(0, 2)
+            promoted = values[num_kept:][offset::2]
+            sketch["levels"][level] = values[:num_kept]
+            if level + 1 == len(sketch["levels"]):
+                sketch["levels"].append(np.zeros((0, ), dtype=float))
+            sketch["levels"][level + 1] = np.concatenate([sketch["levels"][level + 1], promoted])
+        level += 1
@@ -0,0 +1,92 @@
+import argparse
+import http.client
+import json
+import socket
+
+# Only the standard library is imported here, so the client starts quickly. The work is done by server.py.
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """ An HTTP connection over a Unix socket, for servers started with --unix-socket. """
+
+    def __init__(self, path: str, timeout: float = None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def request(method: str, params: dict = None, host: str = "127.0.0.1", port: int = 8765, unix_socket: str = None,
+            timeout: float = 60.0) -> dict:
+    """ Send one request to the assignment server (see server.serve).
+    :param method: the method, e.g. "select_parties_by_embeddings", or "metrics" or "health"
+    :param params: the parameters of the method. If None, a GET request is sent.
+    :param host: the host of the server
+    :param port: the port of the server
+    :param unix_socket: the Unix socket of the server, used instead of host and port
+    :param timeout: the number of seconds to wait for the server
+    :return: the response
+    """
+
+    if unix_socket is not None:
+        connection = UnixHTTPConnection(unix_socket, timeout=timeout)
+    else:
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    try:
+        if params is None:
+            connection.request("GET", f"/{method}")
+        else:
+            connection.request("POST", f"/{method}", body=json.dumps(params),
+                               headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        body = json.loads(response.read())
+    finally:
+        connection.close()
+
+    if response.status != 200:
+        raise RuntimeError(f"The server returned {response.status}: {body.get('error')}")
+    return body
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Get party assignments from a running server.py.")
+    parser.add_argument("command", choices=["select", "random", "gauntlet", "metrics", "health"])
+    parser.add_argument("--run-style", default="Regular")
+    parser.add_argument("--duplicates", action="store_true")
+    parser.add_argument("--num-parties", type=int, default=5)
+    parser.add_argument("--eps", type=float, default=4.0)
+    parser.add_argument("--num-gauntlets", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix-socket", default=None)
+    parser.add_argument("--json", action="store_true", help="print the raw response")
+    args = parser.parse_args()
+
+    connection_args = {"host": args.host, "port": args.port, "unix_socket": args.unix_socket}
+    if args.command in ["metrics", "health"]:
+        result = request(args.command, **connection_args)
+    elif args.command == "gauntlet":
+        result = request("generate_gauntlet_runs", {"run_style": args.run_style, "num_gauntlets": args.num_gauntlets,
+                                                    "seed": args.seed}, **connection_args)
+    else:
+        method = "select_parties_by_embeddings" if args.command == "select" else "select_parties_randomly"
+        result = request(method, {"run_style": args.run_style, "duplicates": args.duplicates,
+                                  "num_parties": args.num_parties, "eps": args.eps, "seed": args.seed},
+                         **connection_args)
+
+    if args.json or args.command in ["metrics", "health"]:
+        print(json.dumps(result, indent=2))
+    elif args.command == "gauntlet":
+        for idx_gauntlet, gauntlet in enumerate(result["gauntlets"]):
+            print(f"Gauntlet {idx_gauntlet}")
+            for idx, party in enumerate(gauntlet):
+                print(f"{idx} {','.join(party)}")
+    else:
+        for idx, party in enumerate(result["parties"]):
+            print(f"{idx} {','.join(party)}")
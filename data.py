@@ -1,3 +1,5 @@
+import json
+import numpy as np
 import pandas as pd
 
 
@@ -33,16 +35,93 @@ def save_party_embeddings(filename: str, embeddings: list):
 
 def load_party_embeddings(filename: str) -> list:
     """ Loads a set of party embeddings from a csv file. The csv file is assumed to have the same
-    format as save_party_embeddings.
+    format as save_party_embeddings. If filename is not a csv file, it is loaded as an embedding store
+    written by save_party_embedding_store instead, and the embeddings are rows of the memory-mapped matrix.
     :param filename: the filename with the party embeddings to load
     :return: the embeddings in the form [("job1,job2,job3,job4", [v1,v2,v3,...]), ()...]
     """
 
+    if not filename.endswith(".csv"):
+        embedding_matrix, party_indices, header = load_party_embedding_store(filename)
+        job_names = np.array(header["jobs"], dtype=object)
+        party_names = [",".join(party) for party in job_names[party_indices]]
+        return list(zip(party_names, embedding_matrix))
+
     df_embeddings = pd.read_csv(filename, index_col=0)
     embeddings = _dataframe_to_tuple_array(df_embeddings)
     return embeddings
 
 
+def save_party_embedding_store(filename: str, embedding_matrix: np.ndarray, party_indices: np.ndarray,
+                               job_names: list, run_style: str, duplicates: bool, equip_factor: float,
+                               special_weight_jobs: list = None, dtype: np.dtype = None):
+    """ Saves party embeddings in a binary format that can be loaded without parsing or copying. Three files
+    are written:
+        filename: the embedding matrix as a .npy file, one row per party
+        filename with .parties.npy instead of .npy: the parties as job indices, see generate_possible_party_indices
+        filename with .json instead of .npy: a header with the job names and the settings used for the embeddings
+    :param filename: the filename of the embedding matrix. Should end in ".npy".
+    :param embedding_matrix: the embedding matrix, e.g. from calculate_party_embedding_matrix
+    :param party_indices: the job indices of the party in each row of embedding_matrix
+    :param job_names: the job names that party_indices refer to, usually list(df_jobs.index)
+    :param run_style: the run style of the parties
+    :param duplicates: whether the parties allow duplicates
+    :param equip_factor: the equip_factor used for the embeddings
+    :param special_weight_jobs: the special weight jobs used for the embeddings
+    :param dtype: the dtype to save the embedding matrix with, e.g. np.float32. If None, it's saved as is.
+    """
+
+    assert len(embedding_matrix) == len(party_indices)
+
+    matrix_filename, parties_filename, header_filename = _embedding_store_filenames(filename)
+    if dtype is not None:
+        embedding_matrix = embedding_matrix.astype(dtype, copy=False)
+    np.save(matrix_filename, embedding_matrix)
+    np.save(parties_filename, party_indices)
+
+    header = {"run_style": run_style,
+              "duplicates": bool(duplicates),
+              "equip_factor": float(equip_factor),
+              "special_weight_jobs": list(special_weight_jobs or []),
+              "jobs": list(job_names),
+              "num_parties": int(embedding_matrix.shape[0]),
+              "embedding_size": int(embedding_matrix.shape[1]),
+              "dtype": str(embedding_matrix.dtype)}
+    with open(header_filename, "w") as f:
+        json.dump(header, f, indent=2)
+
+
+def load_party_embedding_store(filename: str, mmap: bool = True) -> (np.ndarray, np.ndarray, dict):
+    """ Loads party embeddings saved with save_party_embedding_store. By default the arrays are memory-mapped
+    read-only, so nothing is copied and several processes loading the same file share its pages.
+    :param filename: the filename of the embedding matrix given to save_party_embedding_store
+    :param mmap: memory-map the arrays instead of reading them into memory
+    :return: the embedding matrix, the job indices of each party, and the header
+    """
+
+    matrix_filename, parties_filename, header_filename = _embedding_store_filenames(filename)
+    mmap_mode = "r" if mmap else None
+    embedding_matrix = np.load(matrix_filename, mmap_mode=mmap_mode)
+    party_indices = np.load(parties_filename, mmap_mode=mmap_mode)
+    with open(header_filename) as f:
+        header = json.load(f)
+
+    assert embedding_matrix.shape == (header["num_parties"], header["embedding_size"])
+    assert len(party_indices) == len(embedding_matrix)
+
+    return embedding_matrix, party_indices, header
+
+
+def _embedding_store_filenames(filename: str) -> (str, str, str):
+    """ Get the filenames of the files in an embedding store.
+    :param filename: the filename of the embedding matrix
+    :return: the filenames of the embedding matrix, the party indices, and the header
+    """
+
+    base = filename[:-len(".npy")] if filename.endswith(".npy") else filename
+    return base + ".npy", base + ".parties.npy", base + ".json"
+
+
 def _dataframe_to_tuple_array(df_embeddings: pd.DataFrame) -> list:
     """ Converts a DataFrame into the [("job1,job2,job3,job4", [v1,v2,v3,...]), ()...] embedding
     format. The DataFrame is of the same format used by save_party_embeddings.
@@ -50,7 +129,4 @@ def _dataframe_to_tuple_array(df_embeddings: pd.DataFrame) -> list:
     :return: the contents of df_embeddings in the embedding format
     """
     
-    tuple_array = []
-    for idx, row in df_embeddings.iterrows():
-        tuple_array.append((idx, row.to_numpy()))
-    return tuple_array
+    return list(zip(df_embeddings.index, df_embeddings.to_numpy(dtype=float)))
@@ -0,0 +1,224 @@
+import hashlib
+import json
+import numpy as np
+from numpy.linalg import norm
+
+# The number of set bits in each byte, for counting bits where numpy.bitwise_count isn't available
+_POPCOUNT_TABLE = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)
+
+# The keys prepare_metric adds to a metric
+_PREPARED_KEYS = ["source", "matrix", "squared_norms", "packed"]
+
+
+def euclidean_metric() -> dict:
+    """ The exact 2-norm distance between embeddings, norm(a - b, ord=2). This is the default metric everywhere.
+    :return: the metric
+    """
+
+    return {"name": "euclidean"}
+
+
+def gemm_euclidean_metric(dtype: type = np.float32) -> dict:
+    """ The 2-norm distance calculated in bulk with ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b, so distances to many
+    parties take one matrix product. With prepare_metric, the embedding matrix is converted to dtype and its row
+    norms are calculated once instead of for every query.
+
+    In float32 the distances are only accurate to about 1e-6, so a party that is almost exactly eps away can land on
+    either side of eps. Use euclidean_metric when that matters.
+
+    :param dtype: the floating point type to calculate in
+    :return: the metric
+    """
+
+    return {"name": "gemm_euclidean", "dtype": np.dtype(dtype).name}
+
+
+def weighted_block_metric(block_columns: dict, weights: dict) -> dict:
+    """ The 2-norm distance with each block of the embedding weighted, sqrt(sum over blocks of w * ||a_b - b_b||^2).
+    Blocks can be weighted at query time without calculating the embeddings again, e.g. to count differences in
+    equipment twice as much as differences in style.
+    :param block_columns: the columns of each block, e.g. from embeddings.get_embedding_block_columns
+    :param weights: the weight of each block. Blocks without a weight, and columns in no block, have weight 1.
+    :return: the metric
+    """
+
+    return {"name": "weighted_block",
+            "block_columns": {block: np.asarray(columns) for block, columns in block_columns.items()},
+            "weights": dict(weights)}
+
+
+def hamming_metric(columns: np.ndarray) -> dict:
+    """ The number of columns where one embedding is zero and the other isn't, e.g. the number of equipment types
+    and jobs two parties don't share. The columns are packed 8 to a byte, and the differences are counted with
+    XOR and a popcount, so distances take far less memory traffic than on the float embeddings.
+    :param columns: the columns to compare, e.g. the "equip" and "jobs" columns from
+    embeddings.get_embedding_block_columns
+    :return: the metric
+    """
+
+    return {"name": "hamming", "columns": np.asarray(columns)}
+
+
+def prepare_metric(metric: dict or None, embedding_matrix: np.ndarray) -> dict:
+    """ Calculate what a metric needs to know about embedding_matrix once, so that every call of distances_to_rows
+    on embedding_matrix can use it: the converted matrix and row norms for gemm_euclidean_metric, and the packed
+    bits for hamming_metric.
+
+    The prepared metric keeps a fingerprint of embedding_matrix (see _matrix_fingerprint), and is prepared again if
+    it is used with a matrix that doesn't match it. The fingerprint only hashes some of the rows, so after changing
+    a few rows of the matrix in place, prepare the metric again from the unprepared one.
+
+    :param metric: the metric. If None, euclidean_metric is used.
+    :param embedding_matrix: the embedding matrix the metric will be used on
+    :return: the prepared metric
+    """
+
+    metric = euclidean_metric() if metric is None else metric
+    source = _matrix_fingerprint(embedding_matrix)
+    if metric.get("source") == source:
+        return metric  # Already prepared
+
+    prepared = dict({key: value for key, value in metric.items() if key not in _PREPARED_KEYS}, source=source)
+    if metric["name"] == "gemm_euclidean":
+        prepared["matrix"] = np.ascontiguousarray(embedding_matrix, dtype=metric["dtype"])
+        prepared["squared_norms"] = np.einsum("ij,ij->i", prepared["matrix"], prepared["matrix"])
+    elif metric["name"] == "hamming":
+        prepared["packed"] = _pack_columns(embedding_matrix, metric["columns"])
+    return prepared
+
+
+def describe_metric(metric: dict or None) -> dict:
+    """ Describe a metric with plain values, without what prepare_metric added to it, e.g. to save it as json.
+    :param metric: the metric, prepared or not. If None, euclidean_metric is used.
+    :return: the description, which is the same after a round trip through json
+    """
+
+    metric = euclidean_metric() if metric is None else metric
+    metric = {key: value for key, value in metric.items() if key not in _PREPARED_KEYS}
+    return json.loads(json.dumps(metric, sort_keys=True, default=lambda value: np.asarray(value).tolist()))
+
+
+def distances_to_rows(embedding_matrix: np.ndarray, embeddings: np.ndarray, metric: dict = None,
+                      chunk_size: int = 65536) -> np.ndarray:
+    """ Calculate the distance from each of embeddings to each row of embedding_matrix.
+    :param embedding_matrix: the embeddings to compare against, one per row
+    :param embeddings: the embeddings to compare, one per row
+    :param metric: the metric, prepared for embedding_matrix or not. If None, euclidean_metric is used.
+    :param chunk_size: the number of rows of embedding_matrix to handle at once
+    :return: the distances, of shape (number of embeddings, number of rows of embedding_matrix)
+    """
+
+    metric = prepare_metric(metric, embedding_matrix)
+    embeddings = np.atleast_2d(embeddings)
+    distances = np.empty((len(embeddings), len(embedding_matrix)), dtype=float)
+
+    if metric["name"] == "gemm_euclidean":
+        queries = np.asarray(embeddings, dtype=metric["dtype"])
+        query_squared_norms = np.einsum("ij,ij->i", queries, queries)
+        for start in range(0, len(embedding_matrix), chunk_size):
+            squared_distances = queries @ metric["matrix"][start:start+chunk_size].T
+            squared_distances *= -2.0
+            squared_distances += query_squared_norms[:, None]
+            squared_distances += metric["squared_norms"][None, start:start+chunk_size]
+            np.maximum(squared_distances, 0.0, out=squared_distances)
+            distances[:, start:start+chunk_size] = np.sqrt(squared_distances)
+
+    elif metric["name"] == "hamming":
+        queries = _pack_columns(embeddings, metric["columns"])
+        for row, query in enumerate(queries):
+            for start in range(0, len(embedding_matrix), chunk_size):
+                distances[row, start:start+chunk_size] = count_bits(
+                    metric["packed"][start:start+chunk_size] ^ query).sum(axis=1)
+
+    elif metric["name"] in ["euclidean", "weighted_block"]:
+        scale = None if metric["name"] == "euclidean" else _column_scale(metric, embedding_matrix.shape[1])
+        for row, embedding in enumerate(embeddings):
+            for start in range(0, len(embedding_matrix), chunk_size):
+                differences = embedding_matrix[start:start+chunk_size] - embedding
+                if scale is not None:
+                    differences *= scale
+                distances[row, start:start+chunk_size] = norm(differences, ord=2, axis=1)
+
+    else:
+        raise ValueError(f"Unknown metric {metric['name']}")
+
+    return distances
+
+
+def pairwise_distances(embeddings: np.ndarray, metric: dict = None) -> np.ndarray:
+    """ Calculate the distance between each pair of embeddings, e.g. for a comparison matrix. The distance of an
+    embedding to itself is always 0, even with the rounding of gemm_euclidean_metric.
+    :param embeddings: the embeddings, one per row
+    :param metric: the metric. If None, euclidean_metric is used.
+    :return: the matrix of distances, of shape (number of embeddings, number of embeddings)
+    """
+
+    embeddings = np.asarray(embeddings)
+    if len(embeddings) == 0:
+        return np.zeros((0, 0), dtype=float)
+    if metric is None or metric["name"] == "euclidean":
+        return norm(embeddings[:, None, :] - embeddings[None, :, :], ord=2, axis=2)
+
+    metric = {key: value for key, value in metric.items() if key not in _PREPARED_KEYS}
+    distances = distances_to_rows(embeddings, embeddings, metric)
+    np.fill_diagonal(distances, 0.0)
+    return distances
+
+
+def count_bits(packed: np.ndarray) -> np.ndarray:
+    """ Count the set bits in each byte.
+    :param packed: an array of bytes
+    :return: the number of set bits of each byte
+    """
+
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(packed)
+    return _POPCOUNT_TABLE[packed]
+
+
+def embedding_fingerprint(embedding_matrix: np.ndarray, num_sampled_rows: int = 64) -> str:
+    """ Identify the contents of an embedding matrix cheaply: its shape and dtype, and a hash of up to
+    num_sampled_rows rows spread over it. The same contents give the same fingerprint in any process.
+    :param embedding_matrix: the embedding matrix
+    :param num_sampled_rows: the number of rows to hash
+    :return: the fingerprint
+    """
+
+    embedding_matrix = np.asarray(embedding_matrix)
+    rows = np.unique(np.linspace(0, len(embedding_matrix) - 1, num=min(num_sampled_rows, len(embedding_matrix)),
+                                 dtype=np.int64))
+    sample_hash = hashlib.blake2b(np.ascontiguousarray(embedding_matrix[rows]).tobytes(), digest_size=16)
+    return f"{embedding_matrix.shape}/{embedding_matrix.dtype.str}/{sample_hash.hexdigest()}"
+
+
+def _matrix_fingerprint(embedding_matrix: np.ndarray) -> str:
+    """ Identify an embedding matrix cheaply enough to check on every call of distances_to_rows: its memory address
+    and its embedding_fingerprint.
+    :param embedding_matrix: the embedding matrix
+    :return: the fingerprint
+    """
+
+    return f"{np.asarray(embedding_matrix).ctypes.data}/{embedding_fingerprint(embedding_matrix)}"
+
+
+def _column_scale(metric: dict, num_columns: int) -> np.ndarray:
+    """ Get the factor each column is multiplied by for weighted_block_metric, the square root of its weight.
+    :param metric: the weighted block metric
+    :param num_columns: the number of columns of the embeddings
+    :return: the factor of each column
+    """
+
+    scale = np.ones((num_columns, ), dtype=float)
+    for block, weight in metric["weights"].items():
+        scale[metric["block_columns"][block]] = np.sqrt(weight)
+    return scale
+
+
+def _pack_columns(embeddings: np.ndarray, columns: np.ndarray) -> np.ndarray:
+    """ Pack whether each of columns is non-zero into bits, 8 columns to a byte.
+    :param embeddings: the embeddings, one per row
+    :param columns: the columns to pack
+    :return: the packed bits, of shape (number of embeddings, ceil(number of columns / 8))
+    """
+
+    return np.packbits(np.asarray(embeddings)[:, columns] != 0, axis=1)
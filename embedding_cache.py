@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+import numpy as np
+import pandas as pd
+
+from data import load_party_embedding_store, save_party_embedding_store
+from embeddings import calculate_party_embedding_matrix
+from generate_possible_parties import generate_possible_party_indices
+
+# Bump this when the embeddings change, so old cache entries are not used
+CACHE_FORMAT_VERSION = 1
+
+
+def cached_party_embeddings(df_jobs: pd.DataFrame, run_style: str, duplicates: bool = False,
+                            special_weight_jobs: list = None, equip_factor: float = 1.0,
+                            cache_dir: str = "data/cache", max_bytes: int = 2**31) -> (np.ndarray, np.ndarray, dict):
+    """ Get the embeddings of all possible parties for a run style, from the cache if they were calculated before.
+    Otherwise the parties are generated with generate_possible_party_indices, their embeddings are calculated with
+    calculate_party_embedding_matrix, and both are added to the cache.
+
+    Cache entries are found by a hash of everything the embeddings depend on (see embedding_cache_key), including
+    the contents of df_jobs, so changing the job data or any setting can't pick up a stale entry. Each entry is an
+    embedding store (see data.save_party_embedding_store) in its own directory. It is written to a temporary
+    directory first and then renamed into place, so other processes never see a half-written entry. When the cache
+    is larger than max_bytes, the least recently used entries are removed. The returned arrays are memory-mapped
+    before that, so they stay readable if another process removes the entry. An entry that can't be loaded (e.g.
+    one that was changed by hand) is removed and added again, once.
+
+    :param df_jobs: the DataFrame of jobs data
+    :param run_style: the Four Job Fiesta run style ("Regular", "Typhoon", "Volcano", or "Meteor")
+    :param duplicates: flag to allow duplicates
+    :param special_weight_jobs: jobs to give the special weight in the jobs embedding
+    :param equip_factor: the scaling factor for the equipment embeddings
+    :param cache_dir: the directory of the cache
+    :param max_bytes: the largest size of the cache
+    :return: the memory-mapped embedding matrix, the job indices of each party, and the header of the store
+    """
+
+    key = embedding_cache_key(df_jobs, run_style, duplicates, special_weight_jobs, equip_factor)
+    entry_dir = os.path.join(cache_dir, key)
+    entry_filename = os.path.join(entry_dir, "embeddings.npy")
+
+    for attempt in range(2):
+        if not os.path.isdir(entry_dir):
+            party_indices = generate_possible_party_indices(run_style, df_jobs, duplicates)
+            embedding_matrix = calculate_party_embedding_matrix(party_indices, df_jobs, special_weight_jobs,
+                                                                equip_factor)
+
+            temp_dir = os.path.join(cache_dir, f".{key}.{uuid.uuid4().hex}.tmp")
+            os.makedirs(temp_dir)
+            try:
+                save_party_embedding_store(os.path.join(temp_dir, "embeddings.npy"), embedding_matrix,
+                                           party_indices, list(df_jobs.index), run_style, duplicates, equip_factor,
+                                           special_weight_jobs)
+                os.rename(temp_dir, entry_dir)
+            except OSError:
+                # Another process added the same entry first
+                if not os.path.isdir(entry_dir):
+                    raise
+            finally:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+        # Open the store before evicting, so it stays readable even if another process removes the entry later.
+        # Entries appear and disappear with a rename, so one that can't be loaded is corrupt, or was just removed.
+        try:
+            store = load_party_embedding_store(entry_filename)
+            _touch(os.path.join(entry_dir, "last_used"))
+            break
+        except (OSError, ValueError, AssertionError):
+            if attempt > 0:
+                raise
+            _remove_cache_entry(cache_dir, key)
+
+    evict_embedding_cache(cache_dir, max_bytes, keep=[key])
+
+    return store
+
+
+def embedding_cache_key(df_jobs: pd.DataFrame, run_style: str, duplicates: bool = False,
+                        special_weight_jobs: list = None, equip_factor: float = 1.0) -> str:
+    """ Get the cache key of a set of party embeddings: a hash of the job table and the settings of the embeddings.
+    The order of special_weight_jobs doesn't matter.
+    :param df_jobs: the DataFrame of jobs data
+    :param run_style: the Four Job Fiesta run style
+    :param duplicates: flag to allow duplicates
+    :param special_weight_jobs: jobs to give the special weight in the jobs embedding
+    :param equip_factor: the scaling factor for the equipment embeddings
+    :return: the key, as a hex string
+    """
+
+    settings = {"version": CACHE_FORMAT_VERSION,
+                "run_style": run_style,
+                "duplicates": bool(duplicates),
+                "special_weight_jobs": sorted(special_weight_jobs or []),
+                "equip_factor": float(equip_factor)}
+
+    key_hash = hashlib.sha256()
+    key_hash.update(df_jobs.to_csv().encode())
+    key_hash.update(json.dumps(settings, sort_keys=True).encode())
+    return key_hash.hexdigest()
+
+
+def evict_embedding_cache(cache_dir: str, max_bytes: int, keep: list = None):
+    """ Remove the least recently used entries of the cache until it is at most max_bytes.
+    :param cache_dir: the directory of the cache
+    :param max_bytes: the largest size of the cache
+    :param keep: keys of entries to never remove
+    """
+
+    keep = keep or []
+    entries = []
+    for key in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, key)
+        if key.startswith(".") or not os.path.isdir(entry_dir):
+            continue
+        try:
+            filenames = [os.path.join(entry_dir, filename) for filename in os.listdir(entry_dir)]
+            size = sum(os.path.getsize(filename) for filename in filenames)
+            last_used = os.path.getmtime(os.path.join(entry_dir, "last_used"))
+        except OSError:
+            continue  # Removed by another process
+        entries.append((last_used, size, key))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, key in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        if key in keep:
+            continue
+        _remove_cache_entry(cache_dir, key)
+        total_bytes -= size
+
+    # Finish removing entries whose removal was interrupted
+    for filename in os.listdir(cache_dir):
+        if filename.startswith(".") and filename.endswith(".evict"):
+            shutil.rmtree(os.path.join(cache_dir, filename), ignore_errors=True)
+
+
+def _remove_cache_entry(cache_dir: str, key: str):
+    """ Remove an entry of the cache. It is first renamed out of the way, which is atomic, so other processes
+    either see the whole entry or none of it, even if deleting its files fails or is interrupted.
+    :param cache_dir: the directory of the cache
+    :param key: the key of the entry
+    """
+
+    tombstone_dir = os.path.join(cache_dir, f".{key}.{uuid.uuid4().hex}.evict")
+    try:
+        os.rename(os.path.join(cache_dir, key), tombstone_dir)
+    except FileNotFoundError:
+        return  # Removed by another process
+    shutil.rmtree(tombstone_dir, ignore_errors=True)
+
+
+def _touch(filename: str):
+    """ Set the modification time of a file to now, creating it if needed.
+    :param filename: the file to touch
+    """
+
+    with open(filename, "a"):
+        os.utime(filename)
@@ -1,20 +1,43 @@
 import pandas as pd
 import numpy as np
 
+from instrumentation import report_progress, stage
 
+
+@stage("calculate_party_embeddings")
 def calculate_party_embeddings(valid_parties: list, df_jobs: pd.DataFrame,
-                               stat_cols: list, special_weight_jobs: list = None, equip_factor: float = 1.0) -> list:
+                               stat_cols: list, special_weight_jobs: list = None, equip_factor: float = 1.0,
+                               batch: bool = False) -> list:
     """ Go through each valid party and calculate the embeddings for each party. The return value
     is an embedding list with one row per valid party of the form
     [("job1,job2,job3,job4", [v1,v2,v3,...]), ()...].
+
+    If batch is True, the embeddings are calculated all at once by calculate_party_embedding_matrix.
+    The result is identical, but each embedding in the list is a row of one shared matrix.
+
     :param valid_parties: a list of parties that are possible
     :param df_jobs: the DataFrame of job's data
     :param stat_cols: a list of the column names in df_jobs for stats
     :param special_weight_jobs: double the weight of these jobs
     :param equip_factor: the weight to give the embeddings for equipment
+    :param batch: calculate all embeddings at once with NumPy instead of one party at a time
     :return: the embedding list
     """
 
+    if batch:
+        if len(valid_parties) == 0:
+            return []
+        party_jobs = np.ravel(valid_parties)
+        party_indices = df_jobs.index.get_indexer(party_jobs)
+        if (party_indices < 0).any():
+            # Like the per-party path, which looks each job up with df_jobs.loc
+            raise KeyError(sorted({str(job) for job in party_jobs[party_indices < 0]}))
+        party_indices = party_indices.reshape(len(valid_parties), -1)
+        embedding_matrix = calculate_party_embedding_matrix(party_indices, df_jobs, special_weight_jobs,
+                                                            equip_factor)
+        return [(",".join(chosen_party), embedding)
+                for chosen_party, embedding in zip(valid_parties, embedding_matrix)]
+
     counter = 0
     valid_parties_embeddings = []
 
@@ -26,7 +49,7 @@ def calculate_party_embeddings(valid_parties: list, df_jobs: pd.DataFrame,
 
         # Provide some output so we know things are working
         if counter % 10000 == 0:
-            print(f"On {counter} / {len(valid_parties)}")
+            report_progress("calculate_party_embeddings", counter, len(valid_parties))
         counter += 1
 
         # Calculate the stats embeddings
@@ -46,6 +69,197 @@ def calculate_party_embeddings(valid_parties: list, df_jobs: pd.DataFrame,
     return valid_parties_embeddings
 
 
+def calculate_party_embedding_matrix(party_indices: np.ndarray, df_jobs: pd.DataFrame,
+                                     special_weight_jobs: list = None, equip_factor: float = 1.0) -> np.ndarray:
+    """ Calculate the embeddings for many parties at once. Each row of party_indices is one party, given as
+    the positions of its jobs in df_jobs.index, e.g. [9, 2, 12, 7] for ["Knight", "Berserker", "Ninja", "Dragoon"].
+    Row i of the returned matrix is exactly the embedding that calculate_party_embeddings gives for party i:
+    the style and equipment embedding from calculate_style_equip_embedding (including the Freelancer
+    fallback), followed by the embedding from calculate_jobs_embedding.
+
+    Instead of looking up each job in df_jobs for every party, the per-job values are looked up once
+    by get_job_lookup_arrays and then gathered for all parties with NumPy indexing. This goes through
+    calculate_party_embedding_blocks and combine_embedding_blocks.
+
+    :param party_indices: array of shape (number of parties, 4) with the index of each job in df_jobs
+    :param df_jobs: the DataFrame with data on each job
+    :param special_weight_jobs: jobs to give the special weight in the jobs embedding
+    :param equip_factor: the scaling factor for the equipment embeddings
+    :return: the embedding matrix, with one row per party
+    """
+
+    blocks = calculate_party_embedding_blocks(party_indices, df_jobs)
+    return combine_embedding_blocks(blocks, special_weight_jobs, equip_factor)
+
+
+@stage("calculate_party_embedding_blocks")
+def calculate_party_embedding_blocks(party_indices: np.ndarray, df_jobs: pd.DataFrame) -> dict:
+    """ Calculate the parts of the party embeddings that don't depend on equip_factor or the special weight jobs.
+    The embeddings are made of three blocks:
+        style: the number of jobs of each style available at each crystal, of shape (parties, 4 crystals, 4 styles)
+        equip: the equipment available at each crystal, unscaled, of shape (parties, 4 crystals, equipment types)
+        jobs: whether each job is in the party, of shape (parties, jobs)
+    The Freelancer fallback of calculate_style_equip_embedding is already applied: a crystal without available jobs
+    has one Misc job and the Freelancer's equipment.
+
+    Use combine_embedding_blocks to get the embedding matrix for an equip_factor and special weight jobs. To try
+    another setting, set_equip_factor and set_special_weight_jobs only rewrite the columns that change.
+
+    :param party_indices: array of shape (number of parties, 4) with the index of each job in df_jobs
+    :param df_jobs: the DataFrame with data on each job
+    :return: a dict with the "style", "equip" and "jobs" blocks, and the "job_names" the jobs block refers to
+    """
+
+    lookup = get_job_lookup_arrays(df_jobs)
+    party_indices = np.asarray(party_indices, dtype=np.intp)
+    num_parties, party_size = party_indices.shape
+    num_crystals = len(lookup["crystal_order"])
+    num_styles = len(lookup["style_order"])
+    num_equip = lookup["equip_bits"].shape[1]
+
+    # Equipment is stored compactly unless the Freelancer's equipment values don't fit in a uint8
+    freelancer_equip = lookup["freelancer_equip"]
+    equip_dtype = np.uint8
+    if freelancer_equip is not None and not np.array_equal(freelancer_equip, freelancer_equip.astype(np.uint8)):
+        equip_dtype = float
+
+    style_block = np.zeros((num_parties, num_crystals, num_styles), dtype=np.uint8)
+    equip_block = np.zeros((num_parties, num_crystals, num_equip), dtype=equip_dtype)
+    party_crystals = lookup["crystal_idx"][party_indices]
+    party_styles = lookup["style_onehot"][party_indices].astype(np.uint8)
+    party_equip = lookup["equip_bits"][party_indices]
+    misc_idx = lookup["style_order"].index("Misc")
+
+    for curr_crystal in range(0, num_crystals):
+
+        # A job counts if it was assigned by curr_crystal and its crystal has been reached
+        is_available = party_crystals <= curr_crystal
+        is_available[:, curr_crystal+1:] = False
+        is_any_job_available = is_available.any(axis=1)
+
+        style_block[:, curr_crystal] = (party_styles * is_available[:, :, None]).sum(axis=1)
+        equip_block[:, curr_crystal] = (party_equip & is_available[:, :, None]).any(axis=1)
+
+        # If no jobs are available, then every character is a freelancer
+        if not is_any_job_available.all():
+            if freelancer_equip is None:
+                raise KeyError("Freelancer")
+            style_block[~is_any_job_available, curr_crystal] = 0
+            style_block[~is_any_job_available, curr_crystal, misc_idx] = 1
+            equip_block[~is_any_job_available, curr_crystal] = freelancer_equip
+
+    jobs_block = np.zeros((num_parties, len(df_jobs)), dtype=bool)
+    jobs_block[np.repeat(np.arange(num_parties), party_size), party_indices.ravel()] = True
+
+    return {"style": style_block, "equip": equip_block, "jobs": jobs_block, "job_names": list(df_jobs.index)}
+
+
+@stage("combine_embedding_blocks")
+def combine_embedding_blocks(blocks: dict, special_weight_jobs: list = None, equip_factor: float = 1.0,
+                             out: np.ndarray = None) -> np.ndarray:
+    """ Put the blocks from calculate_party_embedding_blocks together into the embedding matrix, using the
+    layout of calculate_party_embeddings: the style and equipment embeddings of each crystal in crystal order,
+    followed by the jobs embedding. The result is identical to calculate_party_embeddings.
+    :param blocks: the embedding blocks
+    :param special_weight_jobs: jobs to give the special weight in the jobs embedding
+    :param equip_factor: the scaling factor for the equipment embeddings
+    :param out: the matrix to write the embeddings to. If None, a new matrix is created.
+    :return: the embedding matrix
+    """
+
+    num_parties, num_crystals, num_styles = blocks["style"].shape
+    crystal_width = num_styles + blocks["equip"].shape[2]
+    if out is None:
+        out = np.empty((num_parties, num_crystals * crystal_width + blocks["jobs"].shape[1]), dtype=float)
+
+    for curr_crystal in range(0, num_crystals):
+        start = curr_crystal * crystal_width
+        out[:, start:start+num_styles] = blocks["style"][:, curr_crystal] * 0.25
+    set_equip_factor(out, blocks, equip_factor)
+    set_special_weight_jobs(out, blocks, special_weight_jobs)
+
+    return out
+
+
+def set_equip_factor(embedding_matrix: np.ndarray, blocks: dict, equip_factor: float):
+    """ Rewrite only the equipment columns of an embedding matrix for a new equip_factor. The result is the same as
+    calculating the embeddings again with equip_factor.
+    :param embedding_matrix: the embedding matrix from combine_embedding_blocks, changed in place
+    :param blocks: the embedding blocks the matrix was made from
+    :param equip_factor: the new scaling factor for the equipment embeddings
+    """
+
+    num_crystals, num_styles = blocks["style"].shape[1:]
+    num_equip = blocks["equip"].shape[2]
+    crystal_width = num_styles + num_equip
+
+    for curr_crystal in range(0, num_crystals):
+        start = curr_crystal * crystal_width + num_styles
+        embedding_matrix[:, start:start+num_equip] = blocks["equip"][:, curr_crystal].astype(float) * equip_factor
+
+
+def set_special_weight_jobs(embedding_matrix: np.ndarray, blocks: dict, special_weight_jobs: list = None):
+    """ Rewrite only the jobs embedding columns of an embedding matrix for new special weight jobs. The result is
+    the same as calculating the embeddings again with special_weight_jobs.
+    :param embedding_matrix: the embedding matrix from combine_embedding_blocks, changed in place
+    :param blocks: the embedding blocks the matrix was made from
+    :param special_weight_jobs: the new jobs to give the special weight in the jobs embedding
+    """
+
+    job_weights = np.where(np.isin(blocks["job_names"], special_weight_jobs or []), 0.1, 1.0)
+    jobs_start = embedding_matrix.shape[1] - blocks["jobs"].shape[1]
+    embedding_matrix[:, jobs_start:] = np.where(blocks["jobs"], job_weights, 0.0)
+
+
+def get_embedding_block_columns(df_jobs: pd.DataFrame) -> dict:
+    """ Find the columns of each block in the embeddings of calculate_party_embeddings, e.g. for
+    distances.weighted_block_metric. Each crystal has its style columns followed by its equipment columns, and the
+    jobs columns come last.
+    :param df_jobs: the DataFrame with data on each job
+    :return: a dict with the "style", "equip" and "jobs" columns, as arrays of column indices
+    """
+
+    num_crystals, num_styles = 4, 4  # The lengths of crystal_order and style_order in get_job_lookup_arrays
+    num_equip = len(df_jobs.columns[6:])  # Crystal + Style + stat_cols + equip_cols
+    crystal_starts = np.arange(num_crystals) * (num_styles + num_equip)
+
+    return {"style": (crystal_starts[:, None] + np.arange(num_styles)).ravel(),
+            "equip": (crystal_starts[:, None] + num_styles + np.arange(num_equip)).ravel(),
+            "jobs": num_crystals * (num_styles + num_equip) + np.arange(len(df_jobs))}
+
+
+def get_job_lookup_arrays(df_jobs: pd.DataFrame) -> dict:
+    """ Look up the values needed for the embeddings of every job in df_jobs once, so they can be gathered
+    for many parties with NumPy indexing. All arrays are ordered the same as df_jobs.index.
+    The weights of the jobs embedding aren't looked up here, since they depend on the special weight jobs and
+    are set by combine_embedding_blocks and set_special_weight_jobs.
+    :param df_jobs: the DataFrame with data on each job
+    :return: a dict with the crystal index ("crystal_idx"), style one-hot ("style_onehot") and equipment
+    bits ("equip_bits") of each job, the equipment of a Freelancer ("freelancer_equip", None if there is no
+    Freelancer), and the crystal and style orders used
+    """
+
+    crystal_order = ["Wind", "Water", "Fire", "Earth"]
+    crystal_col = "Crystal"
+    style_order = ["Heavy", "Clothes", "Mage", "Misc"]
+    style_col = "Style"
+
+    equip_cols = df_jobs.columns[6:]  # Crystal + Style + stat_cols + equip_cols
+
+    crystal_idx = np.array([get_crystal_idx(job, df_jobs, crystal_order, crystal_col) for job in df_jobs.index])
+    style_onehot = np.zeros((len(df_jobs), len(style_order)), dtype=float)
+    style_onehot[np.arange(len(df_jobs)), [style_order.index(style) for style in df_jobs[style_col]]] = 1.0
+    equip_bits = df_jobs[equip_cols].to_numpy().astype(bool)
+
+    if "Freelancer" in df_jobs.index:
+        freelancer_equip = df_jobs.loc["Freelancer"][equip_cols].to_numpy(dtype=float)
+    else:
+        freelancer_equip = None
+
+    return {"crystal_idx": crystal_idx, "style_onehot": style_onehot, "equip_bits": equip_bits,
+            "freelancer_equip": freelancer_equip, "crystal_order": crystal_order, "style_order": style_order}
+
+
 def calculate_style_equip_embedding(chosen_party: list, df_jobs: pd.DataFrame, equip_factor: float = 1.0) -> np.ndarray:
     """ Calculate embeddings based on the style and equipment for the chosen party.
     For style, this computes the number of jobs of each style (heavy, clothes, mage, misc) in the
@@ -1,16 +1,34 @@
+from contextlib import contextmanager
+import csv
 from functools import partial
+import json
+import mmap
 from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
 import numpy as np
-from numpy.linalg import norm
+import os
 from typing import Callable
 
+from distances import describe_metric, embedding_fingerprint, pairwise_distances, prepare_metric
+from instrumentation import count, is_recording, merge_report, report_progress, run_recorded, stage
+from select_parties import select_party_indices_batched, select_party_indices_by_embeddings
 
+# State of a trial worker process, set once by _init_trial_worker
+_worker_state = {}
+
+
+@stage("run_trials")
 def run_trials(valid_parties_embeddings: list, num_parties: int, num_trials: int, eps: float, selector: Callable,
-               should_generate_matrix: bool = False, verbose: bool = False, num_procs: int = 1) -> list:
+               should_generate_matrix: bool = False, verbose: bool = False, num_procs: int = 1,
+               index: dict = None, aggregate: bool = False, seed: int = None) -> list or dict:
     """ Select a collection of num_parties, num_trials times. This returns the selected parties for
         each trial, as well as the comparison matrix for each party. If should_generate_matrix is False, then
         None is returned for the matrices.
 
+        The selectors draw from numpy.random, and forked worker processes all start with the same state of it. So
+        each trial seeds numpy.random from seed and its trial id (see run_trial), and the results only depend on
+        seed, not on num_procs.
+
         selector is a method that selects a party. The signature must be:
             (valid_parties: list, num_parties: int = 10, eps: float = 1.0)
 
@@ -22,25 +40,52 @@ def run_trials(valid_parties_embeddings: list, num_parties: int, num_trials: int
         :param should_generate_matrix: should the comparison matrices be generated?
         :param verbose: print information
         :param num_procs: the number of processes to use when creating trials
+        :param index: a ball tree over the embeddings (see spatial_index.build_ball_tree), passed on to the
+        selector as index. If None, it isn't passed.
+        :param aggregate: instead of returning every trial, keep running statistics of the trials and return
+        their summary from summarize_trial_statistics. The comparison matrices are always generated for this.
+        :param seed: the seed for the random state of the trials. If None, a random seed is used.
         :return: a list of tuples. Each tuple contains a list of select parties and the comparison
         matrix.
         """
 
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
     with Pool(num_procs) as p:
         funcy = partial(run_trial,
                         valid_parties_embeddings=valid_parties_embeddings,
                         num_parties=num_parties,
                         eps=eps,
                         selector=selector,
-                        should_generate_matrix=should_generate_matrix,
-                        verbose=verbose)
-        trials = p.map(funcy, range(num_trials))
+                        should_generate_matrix=should_generate_matrix or aggregate,
+                        verbose=verbose,
+                        index=index,
+                        seed=seed)
+
+        # When recording, the workers record too and send their reports back with each trial
+        recording = is_recording()
+        if recording:
+            funcy = partial(run_recorded, funcy)
+
+        if not aggregate:
+            trials = p.map(funcy, range(num_trials))
+            if recording:
+                trials = [_merge_worker_report(trial) for trial in trials]
+            return trials
+
+        statistics = new_trial_statistics()
+        chunk_size = max(1, -(-num_trials // (num_procs * 4)))
+        for trial in p.imap_unordered(funcy, range(num_trials), chunksize=chunk_size):
+            selected_parties, comparison_matrix = _merge_worker_report(trial) if recording else trial
+            update_trial_statistics(statistics, comparison_matrix, selected_parties)
 
-    return trials
+    return summarize_trial_statistics(statistics)
 
 
 def run_trial(trial_num: int, valid_parties_embeddings: list, num_parties: int, eps: float, selector: Callable,
-              should_generate_matrix: bool = False, verbose: bool = False) -> tuple:
+              should_generate_matrix: bool = False, verbose: bool = False, index: dict = None,
+              seed: int = None) -> tuple:
     """ Select a collection of num_parties. This returns the selected party and the comparison matrix, if desired. If
     the comparison matrix is not created, None is returned for the matrix. selector is
     a method that selects a party. The signature must be:
@@ -53,13 +98,21 @@ def run_trial(trial_num: int, valid_parties_embeddings: list, num_parties: int,
     :param selector: the method for selecting a party
     :param should_generate_matrix: should the comparison matrix be calculated?
     :param verbose: print additional logging info
+    :param index: a ball tree over the embeddings, passed on to the selector as index. If None, it isn't passed.
+    :param seed: the seed of the run of trials. If given, numpy.random is seeded for this trial from seed and
+    trial_num, with the same seed sequence as trial_rng.
     :return: a list of the select parties and the comparison matrix
     """
 
     if verbose:
         print(f"trial {trial_num}")
+    if seed is not None:
+        np.random.seed(np.random.SeedSequence(entropy=seed, spawn_key=(trial_num, )).generate_state(4))
 
-    selected_parties = selector(valid_parties_embeddings, num_parties, eps)
+    if index is None:
+        selected_parties = selector(valid_parties_embeddings, num_parties, eps)
+    else:
+        selected_parties = selector(valid_parties_embeddings, num_parties, eps, index=index)
     if should_generate_matrix:
         comparison_matrix = generate_comparison_matrix(selected_parties)
     else:
@@ -68,18 +121,508 @@ def run_trial(trial_num: int, valid_parties_embeddings: list, num_parties: int,
     return [p[0] for p in selected_parties], comparison_matrix
 
 
-def generate_comparison_matrix(selected_parties: list) -> np.ndarray:
+@stage("run_trials_shared")
+def run_trials_shared(embedding_matrix: np.ndarray, party_names: list, num_parties: int, num_trials: int,
+                      eps: float, selector: Callable = select_party_indices_by_embeddings,
+                      should_generate_matrix: bool = False, num_procs: int = 1, seed: int = None,
+                      chunk_size: int = None, index: dict = None, batched: bool = False,
+                      aggregate: bool = False, output_filename: str = None, checkpoint_every: int = 1,
+                      resume: bool = True, metric: dict = None) -> list or dict:
+    """ Run trials like run_trials, but on the embedding matrix instead of the embedding list. The matrix is
+    shared with the worker processes once: through the file if it is memory-mapped (e.g. from
+    data.load_party_embedding_store), otherwise through shared memory. Workers are only sent ranges of trial ids,
+    chunk_size trials at a time.
+
+    Each trial gets its own random generator, seeded from seed and the trial id. So the results only depend on
+    seed, not on num_procs or chunk_size, and no two workers share a random state.
+
+    selector is a method that selects parties from the embedding matrix and returns their row indices. The
+    signature must be:
+        (embedding_matrix: np.ndarray, num_parties: int = 10, eps: float = 1.0, verbose: bool = False,
+         rng: np.random.Generator = None)
+    like select_parties.select_party_indices_by_embeddings and select_parties.select_party_indices_randomly.
+
+    :param embedding_matrix: the embedding of each valid party, one per row
+    :param party_names: the "job1,job2,job3,job4" name of each row of embedding_matrix
+    :param num_parties: the number of parties to select in each trial
+    :param num_trials: the number of groups of parties to create
+    :param eps: the value of eps to use for the definition of close in each trial
+    :param selector: the method for selecting parties
+    :param should_generate_matrix: should the comparison matrices be generated?
+    :param num_procs: the number of processes to use when creating trials
+    :param seed: the seed for the random generators of the trials. If None, a random seed is used, or with
+    output_filename, the seed of the checkpoint that is resumed.
+    :param chunk_size: the number of trials sent to a worker at once. If None, the trials are split into
+    about 4 chunks per process.
+    :param index: a ball tree over embedding_matrix, passed on to the selector as index. If None, it isn't passed.
+    :param batched: run the trials of each chunk together with select_parties.select_party_indices_batched instead
+    of one at a time with selector. The selected parties are the same as with select_party_indices_by_embeddings.
+    It can't be used with index.
+    :param aggregate: instead of returning every trial, keep running statistics of the trials and return their
+    summary from summarize_trial_statistics. Workers send back statistics per chunk, so memory doesn't grow with
+    num_trials.
+    :param output_filename: a csv file to append the trials to as they finish, instead of returning them. See
+    _run_trials_to_file for the format and the checkpoints written next to it.
+    :param checkpoint_every: with output_filename, write a checkpoint after this many chunks of trials
+    :param resume: with output_filename, continue from the checkpoint of an earlier run if there is one
+    :param metric: the metric that defines the distance between parties, see the distances module. It is passed on
+    to the selector as metric, prepared once per worker, and also used for the comparison matrices. If None, the
+    2-norm is used and metric isn't passed. It can't be used with batched.
+    :return: a list of tuples, in trial order. Each tuple contains a list of selected parties and the comparison
+    matrix. With output_filename, the final checkpoint is returned instead.
+    """
+
+    assert not batched or selector is select_party_indices_by_embeddings
+    assert not (aggregate and output_filename is not None)
+    assert not (batched and metric is not None)
+    assert not (batched and index is not None)
+
+    # With output_filename, the seed of a checkpoint that is resumed is used, so a random seed is picked later
+    if seed is None and output_filename is None:
+        seed = np.random.SeedSequence().entropy
+    if chunk_size is None:
+        chunk_size = max(1, -(-num_trials // (num_procs * 4)))
+    chunks = [(start, min(start + chunk_size, num_trials)) for start in range(0, num_trials, chunk_size)]
+    trial_settings = {"num_parties": num_parties, "eps": eps, "selector": selector,
+                      "should_generate_matrix": should_generate_matrix or aggregate, "seed": seed, "index": index,
+                      "batched": batched, "metric": metric}
+
+    if aggregate:
+        statistics = new_trial_statistics()
+        for chunk_statistics, chosen_party_indices in _imap_trial_chunks(_aggregate_trial_chunk, chunks,
+                                                                          embedding_matrix, trial_settings,
+                                                                          num_procs):
+            merge_trial_statistics(statistics, chunk_statistics)
+            update_job_counts(statistics, [party_names[i] for i in chosen_party_indices.ravel()])
+        return summarize_trial_statistics(statistics)
+
+    if output_filename is not None:
+        return _run_trials_to_file(output_filename, party_names, chunks, embedding_matrix, trial_settings,
+                                   num_procs, checkpoint_every, resume)
+
+    trials = sorted(trial for chunk_result in _imap_trial_chunks(_run_trial_chunk, chunks, embedding_matrix,
+                                                                 trial_settings, num_procs)
+                    for trial in chunk_result)
+    return [([party_names[i] for i in chosen_party_indices], comparison_matrix)
+            for _, chosen_party_indices, comparison_matrix in trials]
+
+
+def _run_trials_to_file(output_filename: str, party_names: list, chunks: list, embedding_matrix: np.ndarray,
+                        trial_settings: dict, num_procs: int, checkpoint_every: int, resume: bool) -> dict:
+    """ Run trials and append them to a csv file as each chunk finishes, so a crash only loses the trials since
+    the last checkpoint. Each row is one trial: the trial id followed by the jobs of every selected party. Rows are
+    in the order chunks finish, not in trial order.
+
+    The checkpoint is a json file next to the csv file (output_filename + ".checkpoint.json"). It holds the seed of
+    the run, which with a trial id determines the random generator of that trial (see trial_rng), the settings the
+    trials depend on (including the selector, the metric and a fingerprint of the embeddings), the completed
+    chunks, the number of completed trials, and the size of the csv file when it was written. It is only written
+    after the rows are flushed to disk, and it is replaced atomically. When resuming, the csv file is cut back to
+    that size, so rows of chunks that finished after the last checkpoint are not written twice. A run that doesn't
+    resume removes the checkpoint before writing any rows.
+
+    :param output_filename: the csv file to write the trials to
+    :param party_names: the "job1,job2,job3,job4" name of each row of embedding_matrix
+    :param chunks: the ranges of trial ids
+    :param embedding_matrix: the embedding of each valid party
+    :param trial_settings: the settings for each trial. If its seed is None, the seed of the checkpoint is used
+    when resuming, and a random seed otherwise.
+    :param num_procs: the number of processes to use
+    :param checkpoint_every: write a checkpoint after this many chunks
+    :param resume: continue from an existing checkpoint. It must have the same settings and seed (unless the seed
+    is None), and the csv file must still have all the rows it records.
+    :return: the final checkpoint
+    """
+
+    checkpoint_filename = output_filename + ".checkpoint.json"
+    seed = trial_settings["seed"]
+    checkpoint = {"seed": np.random.SeedSequence().entropy if seed is None else seed,
+                  "num_parties": trial_settings["num_parties"],
+                  "eps": trial_settings["eps"],
+                  "selector": f"{trial_settings['selector'].__module__}.{trial_settings['selector'].__qualname__}",
+                  "batched": trial_settings["batched"],
+                  "metric": describe_metric(trial_settings["metric"]),
+                  "embeddings": embedding_fingerprint(embedding_matrix),
+                  "chunks": chunks,
+                  "completed_chunks": [],
+                  "num_completed_trials": 0,
+                  "output_bytes": 0}
+
+    if resume and os.path.exists(checkpoint_filename):
+        with open(checkpoint_filename) as f:
+            saved_checkpoint = json.load(f)
+        for key in ["num_parties", "eps", "selector", "batched", "metric", "embeddings"]:
+            if saved_checkpoint.get(key) != checkpoint[key]:
+                raise ValueError(f"The {key} of the checkpoint {checkpoint_filename} isn't the same as this run's, "
+                                 f"so the trials can't be resumed. Pass resume=False to start again.")
+        if [tuple(chunk) for chunk in saved_checkpoint["chunks"]] != chunks:
+            raise ValueError("The number of trials and chunk_size must be the same as in the checkpoint.")
+        if seed is not None and saved_checkpoint["seed"] != seed:
+            raise ValueError(f"The seed {seed} isn't the seed {saved_checkpoint['seed']} of the checkpoint "
+                             f"{checkpoint_filename}. Pass the same seed (or None) to resume, or resume=False.")
+        if not os.path.exists(output_filename) or \
+                os.path.getsize(output_filename) < saved_checkpoint["output_bytes"]:
+            raise ValueError(f"{output_filename} is missing or shorter than in the checkpoint "
+                             f"{checkpoint_filename}, so the trials can't be resumed.")
+        checkpoint = saved_checkpoint
+    else:
+        # Remove the checkpoint of an earlier run first, so it can't be resumed with the rows of this one
+        for filename in [checkpoint_filename, output_filename]:
+            if os.path.exists(filename):
+                os.remove(filename)
+    trial_settings = dict(trial_settings, seed=checkpoint["seed"])
+
+    completed_chunks = set(checkpoint["completed_chunks"])
+    remaining_chunks = [chunk for chunk in chunks if chunk[0] not in completed_chunks]
+
+    with open(output_filename, "a+", newline="") as f:
+        f.truncate(checkpoint["output_bytes"])
+        f.seek(checkpoint["output_bytes"])
+        writer = csv.writer(f)
+
+        chunks_since_checkpoint = 0
+        for chunk_result in _imap_trial_chunks(_run_trial_chunk, remaining_chunks, embedding_matrix,
+                                               trial_settings, num_procs):
+            for trial_num, chosen_party_indices, _ in chunk_result:
+                writer.writerow([trial_num] + [job for i in chosen_party_indices for job in party_names[i].split(",")])
+            checkpoint["completed_chunks"].append(chunk_result[0][0])
+            checkpoint["num_completed_trials"] += len(chunk_result)
+
+            chunks_since_checkpoint += 1
+            if chunks_since_checkpoint >= checkpoint_every:
+                _write_trial_checkpoint(f, checkpoint_filename, checkpoint)
+                chunks_since_checkpoint = 0
+
+        _write_trial_checkpoint(f, checkpoint_filename, checkpoint)
+
+    return checkpoint
+
+
+def _write_trial_checkpoint(output_file, checkpoint_filename: str, checkpoint: dict):
+    """ Flush the trial output to disk and then atomically replace the checkpoint.
+    :param output_file: the open csv file of the trials
+    :param checkpoint_filename: the checkpoint file to write
+    :param checkpoint: the checkpoint to write. Its output size is updated first.
+    """
+
+    output_file.flush()
+    os.fsync(output_file.fileno())
+    checkpoint["output_bytes"] = output_file.tell()
+
+    temp_filename = checkpoint_filename + ".tmp"
+    with open(temp_filename, "w") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_filename, checkpoint_filename)
+
+
+def _imap_trial_chunks(function: Callable, chunks: list, embedding_matrix: np.ndarray, trial_settings: dict,
+                       num_procs: int):
+    """ Run function on each chunk of trial ids in trial workers, and yield the results as they finish. With one
+    process, the chunks are run in this process instead.
+    :param function: the function to run on each chunk, e.g. _run_trial_chunk
+    :param chunks: the ranges of trial ids
+    :param embedding_matrix: the embedding of each valid party
+    :param trial_settings: the settings for each trial
+    :param num_procs: the number of processes to use
+    :return: the result of function for each chunk, in the order they finish
+    """
+
+    num_trials = sum(end - start for start, end in chunks)
+    num_done = 0
+
+    if num_procs == 1:
+        _init_trial_worker(None, embedding_matrix, trial_settings)
+        try:
+            for chunk in chunks:
+                result = function(chunk)
+                num_done += chunk[1] - chunk[0]
+                count("trials", chunk[1] - chunk[0])
+                report_progress("run_trials_shared", num_done, num_trials)
+                yield result
+        finally:
+            _worker_state.clear()
+    else:
+        # When recording, the workers record too and send their reports back with each chunk
+        recording = is_recording()
+        if recording:
+            function = partial(run_recorded, function)
+
+        # The chunks finish in any order, so each result comes back with its chunk
+        function = partial(_run_identified_chunk, function)
+        with _share_embedding_matrix(embedding_matrix) as shared_matrix:
+            with Pool(num_procs, initializer=_init_trial_worker,
+                      initargs=(shared_matrix, None, trial_settings)) as p:
+                for chunk, result in p.imap_unordered(function, chunks, chunksize=1):
+                    if recording:
+                        result = _merge_worker_report(result)
+                    num_done += chunk[1] - chunk[0]
+                    count("trials", chunk[1] - chunk[0])
+                    report_progress("run_trials_shared", num_done, num_trials)
+                    yield result
+
+
+def _run_identified_chunk(function: Callable, chunk: tuple) -> (tuple, object):
+    """ Run function on a chunk of trial ids in a trial worker, and return the chunk with the result.
+    :param function: the function to run on the chunk
+    :param chunk: the range of trial ids
+    :return: the chunk and the result of function
+    """
+
+    return chunk, function(chunk)
+
+
+def _merge_worker_report(recorded_result: tuple) -> object:
+    """ Add the report of work done in a worker process with instrumentation.run_recorded to this process.
+    :param recorded_result: the result and the report from run_recorded
+    :return: the result
+    """
+
+    result, report = recorded_result
+    merge_report(report)
+    return result
+
+
+@contextmanager
+def _share_embedding_matrix(embedding_matrix: np.ndarray):
+    """ Describe how worker processes can reach the embedding matrix without pickling it. A memory-mapped matrix
+    (or a contiguous view of one) is reopened from its file. Any other matrix is copied into shared memory once,
+    which is released on exit.
+    :param embedding_matrix: the embedding matrix to share
+    :return: a description of the shared matrix for _init_trial_worker
+    """
+
+    description = {"shape": embedding_matrix.shape, "dtype": embedding_matrix.dtype.str}
+
+    # A view of a memory-mapped matrix keeps the offset of the whole mapping, so find where its data starts in the
+    # file from its distance to the start of the mapped matrix. A memmap that isn't backed by a file (e.g. from
+    # astype) has no filename and is copied like any other matrix.
+    mapped_matrix = embedding_matrix if isinstance(embedding_matrix.base, mmap.mmap) else embedding_matrix.base
+    if isinstance(embedding_matrix, np.memmap) and embedding_matrix.flags["C_CONTIGUOUS"] and \
+            isinstance(mapped_matrix, np.memmap) and isinstance(mapped_matrix.base, mmap.mmap) and \
+            mapped_matrix.filename is not None:
+        description["filename"] = mapped_matrix.filename
+        description["offset"] = mapped_matrix.offset + embedding_matrix.ctypes.data - mapped_matrix.ctypes.data
+        yield description
+        return
+
+    shared_memory = SharedMemory(create=True, size=max(embedding_matrix.nbytes, 1))
+    try:
+        np.ndarray(embedding_matrix.shape, dtype=embedding_matrix.dtype, buffer=shared_memory.buf)[:] = \
+            embedding_matrix
+        description["shared_memory"] = shared_memory.name
+        yield description
+    finally:
+        shared_memory.close()
+        shared_memory.unlink()
+
+
+def _init_trial_worker(shared_matrix: dict or None, embedding_matrix: np.ndarray or None, trial_settings: dict):
+    """ Set up the state of a trial worker. Either shared_matrix (from _share_embedding_matrix) or embedding_matrix
+    must be given.
+    :param shared_matrix: the description of the shared embedding matrix from _share_embedding_matrix
+    :param embedding_matrix: the embedding matrix itself, when running in the same process
+    :param trial_settings: the settings for each trial
+    """
+
+    _worker_state.clear()
+    _worker_state.update(trial_settings)
+
+    if embedding_matrix is None:
+        if "filename" in shared_matrix:
+            embedding_matrix = np.memmap(shared_matrix["filename"], dtype=shared_matrix["dtype"], mode="r",
+                                         offset=shared_matrix["offset"], shape=shared_matrix["shape"])
+        else:
+            shared_memory = SharedMemory(name=shared_matrix["shared_memory"])
+            embedding_matrix = np.ndarray(shared_matrix["shape"], dtype=shared_matrix["dtype"],
+                                          buffer=shared_memory.buf)
+            _worker_state["shared_memory"] = shared_memory  # Keep the shared memory open
+    _worker_state["embedding_matrix"] = embedding_matrix
+    if trial_settings["metric"] is not None:
+        _worker_state["selector_metric"] = prepare_metric(trial_settings["metric"], embedding_matrix)
+
+
+def _run_trial_chunk(chunk: tuple) -> list:
+    """ Run the trials with ids from chunk[0] up to (not including) chunk[1] in a trial worker.
+    :param chunk: the range of trial ids
+    :return: a list with the trial id, the row indices of the selected parties and the comparison matrix
+    (or None) of each trial
+    """
+
+    embedding_matrix = _worker_state["embedding_matrix"]
+    selector_kwargs = {} if _worker_state["index"] is None else {"index": _worker_state["index"]}
+    if _worker_state["metric"] is not None:
+        selector_kwargs["metric"] = _worker_state["selector_metric"]
+
+    if _worker_state["batched"]:
+        batch_party_indices = select_party_indices_batched(
+            embedding_matrix, _worker_state["num_parties"], _worker_state["eps"], num_trials=chunk[1] - chunk[0],
+            rngs=[trial_rng(_worker_state["seed"], trial_num) for trial_num in range(*chunk)])
+
+    results = []
+    for trial_num in range(*chunk):
+        if _worker_state["batched"]:
+            chosen_party_indices = batch_party_indices[trial_num - chunk[0]]
+        else:
+            rng = trial_rng(_worker_state["seed"], trial_num)
+            chosen_party_indices = _worker_state["selector"](embedding_matrix, _worker_state["num_parties"],
+                                                             _worker_state["eps"], rng=rng, **selector_kwargs)
+        if _worker_state["should_generate_matrix"]:
+            comparison_matrix = generate_comparison_matrix(
+                [(i, embedding_matrix[i]) for i in chosen_party_indices], _worker_state["metric"])
+        else:
+            comparison_matrix = None
+        results.append((trial_num, np.asarray(chosen_party_indices), comparison_matrix))
+
+    return results
+
+
+def _aggregate_trial_chunk(chunk: tuple) -> (dict, np.ndarray):
+    """ Run a chunk of trials in a trial worker and only keep their statistics.
+    :param chunk: the range of trial ids
+    :return: the statistics of the trials (without job counts, since the worker doesn't know the party names)
+    and the row indices of the selected parties of each trial
+    """
+
+    statistics = new_trial_statistics()
+    chosen = []
+    for _, chosen_party_indices, comparison_matrix in _run_trial_chunk(chunk):
+        update_trial_statistics(statistics, comparison_matrix)
+        chosen.append(chosen_party_indices)
+    return statistics, np.array(chosen)
+
+
+def trial_rng(seed: int, trial_num: int) -> np.random.Generator:
+    """ Get the random generator of a trial. Every trial has an independent stream, determined by the seed of
+    the run and the trial id.
+    :param seed: the seed of the run of trials
+    :param trial_num: the id of the trial
+    :return: the random generator for the trial
+    """
+
+    return np.random.default_rng(np.random.SeedSequence(entropy=seed, spawn_key=(trial_num, )))
+
+
+def generate_comparison_matrix(selected_parties: list, metric: dict = None) -> np.ndarray:
     """ Generates a matrix that shows the distance of each party in selected_parties from each
     other, in terms of the 2-norm of their embeddings. This is helpful for analyses.
     :param selected_parties: embedding list of the form [("job1,job2,job3,job4", embedding), (), ...]
+    :param metric: the metric to use instead of the 2-norm, see the distances module. If None, the 2-norm is used.
     :return: the matrix of distances of each job to each other job
     """
 
-    comparison_matrix = np.zeros((len(selected_parties), len(selected_parties)), dtype=float)
-    
-    for row_idx, row_tuple in enumerate(selected_parties):
-        for col_idx, col_tuple in enumerate(selected_parties):
-            _, embedding_row = row_tuple
-            _, embedding_col = col_tuple
-            comparison_matrix[row_idx][col_idx] = norm(embedding_row - embedding_col, ord=2)
+    embeddings = np.array([embedding for _, embedding in selected_parties], dtype=float)
+    comparison_matrix = pairwise_distances(embeddings, metric)
     return comparison_matrix
+
+
+def new_trial_statistics(histogram_edges: np.ndarray = None) -> dict:
+    """ Create empty running statistics of trials, to be filled by update_trial_statistics. The statistics keep
+    the same amount of memory no matter how many trials are added:
+        the count, mean and sum of squared deviations of the distances between the parties of each trial,
+        a histogram of the smallest distance between two parties in each trial, and
+        the number of times each job was selected.
+    :param histogram_edges: the bin edges of the smallest distance histogram. Distances past the last edge are
+    counted in the last bin. If None, 100 bins from 0 to 10 are used.
+    :return: the empty statistics
+    """
+
+    if histogram_edges is None:
+        histogram_edges = np.linspace(0.0, 10.0, 101)
+
+    return {"num_trials": 0,
+            "num_distances": 0,
+            "distance_mean": 0.0,
+            "distance_m2": 0.0,
+            "histogram_edges": np.asarray(histogram_edges, dtype=float),
+            "min_distance_histogram": np.zeros((len(histogram_edges) - 1, ), dtype=np.int64),
+            "job_counts": {}}
+
+
+def update_trial_statistics(statistics: dict, comparison_matrix: np.ndarray, selected_parties: list = None):
+    """ Add one trial to running statistics from new_trial_statistics.
+    :param statistics: the statistics to update in place
+    :param comparison_matrix: the comparison matrix of the trial, from generate_comparison_matrix
+    :param selected_parties: the "job1,job2,job3,job4" names of the selected parties. If None, the job counts
+    are not updated.
+    """
+
+    distances = comparison_matrix[np.triu_indices(len(comparison_matrix), k=1)]
+    statistics["num_trials"] += 1
+    if len(distances) > 0:
+        trial_statistics = {"num_distances": len(distances),
+                            "distance_mean": distances.mean(),
+                            "distance_m2": ((distances - distances.mean())**2).sum()}
+        _merge_distance_moments(statistics, trial_statistics)
+
+        edges = statistics["histogram_edges"]
+        bin_idx = np.clip(np.searchsorted(edges, distances.min(), side="right") - 1, 0, len(edges) - 2)
+        statistics["min_distance_histogram"][bin_idx] += 1
+
+    if selected_parties is not None:
+        update_job_counts(statistics, selected_parties)
+
+
+def update_job_counts(statistics: dict, selected_parties: list):
+    """ Count the jobs of selected parties in running statistics from new_trial_statistics.
+    :param statistics: the statistics to update in place
+    :param selected_parties: the "job1,job2,job3,job4" names of the selected parties
+    """
+
+    job_counts = statistics["job_counts"]
+    for party in selected_parties:
+        for job in party.split(","):
+            job_counts[job] = job_counts.get(job, 0) + 1
+
+
+def merge_trial_statistics(statistics: dict, other: dict):
+    """ Add the trials in other to statistics. Both must come from new_trial_statistics with the same
+    histogram edges.
+    :param statistics: the statistics to update in place
+    :param other: the statistics to add
+    """
+
+    assert np.array_equal(statistics["histogram_edges"], other["histogram_edges"])
+
+    statistics["num_trials"] += other["num_trials"]
+    _merge_distance_moments(statistics, other)
+    statistics["min_distance_histogram"] += other["min_distance_histogram"]
+    for job, count in other["job_counts"].items():
+        statistics["job_counts"][job] = statistics["job_counts"].get(job, 0) + count
+
+
+def _merge_distance_moments(statistics: dict, other: dict):
+    """ Combine the count, mean and sum of squared deviations of the distances in other into statistics,
+    with the parallel variance formula of Chan et al.
+    :param statistics: the statistics to update in place
+    :param other: the statistics to add
+    """
+
+    count = statistics["num_distances"] + other["num_distances"]
+    if count == 0:
+        return
+    delta = other["distance_mean"] - statistics["distance_mean"]
+    statistics["distance_mean"] += delta * other["num_distances"] / count
+    statistics["distance_m2"] += other["distance_m2"] + \
+        delta**2 * statistics["num_distances"] * other["num_distances"] / count
+    statistics["num_distances"] = count
+
+
+def summarize_trial_statistics(statistics: dict) -> dict:
+    """ Summarize running statistics from new_trial_statistics.
+    :param statistics: the statistics of the trials
+    :return: a dict with the number of trials, the mean and variance of the distances between parties in a trial,
+    the smallest distance histogram and its bin edges, and the count and frequency of each job. The frequency of
+    a job is its share of all selected jobs.
+    """
+
+    num_distances = statistics["num_distances"]
+    total_jobs = sum(statistics["job_counts"].values())
+    return {"num_trials": statistics["num_trials"],
+            "distance_mean": statistics["distance_mean"] if num_distances > 0 else float("nan"),
+            "distance_variance": statistics["distance_m2"] / num_distances if num_distances > 0 else float("nan"),
+            "min_distance_histogram": statistics["min_distance_histogram"].copy(),
+            "histogram_edges": statistics["histogram_edges"].copy(),
+            "job_counts": dict(sorted(statistics["job_counts"].items())),
+            "job_frequency": {job: count / total_jobs for job, count in sorted(statistics["job_counts"].items())}}
@@ -1,6 +1,10 @@
+import numpy as np
 import pandas as pd
+from numpy.linalg import norm
 from numpy.random import randint
 
+from embeddings import calculate_party_embedding_matrix
+
 
 def generate_gauntlet_runs(run_style: str, df_jobs: pd.DataFrame) -> list:
     """ Generate a gauntlet run of 5 parties. This generates a group of parties in such a way as to select jobs
@@ -63,3 +67,92 @@ def generate_gauntlet_runs(run_style: str, df_jobs: pd.DataFrame) -> list:
         raise ValueError(f"Bad game style {run_style}.")
 
     return selected_parties
+
+
+def generate_gauntlet_run_indices(run_style: str, df_jobs: pd.DataFrame, num_gauntlets: int = 1,
+                                  rng: np.random.Generator = None) -> np.ndarray:
+    """ Generate many gauntlet runs at once, following the same rules as generate_gauntlet_runs. Instead of job
+    names, the jobs are given as their index in df_jobs.index (see generate_possible_parties.party_indices_to_names
+    to turn a party back into names).
+
+    The job pools for each crystal are found once. Then drawing jobs without replacement is done with one random
+    permutation of each pool per gauntlet, made by sorting random keys.
+
+    :param run_style: the style of the run, currently only "Regular" and "Meteor"
+    :param df_jobs: the DataFrame of jobs. Only the index and the Crystal column are used.
+    :param num_gauntlets: the number of gauntlet runs to generate
+    :param rng: the random generator to use. If None, a new unseeded generator is used.
+    :return: an array of shape (num_gauntlets, 5 parties, 4 jobs) of job indices
+    """
+
+    num_parties = 5
+    num_jobs_in_party = 4  # 4 characters => 4 jobs
+    crystal_order = ["Wind", "Water", "Fire", "Earth"]
+    wind_crystal_idx = crystal_order.index("Wind")
+    earth_crystal_idx = crystal_order.index("Earth")
+    if rng is None:
+        rng = np.random.default_rng()
+
+    if run_style == "Regular":
+
+        # Set the available jobs to choose at each crystal, moving one job from Wind to Earth
+        jobs_by_crystal = [np.flatnonzero(df_jobs["Crystal"] == crystal) for crystal in crystal_order]
+        wind_jobs = _permute_rows(np.tile(jobs_by_crystal[wind_crystal_idx], (num_gauntlets, 1)), rng)
+        wind_to_earth_jobs = wind_jobs[:, :1]
+
+        pools = [np.tile(jobs, (num_gauntlets, 1)) for jobs in jobs_by_crystal]
+        pools[wind_crystal_idx] = wind_jobs[:, 1:]
+        pools[earth_crystal_idx] = np.concatenate([pools[earth_crystal_idx], wind_to_earth_jobs], axis=1)
+
+        # Assign jobs from each crystal to each party
+        draws = []
+        for i in range(num_jobs_in_party):
+            if pools[i].shape[1] < num_parties:
+                raise ValueError(f"Not enough jobs for crystal {crystal_order[i]}.")
+            draws.append(_permute_rows(pools[i], rng)[:, :num_parties])
+        gauntlet_indices = np.stack(draws, axis=2)
+
+    elif run_style == "Meteor":
+
+        # Draw from the jobs without Mime and Freelancer, then from all jobs whenever they run out
+        num_draws = num_parties * num_jobs_in_party
+        pool = np.flatnonzero(df_jobs["Crystal"] != "Misc")
+        draws = []
+        while sum(d.shape[1] for d in draws) < num_draws:
+            draws.append(_permute_rows(np.tile(pool, (num_gauntlets, 1)), rng))
+            pool = np.arange(len(df_jobs))
+        gauntlet_indices = np.concatenate(draws, axis=1)[:, :num_draws].reshape(
+            num_gauntlets, num_parties, num_jobs_in_party)
+
+    else:
+        raise ValueError(f"Bad game style {run_style}.")
+
+    return gauntlet_indices.astype(np.min_scalar_type(max(len(df_jobs) - 1, 0)))
+
+
+def calculate_gauntlet_comparison_matrices(gauntlet_indices: np.ndarray, df_jobs: pd.DataFrame,
+                                           special_weight_jobs: list = None, equip_factor: float = 1.0) -> np.ndarray:
+    """ Calculate the comparison matrix (see experiment.generate_comparison_matrix) of many gauntlet runs at once.
+    The embeddings of all parties are calculated together, and then the distances within each gauntlet.
+    :param gauntlet_indices: the gauntlet runs from generate_gauntlet_run_indices
+    :param df_jobs: the DataFrame with data on each job
+    :param special_weight_jobs: jobs to give the special weight in the jobs embedding
+    :param equip_factor: the scaling factor for the equipment embeddings
+    :return: an array of shape (number of gauntlets, 5, 5) with the distances between the parties of each gauntlet
+    """
+
+    num_gauntlets, num_parties, num_jobs_in_party = gauntlet_indices.shape
+    embeddings = calculate_party_embedding_matrix(gauntlet_indices.reshape(-1, num_jobs_in_party), df_jobs,
+                                                  special_weight_jobs, equip_factor)
+    embeddings = embeddings.reshape(num_gauntlets, num_parties, -1)
+    return norm(embeddings[:, :, None, :] - embeddings[:, None, :, :], ord=2, axis=3)
+
+
+def _permute_rows(pools: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """ Shuffle each row of pools independently.
+    :param pools: the array to shuffle, one pool per row
+    :param rng: the random generator to use
+    :return: the shuffled pools
+    """
+
+    return np.take_along_axis(pools, np.argsort(rng.random(pools.shape), axis=1), axis=1)
@@ -1,6 +1,10 @@
+import numpy as np
 import pandas as pd
 
+from instrumentation import stage
 
+
+@stage("generate_possible_parties")
 def generate_possible_parties(run: str, df_jobs: pd.DataFrame, duplicates: bool = False) -> list:
     """ Generate the list of all possible parties given a particular Four Job Fiesta style. These
     are consistent with the definitions on the event pages as of 19.09.23. See:
@@ -66,3 +70,77 @@ def generate_possible_parties(run: str, df_jobs: pd.DataFrame, duplicates: bool
         valid_parties = valid_parties_no_duplicates
 
     return valid_parties
+
+
+@stage("generate_possible_party_indices")
+def generate_possible_party_indices(run: str, df_jobs: pd.DataFrame, duplicates: bool = False) -> np.ndarray:
+    """ Generate all possible parties like generate_possible_parties, but as an array of job indices instead
+    of a list of job names. Row i is the party at position i of generate_possible_parties, with each job given
+    as its position in df_jobs.index. Use party_indices_to_names to get the names back when they are needed.
+
+    :param run: the Four Job Fiesta run style ("Regular", "Typhoon", "Volcano", or "Meteor").
+    :param df_jobs: the DataFrame of jobs data
+    :param duplicates: flag to allow duplicates. Doesn't do anything for Regular runs.
+    :return: an array of shape (number of parties, 4), uint8 for up to 256 jobs
+    """
+
+    jobs_per_position = get_jobs_per_position(run, df_jobs)
+
+    # Cartesian product in the same order as the nested loops, with the first job changing slowest
+    dtype = np.min_scalar_type(max(len(df_jobs) - 1, 0))
+    grids = np.meshgrid(*[jobs.astype(dtype) for jobs in jobs_per_position], indexing="ij")
+    party_indices = np.stack([grid.ravel() for grid in grids], axis=1)
+
+    if not duplicates and not run == "Regular":
+        has_no_duplicates = np.ones((len(party_indices), ), dtype=bool)
+        for i in range(party_indices.shape[1]):
+            for j in range(i+1, party_indices.shape[1]):
+                has_no_duplicates &= party_indices[:, i] != party_indices[:, j]
+        party_indices = party_indices[has_no_duplicates]
+
+    return party_indices
+
+
+def get_jobs_per_position(run: str, df_jobs: pd.DataFrame) -> list:
+    """ Get the jobs that can be in each position of a party for a Four Job Fiesta style, in the order
+    generate_possible_parties goes through them.
+    :param run: the Four Job Fiesta run style ("Regular", "Typhoon", "Volcano", or "Meteor").
+    :param df_jobs: the DataFrame of jobs data
+    :return: a list with an array of job indices (positions in df_jobs.index) for each of the 4 positions
+    """
+
+    crystal_order = ["Wind", "Water", "Fire", "Earth"]
+    jobs_by_crystal = {crystal: np.flatnonzero(df_jobs["Crystal"] == crystal) for crystal in crystal_order}
+
+    if run == "Regular":
+        jobs_per_position = [jobs_by_crystal[crystal] for crystal in crystal_order]
+    elif run == "Typhoon":
+        jobs_per_position = []
+        previous_crystal_jobs = np.array([], dtype=int)
+        for crystal in crystal_order:
+            previous_crystal_jobs = np.concatenate([jobs_by_crystal[crystal], previous_crystal_jobs])
+            jobs_per_position.append(previous_crystal_jobs)
+    elif run == "Volcano":
+        jobs_per_position = []
+        previous_crystal_jobs = np.array([], dtype=int)
+        for crystal in reversed(crystal_order):
+            previous_crystal_jobs = np.concatenate([jobs_by_crystal[crystal], previous_crystal_jobs])
+            jobs_per_position.append(previous_crystal_jobs)
+    elif run == "Meteor":
+        jobs_per_position = [np.arange(len(df_jobs))] * 4
+    else:
+        raise ValueError(f"Bad game style {run}.")
+
+    return jobs_per_position
+
+
+def party_indices_to_names(party_indices: np.ndarray, df_jobs: pd.DataFrame) -> list:
+    """ Turn parties given as job indices (see generate_possible_party_indices) into the "job1,job2,job3,job4"
+    names used in the embedding lists.
+    :param party_indices: an array of shape (number of parties, 4) of indices into df_jobs.index
+    :param df_jobs: the DataFrame of jobs data
+    :return: the list of party names
+    """
+
+    job_names = df_jobs.index.to_numpy()
+    return [",".join(party) for party in job_names[np.asarray(party_indices, dtype=np.intp)]]
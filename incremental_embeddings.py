@@ -0,0 +1,215 @@
+import os
+import shutil
+import uuid
+import numpy as np
+import pandas as pd
+
+from data import load_party_embedding_store, save_party_embedding_store
+from embeddings import calculate_party_embedding_matrix, get_embedding_block_columns, get_job_lookup_arrays
+from generate_possible_parties import generate_possible_party_indices
+
+
+def build_job_party_index(party_indices: np.ndarray, num_jobs: int) -> dict:
+    """ Build an inverted index from each job to the rows of party_indices (and so of its embedding matrix) whose
+    party has the job. The index is stored like a sparse CSR matrix: the rows of job j are
+    rows[offsets[j]:offsets[j+1]], in increasing order. A party with the same job twice is listed once.
+    :param party_indices: the job indices of the party in each row, e.g. from generate_possible_party_indices
+    :param num_jobs: the number of jobs the indices refer to, usually len(df_jobs)
+    :return: the index as a dict with the "offsets" and "rows" arrays
+    """
+
+    party_indices = np.asarray(party_indices)
+    num_rows, party_size = party_indices.shape
+
+    # Leave out a job that is already at an earlier position of the same party
+    is_first = np.ones(party_indices.shape, dtype=bool)
+    for position in range(1, party_size):
+        is_first[:, position] = (party_indices[:, :position] != party_indices[:, position:position+1]).all(axis=1)
+
+    # The pairs are in row order, so a stable sort by job keeps the rows of each job in order
+    jobs = party_indices[is_first]
+    rows = np.repeat(np.arange(num_rows), is_first.sum(axis=1))[np.argsort(jobs, kind="stable")]
+    offsets = np.zeros((num_jobs + 1, ), dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(jobs, minlength=num_jobs))
+
+    return {"offsets": offsets, "rows": rows.astype(np.min_scalar_type(max(num_rows - 1, 0)))}
+
+
+def job_party_rows(index: dict, jobs: list) -> np.ndarray:
+    """ Get the rows whose party has any of jobs, from the index of build_job_party_index.
+    :param index: the job to party index
+    :param jobs: the job indices to look up
+    :return: the rows, in increasing order
+    """
+
+    rows = np.sort(np.concatenate([index["rows"][index["offsets"][job]:index["offsets"][job+1]] for job in jobs] +
+                                  [np.zeros((0, ), dtype=index["rows"].dtype)]))
+    return rows[np.concatenate([[True], rows[1:] != rows[:-1]])] if len(rows) > 0 else rows
+
+
+def diff_job_tables(df_old: pd.DataFrame, df_new: pd.DataFrame) -> dict:
+    """ Compare two versions of the job data from data.load_data, keeping only the differences that change the
+    party embeddings: the jobs' crystals, styles and equipment, and the Freelancer's equipment (which every crystal
+    without an available job falls back on). Stats aren't part of the embeddings, so changing them changes nothing.
+    :param df_old: the old DataFrame of jobs data
+    :param df_new: the new DataFrame of jobs data
+    :return: a dict with the names of the "added_jobs", "removed_jobs" and "changed_jobs" (whose embedding values
+    changed), the "crystal_changed_jobs" among them (which changes which parties are possible), and whether the
+    "freelancer_changed" or the "equip_columns_changed"
+    """
+
+    old_lookup = get_job_lookup_arrays(df_old)
+    new_lookup = get_job_lookup_arrays(df_new)
+    common_jobs = [job for job in df_old.index if job in df_new.index]
+    old_rows = df_old.index.get_indexer(common_jobs)
+    new_rows = df_new.index.get_indexer(common_jobs)
+
+    equip_columns_changed = list(df_old.columns[6:]) != list(df_new.columns[6:])
+    is_crystal_changed = old_lookup["crystal_idx"][old_rows] != new_lookup["crystal_idx"][new_rows]
+    is_changed = is_crystal_changed | \
+        (old_lookup["style_onehot"][old_rows] != new_lookup["style_onehot"][new_rows]).any(axis=1)
+    if equip_columns_changed:
+        is_changed[:] = True
+    else:
+        is_changed |= (old_lookup["equip_bits"][old_rows] != new_lookup["equip_bits"][new_rows]).any(axis=1)
+
+    old_freelancer, new_freelancer = old_lookup["freelancer_equip"], new_lookup["freelancer_equip"]
+    freelancer_changed = (old_freelancer is None) != (new_freelancer is None) or \
+        (old_freelancer is not None and not np.array_equal(old_freelancer, new_freelancer))
+
+    return {"added_jobs": [job for job in df_new.index if job not in df_old.index],
+            "removed_jobs": [job for job in df_old.index if job not in df_new.index],
+            "changed_jobs": [job for job, changed in zip(common_jobs, is_changed) if changed],
+            "crystal_changed_jobs": [job for job, changed in zip(common_jobs, is_crystal_changed) if changed],
+            "freelancer_changed": bool(freelancer_changed),
+            "equip_columns_changed": equip_columns_changed}
+
+
+def update_party_embedding_store(filename: str, df_old: pd.DataFrame, df_new: pd.DataFrame) -> dict:
+    """ Bring an embedding store (see data.save_party_embedding_store) made from df_old up to date with df_new,
+    recalculating only the rows whose embedding changed. The result is the same store that calculating every
+    embedding again from df_new would give.
+
+    The rows to recalculate are found with diff_job_tables and the job to party index of build_job_party_index: the
+    parties with a changed job, and if the Freelancer's equipment changed, the parties with a crystal that falls back
+    on it.
+
+    If the same parties are still possible (no job was added or removed, and no crystal changed), the changed rows
+    are written into the store in place. Otherwise the parties of df_new are generated (which is fast), the rows of
+    parties that were already in the store are copied over, with the jobs columns moved to the new job order, and
+    only the new and changed parties are calculated. The new store is written next to the old one and then moved in
+    its place.
+
+    :param filename: the filename of the embedding store
+    :param df_old: the DataFrame of jobs data the store was made from
+    :param df_new: the new DataFrame of jobs data
+    :return: a dict with the "num_parties" in the updated store, the number of rows that were "recalculated" and
+    "copied", the number of parties "removed" and "added", whether the store was updated "in_place", and the
+    "diff" from diff_job_tables
+    """
+
+    old_matrix, old_party_indices, header = load_party_embedding_store(filename)
+    if header["jobs"] != list(df_old.index):
+        raise ValueError(f"The embedding store {filename} wasn't made from df_old")
+
+    diff = diff_job_tables(df_old, df_new)
+    run_style, duplicates = header["run_style"], header["duplicates"]
+    special_weight_jobs, equip_factor = header["special_weight_jobs"], header["equip_factor"]
+
+    # The old rows whose embedding changed
+    job_index = build_job_party_index(old_party_indices, len(df_old))
+    is_stale = np.zeros((len(old_party_indices), ), dtype=bool)
+    is_stale[job_party_rows(job_index, df_old.index.get_indexer(diff["changed_jobs"]))] = True
+    if diff["freelancer_changed"]:
+        is_stale |= _uses_freelancer_fallback(old_party_indices, get_job_lookup_arrays(df_old)["crystal_idx"])
+
+    if list(df_old.index) == list(df_new.index) and len(diff["crystal_changed_jobs"]) == 0 and \
+            not diff["equip_columns_changed"]:
+        stale_rows = np.flatnonzero(is_stale)
+        if len(stale_rows) > 0:
+            matrix = np.load(filename if filename.endswith(".npy") else filename + ".npy", mmap_mode="r+")
+            matrix[stale_rows] = calculate_party_embedding_matrix(old_party_indices[stale_rows], df_new,
+                                                                  special_weight_jobs, equip_factor)
+            matrix.flush()
+            del matrix
+        return {"num_parties": len(old_party_indices), "recalculated": len(stale_rows),
+                "copied": len(old_party_indices) - len(stale_rows), "removed": 0, "added": 0, "in_place": True,
+                "diff": diff}
+
+    # Find each new party in the old store, by its jobs in the new job order
+    new_party_indices = generate_possible_party_indices(run_style, df_new, duplicates)
+    old_to_new_job = df_new.index.get_indexer(df_old.index)
+    old_in_new_jobs = old_to_new_job[old_party_indices]
+    is_kept = (old_in_new_jobs >= 0).all(axis=1)
+    old_keys = _party_keys(old_in_new_jobs[is_kept], len(df_new))
+    key_order = np.argsort(old_keys)
+    sorted_keys, sorted_rows = old_keys[key_order], np.flatnonzero(is_kept)[key_order]
+    new_keys = _party_keys(new_party_indices, len(df_new))
+    positions = np.searchsorted(sorted_keys, new_keys)
+    is_found = positions < len(sorted_keys)
+    is_found[is_found] = sorted_keys[positions[is_found]] == new_keys[is_found]
+    old_rows = np.full((len(new_keys), ), -1, dtype=np.int64)
+    old_rows[is_found] = sorted_rows[positions[is_found]]
+
+    is_copied = is_found.copy()
+    is_copied[is_found] = ~is_stale[old_rows[is_found]]
+    copied_rows = np.flatnonzero(is_copied)
+    recalculated_rows = np.flatnonzero(~is_copied)
+
+    num_columns = sum(len(columns) for columns in get_embedding_block_columns(df_new).values())
+    new_matrix = np.empty((len(new_party_indices), num_columns), dtype=old_matrix.dtype)
+    if len(recalculated_rows) > 0:
+        new_matrix[recalculated_rows] = calculate_party_embedding_matrix(new_party_indices[recalculated_rows],
+                                                                         df_new, special_weight_jobs, equip_factor)
+
+    # Copy the crystal columns as they are, and the jobs columns to their new place. The copied parties don't have
+    # any added job, so its column is 0.
+    jobs_start = old_matrix.shape[1] - len(df_old)
+    common_old_jobs = np.flatnonzero(old_to_new_job >= 0)
+    new_matrix[copied_rows, :jobs_start] = old_matrix[old_rows[copied_rows], :jobs_start]
+    new_matrix[copied_rows, jobs_start:] = 0.0
+    new_matrix[np.ix_(copied_rows, jobs_start + old_to_new_job[common_old_jobs])] = \
+        old_matrix[np.ix_(old_rows[copied_rows], jobs_start + common_old_jobs)]
+
+    directory, basename = os.path.split(os.path.abspath(filename))
+    temp_dir = os.path.join(directory, f".{basename}.{uuid.uuid4().hex}.tmp")
+    os.makedirs(temp_dir)
+    try:
+        save_party_embedding_store(os.path.join(temp_dir, basename), new_matrix, new_party_indices,
+                                   list(df_new.index), run_style, duplicates, equip_factor, special_weight_jobs)
+        for store_filename in os.listdir(temp_dir):
+            os.replace(os.path.join(temp_dir, store_filename), os.path.join(directory, store_filename))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return {"num_parties": len(new_party_indices), "recalculated": len(recalculated_rows),
+            "copied": len(copied_rows), "removed": int(len(old_party_indices) - is_found.sum()),
+            "added": int((~is_found).sum()), "in_place": False, "diff": diff}
+
+
+def _uses_freelancer_fallback(party_indices: np.ndarray, crystal_idx: np.ndarray) -> np.ndarray:
+    """ Find the parties with a crystal where none of their jobs is available yet, so the embedding of that crystal
+    uses the Freelancer's equipment (see embeddings.calculate_style_equip_embedding).
+    :param party_indices: the job indices of each party
+    :param crystal_idx: the crystal index of each job, from embeddings.get_job_lookup_arrays
+    :return: whether each party falls back on the Freelancer
+    """
+
+    party_crystals = crystal_idx[np.asarray(party_indices, dtype=np.intp)]
+    uses_fallback = np.zeros((len(party_crystals), ), dtype=bool)
+    for curr_crystal in range(party_crystals.shape[1]):
+        uses_fallback |= (party_crystals[:, :curr_crystal+1] > curr_crystal).all(axis=1)
+    return uses_fallback
+
+
+def _party_keys(party_indices: np.ndarray, num_jobs: int) -> np.ndarray:
+    """ Turn each party into one integer, reading its job indices as the digits of a number in base num_jobs.
+    :param party_indices: the job indices of each party
+    :param num_jobs: the number of jobs
+    :return: the key of each party
+    """
+
+    keys = np.zeros((len(party_indices), ), dtype=np.int64)
+    for position in range(party_indices.shape[1]):
+        keys = keys * num_jobs + party_indices[:, position]
+    return keys
@@ -0,0 +1,204 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import json
+from time import perf_counter
+from typing import Callable
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# The recorder of the current process, or None when nothing is being recorded
+_recorder = None
+
+
+def start_recording(progress: Callable = None):
+    """ Start recording stage timers, counters and progress in this process. Until then, all instrumentation calls
+    return immediately. The pipeline records:
+        stages: time spent in e.g. "calculate_party_embedding_matrix", "distance_scan" or "run_trials"
+        counters: e.g. "parties_scanned", "distance_evaluations", "eps_decay_rounds" and "trials"
+        distributions: e.g. "eps_decay_rounds_per_trial", how many trials needed each number of eps decays
+    :param progress: a function called as progress(stage, done, total) as long running stages advance, e.g.
+    print_progress. If None, progress is not reported.
+    """
+
+    global _recorder
+    _recorder = {"start": perf_counter(),
+                 "progress": progress,
+                 "stages": defaultdict(lambda: {"seconds": 0.0, "calls": 0}),
+                 "counters": defaultdict(int),
+                 "distributions": defaultdict(lambda: defaultdict(int))}
+
+
+def stop_recording() -> dict:
+    """ Stop recording and get the report of everything recorded since start_recording.
+    :return: the report, see get_report
+    """
+
+    global _recorder
+    report = get_report()
+    _recorder = None
+    return report
+
+
+@contextmanager
+def recording(progress: Callable = None):
+    """ Record everything inside a with block. The yielded dict is filled with the report when the block ends:
+        with recording(print_progress) as report:
+            ...
+        save_report(report, "report.json")
+    :param progress: a function called as progress(stage, done, total), see start_recording
+    :return: the report, filled in at the end of the block
+    """
+
+    start_recording(progress)
+    report = {}
+    try:
+        yield report
+    finally:
+        report.update(stop_recording())
+
+
+def is_recording() -> bool:
+    """ Check if instrumentation is being recorded in this process.
+    :return: True if recording
+    """
+
+    return _recorder is not None
+
+
+@contextmanager
+def stage(name: str):
+    """ Time a stage of the pipeline inside a with block. Times of stages with the same name are added up.
+    :param name: the name of the stage
+    """
+
+    if _recorder is None:
+        yield
+        return
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        if _recorder is not None:
+            _recorder["stages"][name]["seconds"] += perf_counter() - start
+            _recorder["stages"][name]["calls"] += 1
+
+
+def count(name: str, value: int = 1):
+    """ Add value to a counter.
+    :param name: the name of the counter
+    :param value: the amount to add
+    """
+
+    if _recorder is not None:
+        _recorder["counters"][name] += value
+
+
+def observe(name: str, value: int):
+    """ Add one observation of value to a distribution, e.g. the number of eps decays of one trial.
+    :param name: the name of the distribution
+    :param value: the observed value
+    """
+
+    if _recorder is not None:
+        _recorder["distributions"][name][value] += 1
+
+
+def report_progress(stage_name: str, done: int, total: int):
+    """ Tell the progress callback given to start_recording how far a stage is.
+    :param stage_name: the name of the stage
+    :param done: the number of items done
+    :param total: the total number of items
+    """
+
+    if _recorder is not None and _recorder["progress"] is not None:
+        _recorder["progress"](stage_name, done, total)
+
+
+def print_progress(stage_name: str, done: int, total: int):
+    """ A progress callback that prints the progress.
+    :param stage_name: the name of the stage
+    :param done: the number of items done
+    :param total: the total number of items
+    """
+
+    print(f"{stage_name}: on {done} / {total}")
+
+
+def get_report() -> dict:
+    """ Get a report of everything recorded so far, as plain dicts that can be saved as json.
+    :return: the report with the wall time since recording started, the stage times, the counters, the
+    distributions and the peak resident memory of this process and of its finished child processes
+    """
+
+    if _recorder is None:
+        return {}
+
+    peak_rss_bytes, peak_children_rss_bytes = _peak_rss()
+    return {"wall_seconds": perf_counter() - _recorder["start"],
+            "stages": {name: dict(values) for name, values in _recorder["stages"].items()},
+            "counters": dict(_recorder["counters"]),
+            "distributions": {name: dict(sorted(values.items()))
+                              for name, values in _recorder["distributions"].items()},
+            "peak_rss_bytes": peak_rss_bytes,
+            "peak_children_rss_bytes": peak_children_rss_bytes}
+
+
+def merge_report(report: dict):
+    """ Add the stages, counters and distributions of a report from another process, e.g. a trial worker, to the
+    recording of this process.
+    :param report: the report to add
+    """
+
+    if _recorder is None:
+        return
+
+    for name, values in report.get("stages", {}).items():
+        _recorder["stages"][name]["seconds"] += values["seconds"]
+        _recorder["stages"][name]["calls"] += values["calls"]
+    for name, value in report.get("counters", {}).items():
+        _recorder["counters"][name] += value
+    for name, values in report.get("distributions", {}).items():
+        for value, num in values.items():
+            _recorder["distributions"][name][value] += num
+
+
+def run_recorded(function: Callable, *args) -> (object, dict):
+    """ Call a function while recording, and return its result with the report. This is used to run work in other
+    processes, whose reports are then added to the parent process with merge_report.
+    :param function: the function to call
+    :param args: the arguments of the function
+    :return: the result of the function and the report
+    """
+
+    start_recording()
+    try:
+        result = function(*args)
+    finally:
+        report = stop_recording()
+    return result, report
+
+
+def save_report(report: dict, filename: str):
+    """ Save a report as json.
+    :param report: the report from stop_recording or recording
+    :param filename: the file to save to
+    """
+
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def _peak_rss() -> (int or None, int or None):
+    """ Get the peak resident memory of this process and of its finished child processes.
+    :return: the peak resident memory of this process and its children in bytes, or None if unknown
+    """
+
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
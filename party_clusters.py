@@ -0,0 +1,122 @@
+import numpy as np
+from numpy.linalg import norm
+
+
+def build_party_clusters(embedding_matrix: np.ndarray, num_clusters: int = None, num_iterations: int = 10,
+                         seed: int = 0, chunk_size: int = 16384) -> dict:
+    """ Cluster the rows of embedding_matrix with k-means, so that a selection can rule out whole clusters of
+    parties at a time (see select_parties.select_party_indices_clustered). Like the ball tree of spatial_index, the
+    clusters are built once per embedding set and can be saved next to the embeddings with save_party_clusters.
+
+    The clusters only need to be compact, not optimal, so a few rounds of Lloyd's algorithm from random parties are
+    enough. Each cluster stores its center, its radius (the largest distance from the center to one of its
+    parties), and the distances between all centers, which bound the distance from a party to every center without
+    calculating it.
+
+    :param embedding_matrix: the embedding of each party, of shape (number of parties, embedding size)
+    :param num_clusters: the number of clusters. If None, the square root of the number of parties, which balances
+    the work of checking the centers against the work inside the clusters.
+    :param num_iterations: the number of rounds of Lloyd's algorithm
+    :param seed: the random seed for picking the starting centers
+    :param chunk_size: the number of parties to assign to clusters at once
+    :return: the clusters as a dict of arrays: "order" (the row indices, grouped by cluster), "cluster_start" and
+    "cluster_end" (the range of order of each cluster), "cluster_ids" (the cluster of each row), "centers", "radii"
+    and "center_distances"
+    """
+
+    num_rows = len(embedding_matrix)
+    num_clusters = max(1, int(np.sqrt(num_rows))) if num_clusters is None else num_clusters
+    num_clusters = min(num_clusters, num_rows)
+    rng = np.random.default_rng(seed)
+
+    centers = np.array(embedding_matrix[rng.choice(num_rows, size=num_clusters, replace=False)], dtype=float)
+    cluster_ids = _assign_clusters(embedding_matrix, centers, chunk_size)
+    for _ in range(num_iterations):
+        sizes = np.bincount(cluster_ids, minlength=num_clusters)
+        centers = _cluster_sums(embedding_matrix, cluster_ids, num_clusters) / np.maximum(sizes, 1)[:, None]
+
+        # Restart empty clusters from random parties
+        is_empty = sizes == 0
+        centers[is_empty] = embedding_matrix[rng.choice(num_rows, size=is_empty.sum(), replace=False)]
+        cluster_ids = _assign_clusters(embedding_matrix, centers, chunk_size)
+
+    # Drop clusters that ended up empty, and make the centers the means of their parties
+    sizes = np.bincount(cluster_ids, minlength=num_clusters)
+    cluster_ids = (np.cumsum(sizes > 0) - 1)[cluster_ids]
+    sizes = sizes[sizes > 0]
+    centers = _cluster_sums(embedding_matrix, cluster_ids, len(sizes)) / sizes[:, None]
+
+    order = np.argsort(cluster_ids, kind="stable")
+    cluster_end = np.cumsum(sizes)
+    cluster_start = cluster_end - sizes
+
+    radii = np.zeros((len(sizes), ), dtype=float)
+    for cluster, (start, end) in enumerate(zip(cluster_start, cluster_end)):
+        radii[cluster] = norm(embedding_matrix[order[start:end]] - centers[cluster], ord=2, axis=1).max()
+
+    # Pad the radii a little so rounding never rules out a party that is just inside eps, or rules in one that is
+    # just outside
+    radii = radii * (1.0 + 1e-9) + 1e-12
+
+    center_distances = np.zeros((len(sizes), len(sizes)), dtype=float)
+    for cluster, center in enumerate(centers):
+        center_distances[cluster] = norm(centers - center, ord=2, axis=1)
+
+    return {"order": order,
+            "cluster_start": cluster_start,
+            "cluster_end": cluster_end,
+            "cluster_ids": cluster_ids,
+            "centers": centers,
+            "radii": radii,
+            "center_distances": center_distances}
+
+
+def save_party_clusters(filename: str, clusters: dict):
+    """ Saves party clusters to a .npz file. A good place is next to the embedding store they were built from, e.g.
+    "embeddings_meteor_eq0.5.clusters.npz" next to "embeddings_meteor_eq0.5.npy".
+    :param filename: the filename to save the clusters
+    :param clusters: the clusters from build_party_clusters
+    """
+
+    np.savez(filename, **clusters)
+
+
+def load_party_clusters(filename: str) -> dict:
+    """ Loads party clusters saved with save_party_clusters.
+    :param filename: the filename of the saved clusters
+    :return: the clusters
+    """
+
+    with np.load(filename) as saved_clusters:
+        return {key: saved_clusters[key] for key in saved_clusters.files}
+
+
+def _assign_clusters(embedding_matrix: np.ndarray, centers: np.ndarray, chunk_size: int) -> np.ndarray:
+    """ Find the closest center to each row of embedding_matrix, with ||a - c||^2 = ||a||^2 + ||c||^2 - 2 a.c and
+    leaving out ||a||^2, which is the same for every center.
+    :param embedding_matrix: the embedding of each party
+    :param centers: the cluster centers
+    :param chunk_size: the number of rows to handle at once
+    :return: the index of the closest center to each row
+    """
+
+    squared_center_norms = np.einsum("ij,ij->i", centers, centers)
+    cluster_ids = np.zeros((len(embedding_matrix), ), dtype=np.intp)
+    for start in range(0, len(embedding_matrix), chunk_size):
+        chunk = np.asarray(embedding_matrix[start:start+chunk_size], dtype=float)
+        cluster_ids[start:start+chunk_size] = np.argmin(squared_center_norms - 2.0 * chunk @ centers.T, axis=1)
+    return cluster_ids
+
+
+def _cluster_sums(embedding_matrix: np.ndarray, cluster_ids: np.ndarray, num_clusters: int) -> np.ndarray:
+    """ Add up the rows of embedding_matrix in each cluster, one column at a time.
+    :param embedding_matrix: the embedding of each party
+    :param cluster_ids: the cluster of each row
+    :param num_clusters: the number of clusters
+    :return: the sum of the rows of each cluster
+    """
+
+    sums = np.zeros((num_clusters, embedding_matrix.shape[1]), dtype=float)
+    for column in range(embedding_matrix.shape[1]):
+        sums[:, column] = np.bincount(cluster_ids, weights=embedding_matrix[:, column], minlength=num_clusters)
+    return sums
@@ -0,0 +1,279 @@
+from itertools import combinations
+import math
+import numpy as np
+from numpy.random import randint
+import pandas as pd
+
+from generate_possible_parties import get_jobs_per_position
+
+
+def make_party_space(run: str, df_jobs: pd.DataFrame, duplicates: bool = False, excluded_jobs: list = None,
+                     required_jobs: list = None) -> dict:
+    """ Describe all possible parties of a Four Job Fiesta style without generating them. The parties are the ones
+    of generate_possible_parties.generate_possible_party_indices, in the same order, except that parties with an
+    excluded job or without all of the required jobs are left out.
+
+    The space can be counted (count_parties), mapped between ranks and parties (unrank_parties and rank_parties),
+    streamed in chunks (iter_party_chunks) and sampled uniformly (sample_parties), all without holding every
+    party in memory. Embeddings can be calculated on demand for the parties of a chunk or sample with
+    embeddings.calculate_party_embedding_matrix.
+
+    Counts come from inclusion-exclusion, so they don't need enumerating: over the required jobs a party could be
+    missing, and (without duplicates) over which positions hold the same job.
+
+    :param run: the Four Job Fiesta run style ("Regular", "Typhoon", "Volcano", or "Meteor").
+    :param df_jobs: the DataFrame of jobs data
+    :param duplicates: flag to allow duplicates. Doesn't do anything for Regular runs.
+    :param excluded_jobs: names of jobs that can't be in a party
+    :param required_jobs: names of jobs that must all be in a party
+    :return: the party space, as a dict
+    """
+
+    excluded = np.flatnonzero(df_jobs.index.isin(excluded_jobs or []))
+    required = [df_jobs.index.get_loc(job) for job in required_jobs or []]
+    jobs_per_position = [jobs[~np.isin(jobs, excluded)] for jobs in get_jobs_per_position(run, df_jobs)]
+
+    space = {"run": run,
+             "is_distinct": not duplicates and not run == "Regular",
+             "jobs_per_position": jobs_per_position,
+             "job_sets": [frozenset(jobs.tolist()) for jobs in jobs_per_position],
+             "required": frozenset(required),
+             "dtype": np.min_scalar_type(max(len(df_jobs) - 1, 0)),
+             "completion_counts": {},
+             "candidate_counts": [{} for _ in jobs_per_position]}
+
+    # For each position, which later positions each job (by index in df_jobs) is allowed at, as bits
+    space["later_positions"] = []
+    for position in range(len(jobs_per_position)):
+        later_positions = np.zeros((len(df_jobs), ), dtype=np.int64)
+        for bit, jobs in enumerate(jobs_per_position[position+1:]):
+            later_positions[jobs] += 2**bit
+        space["later_positions"].append(later_positions)
+    space["num_parties"] = _count_completions(space, ())
+    return space
+
+
+def count_parties(space: dict) -> int:
+    """ Get the exact number of parties in a party space.
+    :param space: the party space from make_party_space
+    :return: the number of parties
+    """
+
+    return space["num_parties"]
+
+
+def unrank_parties(space: dict, ranks: np.ndarray) -> np.ndarray:
+    """ Get the parties at some ranks of a party space. Rank i is row i of generate_possible_party_indices (with the
+    constraints of the space applied).
+    :param space: the party space from make_party_space
+    :param ranks: the ranks, from 0 to count_parties(space) - 1
+    :return: the parties, as an array of shape (number of ranks, 4) of job indices
+    """
+
+    ranks = np.atleast_1d(ranks)
+    party_indices = np.zeros((len(ranks), len(space["jobs_per_position"])), dtype=space["dtype"])
+
+    for idx_rank, rank in enumerate(ranks):
+        rank = int(rank)
+        if not 0 <= rank < space["num_parties"]:
+            raise IndexError(f"Rank {rank} is out of range for {space['num_parties']} parties")
+
+        # At each position, skip the jobs whose completions all come before rank
+        prefix = ()
+        for position in range(len(space["jobs_per_position"])):
+            candidates, num_completions = _count_candidate_completions(space, prefix)
+            cumulative_completions = np.cumsum(num_completions)
+            idx_job = int(np.searchsorted(cumulative_completions, rank, side="right"))
+            rank -= int(cumulative_completions[idx_job - 1]) if idx_job > 0 else 0
+            prefix += (int(candidates[idx_job]), )
+        party_indices[idx_rank] = prefix
+
+    return party_indices
+
+
+def rank_parties(space: dict, party_indices: np.ndarray) -> np.ndarray:
+    """ Get the ranks of some parties in a party space, the inverse of unrank_parties.
+    :param space: the party space from make_party_space
+    :param party_indices: the parties, as an array of shape (number of parties, 4) of job indices
+    :return: the rank of each party
+    """
+
+    party_indices = np.atleast_2d(party_indices)
+    ranks = np.zeros((len(party_indices), ), dtype=np.int64)
+
+    for idx_party, party in enumerate(party_indices.tolist()):
+        rank = 0
+        prefix = ()
+        for job in party:
+            candidates, num_completions = _count_candidate_completions(space, prefix)
+            idx_job = np.flatnonzero(candidates == job)
+            if len(idx_job) == 0 or num_completions[idx_job[0]] == 0:
+                raise ValueError(f"Party {party} is not in the party space")
+            rank += int(num_completions[:idx_job[0]].sum())
+            prefix += (job, )
+        ranks[idx_party] = rank
+
+    return ranks
+
+
+def iter_party_chunks(space: dict, chunk_size: int = 65536):
+    """ Go through the parties of a party space in order, a chunk at a time. Each chunk comes from chunk_size
+    combinations of one job per position, so it has at most chunk_size parties.
+    :param space: the party space from make_party_space
+    :param chunk_size: the number of combinations of jobs to check at a time
+    :return: a generator of arrays of shape (number of parties in the chunk, 4) of job indices
+    """
+
+    sizes = [len(jobs) for jobs in space["jobs_per_position"]]
+    num_combinations = int(np.prod(sizes, dtype=np.int64))
+
+    for start in range(0, num_combinations, chunk_size):
+        # Write the combination numbers in mixed radix, with the first position changing slowest
+        remainders = np.arange(start, min(start + chunk_size, num_combinations), dtype=np.int64)
+        party_indices = np.zeros((len(remainders), len(sizes)), dtype=space["dtype"])
+        for position in reversed(range(len(sizes))):
+            party_indices[:, position] = space["jobs_per_position"][position][remainders % sizes[position]]
+            remainders //= sizes[position]
+
+        is_valid = np.ones((len(party_indices), ), dtype=bool)
+        if space["is_distinct"]:
+            for i, j in combinations(range(len(sizes)), 2):
+                is_valid &= party_indices[:, i] != party_indices[:, j]
+        for job in space["required"]:
+            is_valid &= (party_indices == job).any(axis=1)
+
+        if is_valid.any():
+            yield party_indices[is_valid]
+
+
+def sample_parties(space: dict, num_parties: int, rng: np.random.Generator = None) -> np.ndarray:
+    """ Draw parties uniformly at random (with replacement) from a party space, by drawing random ranks.
+    :param space: the party space from make_party_space
+    :param num_parties: the number of parties to draw
+    :param rng: the random generator. If None, numpy.random is used.
+    :return: the parties, as an array of shape (num_parties, 4) of job indices
+    """
+
+    if space["num_parties"] == 0:
+        raise ValueError("The party space is empty")
+    if rng is None:
+        ranks = randint(0, space["num_parties"], size=(num_parties, ))
+    else:
+        ranks = rng.integers(0, space["num_parties"], size=(num_parties, ))
+    return unrank_parties(space, ranks)
+
+
+def _count_candidate_completions(space: dict, prefix: tuple) -> (np.ndarray, np.ndarray):
+    """ Count the parties of a party space that start with prefix followed by each job allowed at the next position.
+    Two jobs that are in the same later positions' job sets, and are both missing required jobs or both not, can
+    be swapped without changing the count. So only one job of each such group is counted. The counts of prefixes
+    of up to 1 job are remembered in the space.
+    :param space: the party space
+    :param prefix: the job indices of the first positions
+    :return: the jobs allowed at the next position, in order, and the number of parties after each
+    """
+
+    position = len(prefix)
+    missing = space["required"] - frozenset(prefix)
+    key = (frozenset(prefix) if space["is_distinct"] else frozenset(), missing)
+    if key in space["candidate_counts"][position]:
+        return space["candidate_counts"][position][key]
+
+    candidates = space["jobs_per_position"][position]
+    if space["is_distinct"] and position > 0:
+        is_used = np.zeros((len(space["later_positions"][position]), ), dtype=bool)
+        is_used[list(prefix)] = True
+        candidates = candidates[~is_used[candidates]]
+
+    is_missing = np.zeros((len(space["later_positions"][position]), ), dtype=np.int64)
+    is_missing[list(missing)] = 1
+    groups = space["later_positions"][position][candidates] * 2 + is_missing[candidates]
+    _, first_in_group, group_of_candidate = np.unique(groups, return_index=True, return_inverse=True)
+    group_counts = np.array([_count_completions(space, prefix + (int(candidates[idx_candidate]), ))
+                             for idx_candidate in first_in_group], dtype=np.int64)
+    num_completions = group_counts[group_of_candidate].reshape(-1)
+
+    # Remember the counts for short prefixes, which there are few of and which every rank goes through
+    if position < 2:
+        space["candidate_counts"][position][key] = (candidates, num_completions)
+    return candidates, num_completions
+
+
+def _count_completions(space: dict, prefix: tuple) -> int:
+    """ Count the parties of a party space that start with the jobs of prefix. Counts are remembered in the space,
+    by what they depend on: the position, and the jobs of the prefix that still matter.
+    :param space: the party space
+    :param prefix: the job indices of the first positions
+    :return: the number of parties
+    """
+
+    position = len(prefix)
+    if space["is_distinct"] and len(set(prefix)) < position:
+        return 0
+    if position > 0 and prefix[-1] not in space["job_sets"][position - 1]:
+        return 0
+
+    missing = space["required"] - frozenset(prefix)
+    used = frozenset(prefix) if space["is_distinct"] else frozenset()
+    key = (position, used, missing)
+    if key not in space["completion_counts"]:
+        job_sets = [job_set - used for job_set in space["job_sets"][position:]]
+        space["completion_counts"][key] = _count_with_required(job_sets, missing, space["is_distinct"])
+    return space["completion_counts"][key]
+
+
+def _count_with_required(job_sets: list, required: frozenset, is_distinct: bool) -> int:
+    """ Count the ways to pick one job from each of job_sets so that every job of required is picked, by
+    inclusion-exclusion over the required jobs that are left out.
+    :param job_sets: the jobs allowed at each position
+    :param required: the jobs that must be picked
+    :param is_distinct: must the picked jobs all be different?
+    :return: the number of ways
+    """
+
+    total = 0
+    for num_left_out in range(len(required) + 1):
+        for left_out in combinations(sorted(required), num_left_out):
+            allowed = [job_set.difference(left_out) for job_set in job_sets]
+            total += (-1)**num_left_out * _count_picks(allowed, is_distinct)
+    return total
+
+
+def _count_picks(job_sets: list, is_distinct: bool) -> int:
+    """ Count the ways to pick one job from each of job_sets. With is_distinct, the picked jobs must all be
+    different: this is inclusion-exclusion over the ways positions can hold the same job, a sum over the set
+    partitions of the positions with the Moebius weight prod over blocks of (-1)^(|block| - 1) (|block| - 1)!.
+    :param job_sets: the jobs allowed at each position
+    :param is_distinct: must the picked jobs all be different?
+    :return: the number of ways
+    """
+
+    if not is_distinct:
+        return math.prod(len(job_set) for job_set in job_sets)
+
+    total = 0
+    for partition in _set_partitions(list(range(len(job_sets)))):
+        term = 1
+        for block in partition:
+            common_jobs = frozenset.intersection(*[job_sets[position] for position in block])
+            term *= (-1)**(len(block) - 1) * math.factorial(len(block) - 1) * len(common_jobs)
+        total += term
+    return total
+
+
+def _set_partitions(items: list) -> list:
+    """ Get every way to split items into non-empty blocks.
+    :param items: the items
+    :return: a list of partitions, each a list of blocks
+    """
+
+    if len(items) == 0:
+        return [[]]
+    first, rest = items[0], items[1:]
+    partitions = []
+    for partition in _set_partitions(rest):
+        partitions.append([[first]] + partition)
+        for idx_block in range(len(partition)):
+            partitions.append(partition[:idx_block] + [[first] + partition[idx_block]] + partition[idx_block+1:])
+    return partitions
+
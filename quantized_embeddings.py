@@ -0,0 +1,198 @@
+import numpy as np
+
+from distances import count_bits
+from embeddings import combine_embedding_blocks
+
+
+def quantize_embedding_matrix(embedding_matrix: np.ndarray, chunk_size: int = 65536) -> dict:
+    """ Store an embedding matrix compactly. Every value of the party embeddings is a small multiple of a scale
+    that only depends on the column: multiples of 0.25 for style, 0 or equip_factor for equipment, and 0 or the
+    job weight (1 or 0.1) for jobs. So each value is stored as an integer code with value = code * scale.
+
+    Columns are grouped by scale. Columns whose codes are all 0 or 1 are packed 8 to a byte, the others are stored
+    as one uint8 per value. For the default embeddings that is about 28 bytes per party instead of 816, e.g. about
+    6.5 MB instead of 190 MB for Meteor with duplicates, small enough to stay in the CPU caches during selection.
+
+    The encoding is exact: dequantize_embedding_matrix gives back embedding_matrix. The matrix is read chunk_size
+    rows at a time, so it can be memory-mapped (see data.load_party_embedding_store).
+
+    :param embedding_matrix: the embedding of each party, one per row
+    :param chunk_size: the number of rows to handle at once
+    :return: the quantized embeddings, as a dict with the "num_rows" and "num_columns" of the matrix, and the
+    "code_groups" and "bit_groups". Each group has its "columns", its "scale", and its "codes" (uint8 per value)
+    or "bits" (packed)
+    """
+
+    return _quantize_chunks(lambda start, stop: np.asarray(embedding_matrix[start:stop], dtype=float),
+                            len(embedding_matrix), embedding_matrix.shape[1], chunk_size)
+
+
+def quantize_embedding_blocks(blocks: dict, special_weight_jobs: list = None, equip_factor: float = 1.0,
+                              chunk_size: int = 65536) -> dict:
+    """ Quantize the embeddings made from the blocks of embeddings.calculate_party_embedding_blocks, the same as
+    quantize_embedding_matrix(combine_embedding_blocks(blocks, special_weight_jobs, equip_factor)), without ever
+    holding more than chunk_size rows of the embedding matrix.
+    :param blocks: the embedding blocks
+    :param special_weight_jobs: jobs to give the special weight in the jobs embedding
+    :param equip_factor: the scaling factor for the equipment embeddings
+    :param chunk_size: the number of rows to handle at once
+    :return: the quantized embeddings
+    """
+
+    def get_chunk(start: int, stop: int) -> np.ndarray:
+        chunk_blocks = dict(blocks, style=blocks["style"][start:stop], equip=blocks["equip"][start:stop],
+                            jobs=blocks["jobs"][start:stop])
+        return combine_embedding_blocks(chunk_blocks, special_weight_jobs, equip_factor)
+
+    num_columns = get_chunk(0, 0).shape[1]
+    return _quantize_chunks(get_chunk, len(blocks["jobs"]), num_columns, chunk_size)
+
+
+def dequantize_embedding_matrix(quantized: dict, rows: np.ndarray = None) -> np.ndarray:
+    """ Get the embedding matrix back from quantized embeddings. The values are exactly the quantized ones.
+    :param quantized: the quantized embeddings from quantize_embedding_matrix
+    :param rows: the rows to get. If None, all rows are returned.
+    :return: the embeddings of rows, one per row
+    """
+
+    rows = np.arange(quantized["num_rows"]) if rows is None else np.asarray(rows)
+    embedding_matrix = np.zeros((len(rows), quantized["num_columns"]), dtype=float)
+
+    for group in quantized["code_groups"]:
+        embedding_matrix[:, group["columns"]] = group["codes"][rows] * group["scale"]
+    for group in quantized["bit_groups"]:
+        codes = np.unpackbits(group["bits"][rows], axis=1, count=len(group["columns"]))
+        embedding_matrix[:, group["columns"]] = codes * group["scale"]
+
+    return embedding_matrix
+
+
+def quantized_distances_to_rows(quantized: dict, rows: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+    """ Calculate the 2-norm distance from each of rows to every row of quantized embeddings, without decoding
+    them. The squared distance of each group is scale^2 times a sum over integer codes: the squared differences of
+    the codes, or the number of differing bits (XOR and popcount) for packed groups. The distances are the same as
+    from the decoded embeddings, up to rounding.
+    :param quantized: the quantized embeddings from quantize_embedding_matrix
+    :param rows: the rows to calculate the distances from
+    :param chunk_size: the number of rows to compare against at once
+    :return: the distances, of shape (number of rows, number of quantized rows)
+    """
+
+    rows = np.atleast_1d(rows)
+    squared_distances = np.zeros((len(rows), quantized["num_rows"]), dtype=float)
+
+    for start in range(0, quantized["num_rows"], chunk_size):
+        stop = min(start + chunk_size, quantized["num_rows"])
+        for group in quantized["code_groups"]:
+            codes = group["codes"][start:stop].astype(np.int32)
+            for idx_row, row in enumerate(rows):
+                differences = codes - group["codes"][row].astype(np.int32)
+                squared_distances[idx_row, start:stop] += group["scale"]**2 * np.einsum("ij,ij->i", differences,
+                                                                                        differences)
+        for group in quantized["bit_groups"]:
+            bits = group["bits"][start:stop]
+            for idx_row, row in enumerate(rows):
+                num_differences = count_bits(bits ^ group["bits"][row]).sum(axis=1)
+                squared_distances[idx_row, start:stop] += group["scale"]**2 * num_differences
+
+    return np.sqrt(squared_distances)
+
+
+def take_quantized_rows(quantized: dict, rows: np.ndarray) -> dict:
+    """ Get some rows of quantized embeddings as quantized embeddings of their own, e.g. the selected parties of a
+    trial for a comparison matrix: quantized_distances_to_rows(take_quantized_rows(quantized, rows), range(n)).
+    :param quantized: the quantized embeddings from quantize_embedding_matrix
+    :param rows: the rows to take
+    :return: the quantized embeddings of rows
+    """
+
+    rows = np.asarray(rows)
+    return {"num_rows": len(rows),
+            "num_columns": quantized["num_columns"],
+            "code_groups": [dict(group, codes=group["codes"][rows]) for group in quantized["code_groups"]],
+            "bit_groups": [dict(group, bits=group["bits"][rows]) for group in quantized["bit_groups"]]}
+
+
+def quantized_nbytes(quantized: dict) -> int:
+    """ Get the memory used by the codes of quantized embeddings.
+    :param quantized: the quantized embeddings from quantize_embedding_matrix
+    :return: the number of bytes
+    """
+
+    return sum(group["codes"].nbytes for group in quantized["code_groups"]) + \
+        sum(group["bits"].nbytes for group in quantized["bit_groups"])
+
+
+def _quantize_chunks(get_chunk, num_rows: int, num_columns: int, chunk_size: int) -> dict:
+    """ Quantize an embedding matrix that is read in chunks, for quantize_embedding_matrix. The first pass over the
+    chunks finds the distinct values, and so the scale, of each column, and the second encodes the values.
+    :param get_chunk: a function called as get_chunk(start, stop) that returns those rows of the embedding matrix
+    :param num_rows: the number of rows of the embedding matrix
+    :param num_columns: the number of columns of the embedding matrix
+    :param chunk_size: the number of rows to handle at once
+    :return: the quantized embeddings
+    """
+
+    column_values = [np.zeros((0, ), dtype=float) for _ in range(num_columns)]
+    for start in range(0, num_rows, chunk_size):
+        chunk = get_chunk(start, min(start + chunk_size, num_rows))
+        for column in range(num_columns):
+            column_values[column] = np.union1d(column_values[column], chunk[:, column])
+            if len(column_values[column]) > 256:
+                raise ValueError("The embeddings have too many distinct values in a column to be quantized")
+
+    scales = np.ones((num_columns, ), dtype=float)
+    max_codes = np.zeros((num_columns, ), dtype=float)
+    for column, values in enumerate(column_values):
+        scales[column], max_codes[column] = _find_column_scale(values)
+
+    # Group the columns by scale, and by whether they fit in one bit
+    groups = {}
+    for column, (scale, max_code) in enumerate(zip(scales, max_codes)):
+        groups.setdefault((max_code <= 1, scale), []).append(column)
+
+    quantized = {"num_rows": num_rows, "num_columns": num_columns, "code_groups": [], "bit_groups": []}
+    for (is_bits, scale), columns in groups.items():
+        if is_bits:
+            quantized["bit_groups"].append({"columns": np.array(columns), "scale": scale,
+                                            "bits": np.zeros((num_rows, -(-len(columns) // 8)), dtype=np.uint8)})
+        else:
+            quantized["code_groups"].append({"columns": np.array(columns), "scale": scale,
+                                             "codes": np.zeros((num_rows, len(columns)), dtype=np.uint8)})
+
+    for start in range(0, num_rows, chunk_size):
+        stop = min(start + chunk_size, num_rows)
+        chunk = get_chunk(start, stop)
+        codes = np.rint(chunk / scales)
+        if (codes < 0).any() or not np.array_equal(codes * scales, chunk):
+            raise ValueError("The embeddings aren't multiples of one scale per column, so they can't be quantized "
+                             "exactly")
+        for group in quantized["code_groups"]:
+            group["codes"][start:stop] = codes[:, group["columns"]]
+        for group in quantized["bit_groups"]:
+            group["bits"][start:stop] = np.packbits(codes[:, group["columns"]] != 0, axis=1)
+
+    return quantized
+
+
+def _find_column_scale(values: np.ndarray) -> (float, int):
+    """ Find a scale that every value of a column is an exact multiple of, with codes from 0 to 255. The scale is
+    the non-zero value closest to zero, divided by the smallest whole number that works, e.g. 0.25 for the values
+    0.5 and 0.75.
+    :param values: the distinct values of the column
+    :return: the scale and the largest code
+    """
+
+    non_zero = values[values != 0.0]
+    if len(non_zero) == 0:
+        # Keep the sign of the zeros, e.g. the -0.0 of unused equipment with a negative equip_factor
+        return np.copysign(1.0, values[0]) if len(values) > 0 else 1.0, 0
+
+    smallest = non_zero[np.abs(non_zero).argmin()]
+    for divisor in range(1, 256):
+        scale = smallest / divisor
+        codes = np.rint(values / scale)
+        if codes.min() >= 0 and codes.max() <= 255 and np.array_equal(codes * scale, values):
+            return scale, int(codes.max())
+
+    raise ValueError("The embeddings aren't multiples of one scale per column, so they can't be quantized exactly")
@@ -1,7 +1,12 @@
-from copy import copy
 import numpy as np
 from numpy.linalg import norm
 from numpy.random import randint
+from typing import Callable
+
+from distances import distances_to_rows, prepare_metric
+from instrumentation import count, observe, stage
+from quantized_embeddings import quantized_distances_to_rows
+from spatial_index import query_radius
 
 
 def select_parties_randomly(valid_parties: list, num_parties: int = 10, eps: float = 1.0,
@@ -31,8 +36,32 @@ def select_parties_randomly(valid_parties: list, num_parties: int = 10, eps: flo
     return selected_parties
 
 
+def select_party_indices_randomly(embedding_matrix: np.ndarray, num_parties: int = 10, eps: float = 1.0,
+                                  verbose: bool = False, rng: np.random.Generator = None) -> np.ndarray:
+    """ Select num_parties parties randomly, the same way as select_parties_randomly, but working directly on the
+    embedding matrix and returning the row indices of the selected parties.
+
+    :param embedding_matrix: the embedding of each party, of shape (number of parties, embedding size)
+    :param num_parties: the number of parties to select
+    :param eps: unused parameter
+    :param verbose: print logging info?
+    :param rng: the random generator used to pick parties. If None, numpy.random is used.
+    :return: the row indices of the selected parties
+    """
+
+    if num_parties > len(embedding_matrix):
+        num_parties = len(embedding_matrix)
+        if verbose:
+            print(f"Notice: num_parties was larger than the number of valid parties. "
+                  f"Setting num_parties to {num_parties}.")
+
+    if rng is None:
+        return randint(0, len(embedding_matrix), size=(num_parties, ))
+    return rng.integers(0, len(embedding_matrix), size=(num_parties, ))
+
+
 def select_parties_by_embeddings(valid_parties: list, num_parties: int = 10, eps: float = 1.0,
-                                 verbose: bool = False) -> list:
+                                 verbose: bool = False, index: dict = None, metric: dict = None) -> list:
     """ Given a selection of party embeddings, select num_parties which are intended to be played. This
     uses the embeddings in the selection process. The first party is selected at random. Further parties
     are selected so that they more than eps away (in 2-norm) from any other selected party.
@@ -46,68 +75,443 @@ def select_parties_by_embeddings(valid_parties: list, num_parties: int = 10, eps
     :param num_parties: the number of parties to select
     :param eps: the distance all selected parties must be from each other, to start
     :param verbose: print logging info?
+    :param index: a ball tree over the embeddings of valid_parties (see spatial_index.build_ball_tree) used to
+    find close parties. If None, every party is checked.
+    :param metric: the metric that defines the distance between parties, see the distances module. If None, the
+    2-norm is used.
     :return: the list of selected parties
     """
 
-    available_parties = copy(valid_parties)
-    selected_parties = []
-    unavailable_parties = []
+    if len(valid_parties) == 0:
+        return []
 
-    if num_parties > len(valid_parties):
-        num_parties = len(valid_parties)
+    embedding_matrix = np.stack([party_embedding for _, party_embedding in valid_parties])
+    chosen_party_indices = select_party_indices_by_embeddings(embedding_matrix, num_parties, eps, verbose,
+                                                              index=index, metric=metric)
+    selected_parties = [valid_parties[i] for i in chosen_party_indices]
+
+    return selected_parties
+
+
+@stage("select_parties")
+def select_party_indices_by_embeddings(embedding_matrix: np.ndarray, num_parties: int = 10, eps: float = 1.0,
+                                       verbose: bool = False, rng: np.random.Generator = None,
+                                       index: dict = None, metric: dict = None) -> np.ndarray:
+    """ Select num_parties parties the same way as select_parties_by_embeddings, but working directly on the
+    embedding matrix (one row per party) and returning the row indices of the selected parties.
+
+    Instead of partitioning the parties into close and far lists, this keeps the distance from each party to
+    its nearest selected party. Each pick updates it with one vectorized distance calculation, and a party is
+    available if it isn't selected and that distance is at least eps. When no party is available, eps is
+    multiplied by 0.8 until one is, which only needs a new threshold rather than a new scan of the selected
+    parties.
+
+    If index is given, only the parties within eps of each pick are found (with spatial_index.query_radius) and
+    updated. The other parties keep a larger distance, which is fine since eps never grows: a party that was at
+    least eps away from a pick stays at least eps away after eps shrinks. The selected parties are the same as
+    without the index.
+
+    :param embedding_matrix: the embedding of each party, of shape (number of parties, embedding size)
+    :param num_parties: the number of parties to select
+    :param eps: the distance all selected parties must be from each other, to start
+    :param verbose: print logging info?
+    :param rng: the random generator used to pick parties. If None, numpy.random is used.
+    :param index: a ball tree over embedding_matrix from spatial_index.build_ball_tree. If None, the distance
+    to every party is calculated for each pick.
+    :param metric: the metric that defines the distance between parties, see the distances module. It is prepared
+    for embedding_matrix here unless it already is. If None, the 2-norm is used. The index only works with the
+    2-norm.
+    :return: the row indices of the selected parties, in the order they were selected
+    """
+
+    if index is not None and metric is not None:
+        raise ValueError("The ball tree index only supports the 2-norm, so it can't be used with a metric")
+    if metric is not None:
+        metric = prepare_metric(metric, embedding_matrix)
+
+    def update_min_distances(min_distances: np.ndarray, chosen_party_idx: int, eps: float):
+        if metric is not None:
+            np.minimum(min_distances, distances_to_rows(embedding_matrix, embedding_matrix[chosen_party_idx],
+                                                        metric)[0], out=min_distances)
+            count("parties_scanned", len(embedding_matrix))
+            count("distance_evaluations", len(embedding_matrix))
+        elif index is None:
+            np.minimum(min_distances, calculate_distances(embedding_matrix, embedding_matrix[chosen_party_idx]),
+                       out=min_distances)
+            count("parties_scanned", len(embedding_matrix))
+            count("distance_evaluations", len(embedding_matrix))
+        else:
+            close_indices, close_distances = query_radius(index, embedding_matrix,
+                                                          embedding_matrix[chosen_party_idx], eps)
+            min_distances[close_indices] = np.minimum(min_distances[close_indices], close_distances)
+
+    return _select_party_indices(len(embedding_matrix), update_min_distances, num_parties, eps, verbose, rng)
+
+
+@stage("select_parties")
+def select_party_indices_quantized(quantized: dict, num_parties: int = 10, eps: float = 1.0, verbose: bool = False,
+                                   rng: np.random.Generator = None) -> np.ndarray:
+    """ Select num_parties parties the same way as select_party_indices_by_embeddings, but working directly on
+    quantized embeddings from quantized_embeddings.quantize_embedding_matrix. The codes are much smaller than the
+    embedding matrix, so they stay in the CPU caches while the distances to each pick are calculated.
+    The distances are the same as the 2-norm up to rounding, so the selected parties are the same unless a party is
+    within rounding of eps.
+    :param quantized: the quantized embeddings
+    :param num_parties: the number of parties to select
+    :param eps: the distance all selected parties must be from each other, to start
+    :param verbose: print logging info?
+    :param rng: the random generator used to pick parties. If None, numpy.random is used.
+    :return: the row indices of the selected parties, in the order they were selected
+    """
+
+    def update_min_distances(min_distances: np.ndarray, chosen_party_idx: int, eps: float):
+        np.minimum(min_distances, quantized_distances_to_rows(quantized, [chosen_party_idx])[0], out=min_distances)
+        count("parties_scanned", quantized["num_rows"])
+        count("distance_evaluations", quantized["num_rows"])
+
+    return _select_party_indices(quantized["num_rows"], update_min_distances, num_parties, eps, verbose, rng)
+
+
+def select_party_indices_clustered(embedding_matrix: np.ndarray, clusters: dict, num_parties: int = 10,
+                                   eps: float = 1.0, verbose: bool = False, rng: np.random.Generator = None,
+                                   max_scan_fraction: float = 0.5) -> np.ndarray:
+    """ Select num_parties parties the same way as select_party_indices_by_embeddings, but only calculating the
+    distances to the parties of clusters that straddle eps of each pick.
+
+    For each pick, the distance to each cluster center is bounded from below with the triangle inequality, using
+    the distance from the pick to its own center and the distances between centers. Clusters that are at least eps
+    away even with that bound are skipped without calculating anything. The distances to the other centers are
+    calculated, and with the radii, each cluster is then either:
+        at least eps away: skipped, as with the ball tree index of select_party_indices_by_embeddings
+        within eps: every party in it is close, so it gets the largest distance it can be from the pick, which is
+        enough to know it isn't available. If eps later shrinks below that bound, the exact distances to the
+        pick are calculated then.
+        straddling eps: the exact distances to its parties are calculated.
+    The selected parties are the same as select_party_indices_by_embeddings.
+
+    This is a specialization for small eps, about 1 or below with the default embeddings. The distances between
+    parties are concentrated (e.g. 98% of the Typhoon distances are between 1.8 and 3.8, and the median Meteor
+    distance is 3.5), so near the usual eps of 2 to 4 most parties straddle eps even with much finer clusters: on
+    Meteor with duplicates, 8000 clusters (median radius 1.0) still leave 84% of the parties straddling an eps of 3.
+    There, the selection is no faster than select_party_indices_by_embeddings. At eps 1 it scans about a quarter of
+    the parties, and is about 3 times faster.
+
+    When more than max_scan_fraction of the parties straddle eps of a pick, every party is scanned instead, as in
+    select_party_indices_by_embeddings. If the bounds from the center distances already show that, the distances
+    to the centers aren't calculated either.
+
+    :param embedding_matrix: the embedding of each party, of shape (number of parties, embedding size)
+    :param clusters: the clusters of embedding_matrix from party_clusters.build_party_clusters
+    :param num_parties: the number of parties to select
+    :param eps: the distance all selected parties must be from each other, to start
+    :param verbose: print logging info?
+    :param rng: the random generator used to pick parties. If None, numpy.random is used.
+    :param max_scan_fraction: the fraction of parties straddling eps above which all parties are scanned
+    :return: the row indices of the selected parties, in the order they were selected
+    """
+
+    # The picks and the clusters within eps of them, with the largest distance from the pick to the cluster
+    inside_clusters = []
+
+    def cluster_rows(cluster_list: np.ndarray) -> np.ndarray:
+        return np.concatenate([clusters["order"][clusters["cluster_start"][cluster]:clusters["cluster_end"][cluster]]
+                               for cluster in cluster_list] + [np.zeros((0, ), dtype=np.intp)])
+
+    def update_exactly(min_distances: np.ndarray, chosen_party_idx: int, cluster_list: np.ndarray):
+        rows = cluster_rows(cluster_list)
+        distances = norm(embedding_matrix[rows] - embedding_matrix[chosen_party_idx], ord=2, axis=1)
+        min_distances[rows] = np.minimum(min_distances[rows], distances)
+        count("parties_scanned", len(rows))
+        count("distance_evaluations", len(rows))
+
+    def scan_all(min_distances: np.ndarray, embedding: np.ndarray):
+        np.minimum(min_distances, calculate_distances(embedding_matrix, embedding), out=min_distances)
+        count("parties_scanned", len(embedding_matrix))
+        count("distance_evaluations", len(embedding_matrix))
+
+    def update_min_distances(min_distances: np.ndarray, chosen_party_idx: int, eps: float):
+        embedding = embedding_matrix[chosen_party_idx]
+        own_cluster = clusters["cluster_ids"][chosen_party_idx]
+        own_distance = norm(clusters["centers"][own_cluster] - embedding, ord=2)
+        lower_bounds = np.abs(clusters["center_distances"][own_cluster] - own_distance)
+
+        # When most parties straddle eps, one scan of every party is faster than gathering their rows. The clusters
+        # that are near the pick even with the upper bound, and not within eps even with the lower bound, straddle
+        # eps, so that can be known before calculating the distances to the centers.
+        is_straddling = (clusters["center_distances"][own_cluster] + own_distance - clusters["radii"] < eps) & \
+            (lower_bounds + clusters["radii"] >= eps)
+        if (clusters["cluster_end"] - clusters["cluster_start"])[is_straddling].sum() > \
+                max_scan_fraction * len(embedding_matrix):
+            scan_all(min_distances, embedding)
+            return
+
+        candidates = np.flatnonzero(lower_bounds - clusters["radii"] < eps)
+
+        center_distances = norm(clusters["centers"][candidates] - embedding, ord=2, axis=1)
+        count("clusters_checked", len(candidates))
+        is_near = center_distances - clusters["radii"][candidates] < eps
+        upper_bounds = center_distances + clusters["radii"][candidates]
+        is_inside = upper_bounds < eps
+
+        straddling = candidates[is_near & ~is_inside]
+        num_straddling = (clusters["cluster_end"][straddling] - clusters["cluster_start"][straddling]).sum()
+        if num_straddling > max_scan_fraction * len(embedding_matrix):
+            scan_all(min_distances, embedding)
+            return
+
+        rows = cluster_rows(candidates[is_inside])
+        sizes = clusters["cluster_end"][candidates[is_inside]] - clusters["cluster_start"][candidates[is_inside]]
+        min_distances[rows] = np.minimum(min_distances[rows], np.repeat(upper_bounds[is_inside], sizes))
+        count("parties_scanned", len(rows))
+        inside_clusters.extend((chosen_party_idx, cluster, upper_bound) for cluster, upper_bound
+                               in zip(candidates[is_inside], upper_bounds[is_inside]))
+
+        update_exactly(min_distances, chosen_party_idx, straddling)
+
+    def resolve_min_distances(min_distances: np.ndarray, eps: float):
+        # Parties whose bound is no longer below eps might be available now, so they need their exact distance
+        for chosen_party_idx, cluster, upper_bound in list(inside_clusters):
+            if upper_bound >= eps:
+                update_exactly(min_distances, chosen_party_idx, [cluster])
+                inside_clusters.remove((chosen_party_idx, cluster, upper_bound))
+
+    return _select_party_indices(len(embedding_matrix), update_min_distances, num_parties, eps, verbose, rng,
+                                 resolve_min_distances)
+
+
+def _select_party_indices(num_rows: int, update_min_distances: Callable, num_parties: int, eps: float,
+                          verbose: bool, rng: np.random.Generator or None,
+                          resolve_min_distances: Callable = None) -> np.ndarray:
+    """ Select parties for select_party_indices_by_embeddings, select_party_indices_quantized and
+    select_party_indices_clustered.
+    :param num_rows: the number of parties to select from
+    :param update_min_distances: a function called as update_min_distances(min_distances, chosen_party_idx, eps)
+    after each pick. It must lower min_distances to the distance to the pick, at least for every party closer than
+    eps to it, or to a bound that is still below eps.
+    :param num_parties: the number of parties to select
+    :param eps: the distance all selected parties must be from each other, to start
+    :param verbose: print logging info?
+    :param rng: the random generator used to pick parties. If None, numpy.random is used.
+    :param resolve_min_distances: a function called as resolve_min_distances(min_distances, eps) each time eps
+    shrinks, which must replace the bounds of update_min_distances that are no longer below eps with exact
+    distances. If None, update_min_distances only gives exact distances.
+    :return: the row indices of the selected parties, in the order they were selected
+    """
+
+    if num_parties > num_rows:
+        num_parties = num_rows
         if verbose:
             print(f"Notice: num_parties was larger than the number of valid parties. "
                   f"Setting num_parties to {num_parties}.")
-    
+
+    min_distances = np.full((num_rows, ), np.inf)
+    is_selected = np.zeros((num_rows, ), dtype=bool)
+    chosen_party_indices = np.zeros((num_parties, ), dtype=np.intp)
+    num_eps_decays = 0
+
     for idx_party in range(0, num_parties):
 
+        # Make sure there are still parties available. If not, decrease eps.
+        available_indices = np.flatnonzero(~is_selected & (min_distances >= eps))
+        while len(available_indices) == 0:
+            eps *= 0.8
+            num_eps_decays += 1
+            if resolve_min_distances is not None:
+                resolve_min_distances(min_distances, eps)
+            if verbose:
+                print("Notice: Available parties are too close to selected parties.")
+                print(f"Trying eps = {eps} for party {idx_party}")
+            available_indices = np.flatnonzero(~is_selected & (min_distances >= eps))
+
         # Select a party
-        chosen_party_idx = randint(0, len(available_parties))
-        selected_parties.append(available_parties[chosen_party_idx])
-        available_parties[chosen_party_idx] = available_parties[-1]
-        available_parties.pop()
-        
-        # Organize the available parties by whether they are close to the chosen party or not
-        close_parties, far_parties = organize_parties(selected_parties[-1][1], available_parties, eps)
-        available_parties = far_parties
-        unavailable_parties += close_parties
+        chosen_party_idx = available_indices[_random_index(len(available_indices), rng)]
+        chosen_party_indices[idx_party] = chosen_party_idx
+        is_selected[chosen_party_idx] = True
 
-        # Make sure there are still parties available. If not, decrease eps.
-        if len(selected_parties) != len(valid_parties):
-            while len(available_parties) == 0:
-                eps *= 0.8
-                available_parties = unavailable_parties  # Make all remaining parties available again
-                unavailable_parties = []
-
-                if verbose:
-                    print("Notice: Available parties are too close to selected parties.")
-                    print(f"Trying eps = {eps} for party {idx_party+1}")
-                
-                # Make parties unavailable again if they are too close to an already selected party
-                for selected_party in selected_parties:
-                    close_parties, far_parties = organize_parties(selected_party[1], available_parties, eps)
-                    available_parties = far_parties
-                    unavailable_parties += close_parties
+        # Keep track of how close each party is to the selected parties
+        with stage("distance_scan"):
+            update_min_distances(min_distances, chosen_party_idx, eps)
 
-    return selected_parties
+    count("eps_decay_rounds", num_eps_decays)
+    observe("eps_decay_rounds_per_trial", num_eps_decays)
+
+    return chosen_party_indices
+
+
+@stage("select_parties")
+def select_party_indices_batched(embedding_matrix: np.ndarray, num_parties: int = 10, eps: float = 1.0,
+                                 num_trials: int = 1, verbose: bool = False, rngs: list = None,
+                                 batch_size: int = None) -> np.ndarray:
+    """ Run num_trials selections of select_party_indices_by_embeddings at once. Every trial keeps its own
+    distance from each party to its nearest selected party and its own eps, stored as rows of (trials x parties)
+    arrays. Each selection round picks one party for every trial, and the distances from all new picks to all
+    parties are found with one matrix product, using ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b. Trials without an
+    available party shrink their own eps by 0.8 until they have one.
+
+    The matrix product is not exact, so a distance that is within rounding of eps is checked again with the exact
+    distance. With the same random generator for a trial, the selected parties are the same as from
+    select_party_indices_by_embeddings, including when a party is exactly eps away.
+
+    :param embedding_matrix: the embedding of each party, of shape (number of parties, embedding size)
+    :param num_parties: the number of parties to select in each trial
+    :param eps: the distance all selected parties must be from each other, to start
+    :param num_trials: the number of trials to run
+    :param verbose: print logging info?
+    :param rngs: the random generator of each trial. If None, numpy.random is used.
+    :param batch_size: the number of trials to run at once. If None, trials are batched so the arrays for a batch
+    take about 512 MB.
+    :return: the row indices of the selected parties, of shape (num_trials, num_parties)
+    """
 
+    num_parties = min(num_parties, len(embedding_matrix))
+    if batch_size is None:
+        batch_size = max(1, 2**29 // (20 * max(len(embedding_matrix), 1)))
 
-def organize_parties(chosen_party_embedding: np.ndarray, available_parties: list, eps: float = 1.0) -> (list, list):
+    squared_norms = np.einsum("ij,ij->i", embedding_matrix, embedding_matrix)
+
+    chosen_party_indices = np.zeros((num_trials, num_parties), dtype=np.intp)
+    for start in range(0, num_trials, batch_size):
+        trial_rngs = None if rngs is None else rngs[start:start+batch_size]
+        chosen_party_indices[start:start+batch_size] = _select_party_indices_batch(
+            embedding_matrix, squared_norms, num_parties, eps, min(batch_size, num_trials - start), verbose,
+            trial_rngs)
+
+    return chosen_party_indices
+
+
+def _select_party_indices_batch(embedding_matrix: np.ndarray, squared_norms: np.ndarray, num_parties: int,
+                                eps: float, num_trials: int, verbose: bool, rngs: list or None) -> np.ndarray:
+    """ Run one batch of select_party_indices_batched.
+    :param embedding_matrix: the embedding of each party
+    :param squared_norms: the squared 2-norm of each row of embedding_matrix
+    :param num_parties: the number of parties to select in each trial
+    :param eps: the distance all selected parties must be from each other, to start
+    :param num_trials: the number of trials in the batch
+    :param verbose: print logging info?
+    :param rngs: the random generator of each trial, or None to use numpy.random
+    :return: the row indices of the selected parties, of shape (num_trials, num_parties)
+    """
+
+    # Squared distances from the matrix product are off by far less than this, relative to the squared norms
+    tolerance = np.sqrt(np.finfo(embedding_matrix.dtype).eps) * (1.0 + 4.0 * squared_norms.max(initial=0.0))
+
+    trial_eps = np.full((num_trials, ), float(eps))
+    num_eps_decays = np.zeros((num_trials, ), dtype=int)
+    min_distances = np.full((num_trials, len(embedding_matrix)), np.inf)
+    is_exact = np.ones(min_distances.shape, dtype=bool)
+    is_selected = np.zeros(min_distances.shape, dtype=bool)
+    chosen_party_indices = np.zeros((num_trials, num_parties), dtype=np.intp)
+
+    def find_available(trials: np.ndarray, num_chosen: int) -> np.ndarray:
+        # Decide each party's availability, checking the exact distance when the estimate is too close to call
+        distances = min_distances[trials]
+        trials_eps = trial_eps[trials][:, None]
+        is_uncertain = ~is_exact[trials] & ~is_selected[trials] & \
+            (np.abs(distances**2 - trials_eps**2) <= tolerance)
+        for row, party_idx in zip(*np.nonzero(is_uncertain)):
+            trial = trials[row]
+            chosen_embeddings = embedding_matrix[chosen_party_indices[trial, :num_chosen]]
+            min_distances[trial, party_idx] = norm(embedding_matrix[party_idx] - chosen_embeddings,
+                                                   ord=2, axis=1).min()
+            is_exact[trial, party_idx] = True
+            count("distance_evaluations", num_chosen)
+            distances[row, party_idx] = min_distances[trial, party_idx]
+        return ~is_selected[trials] & (distances >= trials_eps)
+
+    all_trials = np.arange(num_trials)
+    for idx_party in range(0, num_parties):
+
+        # Make sure every trial still has parties available. If not, decrease eps for that trial.
+        is_available = find_available(all_trials, idx_party)
+        num_available = is_available.sum(axis=1)
+        while (num_available == 0).any():
+            trials = np.flatnonzero(num_available == 0)
+            trial_eps[trials] *= 0.8
+            num_eps_decays[trials] += 1
+            if verbose:
+                print(f"Notice: Available parties are too close to selected parties in {len(trials)} trials.")
+            is_available[trials] = find_available(trials, idx_party)
+            num_available[trials] = is_available[trials].sum(axis=1)
+
+        # Select a party for each trial
+        for trial in all_trials:
+            available_indices = np.flatnonzero(is_available[trial])
+            chosen_party_indices[trial, idx_party] = available_indices[
+                _random_index(len(available_indices), None if rngs is None else rngs[trial])]
+        chosen = chosen_party_indices[:, idx_party]
+        is_selected[all_trials, chosen] = True
+
+        # Keep track of how close each party is to the selected parties of each trial
+        with stage("distance_scan"):
+            squared_distances = embedding_matrix[chosen] @ embedding_matrix.T
+            squared_distances *= -2.0
+            squared_distances += squared_norms[chosen][:, None]
+            squared_distances += squared_norms[None, :]
+            np.maximum(squared_distances, 0.0, out=squared_distances)
+            is_exact &= squared_distances > min_distances**2 + tolerance
+            np.minimum(min_distances, np.sqrt(squared_distances), out=min_distances)
+        count("parties_scanned", squared_distances.size)
+        count("distance_evaluations", squared_distances.size)
+
+    count("eps_decay_rounds", int(num_eps_decays.sum()))
+    for trial_decays in num_eps_decays:
+        observe("eps_decay_rounds_per_trial", int(trial_decays))
+
+    return chosen_party_indices
+
+
+def calculate_distances(embedding_matrix: np.ndarray, embedding: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+    """ Calculate the 2-norm distance from embedding to each row of embedding_matrix. The rows are handled in
+    chunks so the temporary differences stay small for large embedding matrices.
+    :param embedding_matrix: the embeddings to compare against, one per row
+    :param embedding: the embedding to compare
+    :param chunk_size: the number of rows to handle at once
+    :return: the distance from embedding to each row of embedding_matrix
+    """
+
+    distances = np.empty((len(embedding_matrix), ), dtype=float)
+    for start in range(0, len(embedding_matrix), chunk_size):
+        chunk = embedding_matrix[start:start+chunk_size]
+        distances[start:start+chunk_size] = norm(chunk - embedding, ord=2, axis=1)
+    return distances
+
+
+def _random_index(size: int, rng: np.random.Generator = None) -> int:
+    """ Draw a random index between 0 and size - 1.
+    :param size: the number of indices to draw from
+    :param rng: the random generator to use. If None, numpy.random is used.
+    :return: the random index
+    """
+
+    if rng is None:
+        return randint(0, size)
+    return rng.integers(0, size)
+
+
+def organize_parties(chosen_party_embedding: np.ndarray, available_parties: list, eps: float = 1.0,
+                     metric: dict = None) -> (list, list):
     """ Given a chosen party and a list of available parties, separate out the parties that are too close
     to the chosen party. Close is defined by an embedding on each party such that the 2-norm is within eps.
     :param chosen_party_embedding: the embedding of the chosen party
     :param available_parties: the parties that are available to be chosen
     :param eps: the distance that defines whether two parties are close
+    :param metric: the metric that defines the distance between parties, see the distances module. If None, the
+    2-norm is used.
     :return: the parties (with their embedding) that are within eps of the chosen party, and the parties
     that are further than eps away. If a party is exactly eps from the chosen party, then it's considered far.
     """
     close_parties = []
     far_parties = []
+    if len(available_parties) == 0:
+        return close_parties, far_parties
+
+    available_embeddings = np.stack([party_embedding for _, party_embedding in available_parties])
+    distances = distances_to_rows(available_embeddings, chosen_party_embedding, metric)[0]
 
-    for party_idx, party_embedding in available_parties:
-        if norm(chosen_party_embedding - party_embedding, ord=2) < eps:
-            close_parties.append((party_idx, party_embedding))
+    for party, distance in zip(available_parties, distances):
+        if distance < eps:
+            close_parties.append(party)
         else:
-            far_parties.append((party_idx, party_embedding))
+            far_parties.append(party)
 
     return close_parties, far_parties
@@ -0,0 +1,335 @@
+import argparse
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+import os
+from time import perf_counter
+import numpy as np
+import pandas as pd
+
+from data import load_data
+from embedding_cache import cached_party_embeddings
+from gauntlet import generate_gauntlet_run_indices
+from select_parties import select_party_indices_by_embeddings, select_party_indices_randomly
+
+RUN_STYLES = ["Regular", "Typhoon", "Volcano", "Meteor"]
+BROKEN_JOBS = ["Summoner", "Black Mage", "Chemist"]
+
+# The methods handle_request answers
+REQUEST_METHODS = ["select_parties_by_embeddings", "select_parties_randomly", "generate_gauntlet_runs"]
+
+# The number of recent requests of each method the latency percentiles are calculated over
+LATENCY_WINDOW = 10000
+
+# The largest request body the server reads
+MAX_BODY_BYTES = 65536
+
+# The most parties and gauntlet runs one request can ask for
+MAX_NUM_PARTIES = 1000
+MAX_NUM_GAUNTLETS = 100
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+def load_server_state(df_jobs: pd.DataFrame, run_styles: list = None, duplicates_options: list = None,
+                      special_weight_jobs: list = None, equip_factor: float = 0.5,
+                      cache_dir: str = "data/cache") -> dict:
+    """ Load everything the assignment server needs once: the job data, and the parties and embeddings of each run
+    style. The embeddings come from embedding_cache.cached_party_embeddings, so they are only calculated the first
+    time a run style is served, and are read into memory so requests never wait on the disk.
+    :param df_jobs: the DataFrame of jobs data
+    :param run_styles: the run styles to serve. If None, all of RUN_STYLES.
+    :param duplicates_options: whether to serve the runs without duplicates (False), with duplicates (True), or
+    both. If None, both.
+    :param special_weight_jobs: jobs to give the special weight in the jobs embedding. If None, BROKEN_JOBS.
+    :param equip_factor: the scaling factor for the equipment embeddings
+    :param cache_dir: the directory of the embedding cache
+    :return: the server state, as a dict
+    """
+
+    run_styles = RUN_STYLES if run_styles is None else run_styles
+    duplicates_options = [False, True] if duplicates_options is None else duplicates_options
+    special_weight_jobs = BROKEN_JOBS if special_weight_jobs is None else special_weight_jobs
+
+    state = {"df_jobs": df_jobs,
+             "job_names": df_jobs.index.to_numpy(),
+             "embedding_sets": {},
+             "latencies": {},
+             "errors": {},
+             "start_time": perf_counter()}
+
+    for run_style in run_styles:
+        for duplicates in duplicates_options:
+            key = _embedding_set_key(run_style, duplicates)
+            if key in state["embedding_sets"]:
+                continue
+            embedding_matrix, party_indices, header = cached_party_embeddings(
+                df_jobs, run_style, duplicates, special_weight_jobs, equip_factor, cache_dir=cache_dir)
+            state["embedding_sets"][key] = {"embedding_matrix": np.array(embedding_matrix),
+                                            "party_indices": np.array(party_indices)}
+
+    return state
+
+
+def handle_request(state: dict, method: str, params: dict) -> dict:
+    """ Answer one request from the warm server state. The methods are:
+        select_parties_by_embeddings: select parties that are far apart, see
+        select_parties.select_party_indices_by_embeddings. Parameters: run_style, duplicates (False), num_parties
+        (10), eps (1.0) and seed (None).
+        select_parties_randomly: select parties randomly, see select_parties.select_party_indices_randomly. Takes
+        the same parameters.
+        generate_gauntlet_runs: generate gauntlet runs, see gauntlet.generate_gauntlet_run_indices. Parameters:
+        run_style, num_gauntlets (1) and seed (None).
+    Every random choice is made with a generator of its own for the request, so requests can run at the same time.
+    Numbers are checked before they are used: eps must be finite and positive, num_parties at most MAX_NUM_PARTIES
+    and num_gauntlets at most MAX_NUM_GAUNTLETS. A request that breaks these raises ValueError.
+    :param state: the server state from load_server_state
+    :param method: the name of the method
+    :param params: the parameters of the request, the JSON object of the request body
+    :return: the response, {"parties": [[job1, job2, job3, job4], ...]} for the selections, and
+    {"gauntlets": [[party, ...], ...]} for gauntlet runs
+    """
+
+    if not isinstance(params, dict):
+        raise ValueError("The request body must be a JSON object")
+    rng = np.random.default_rng(params.get("seed"))
+
+    if method in ["select_parties_by_embeddings", "select_parties_randomly"]:
+        key = _embedding_set_key(params["run_style"], bool(params.get("duplicates", False)))
+        if key not in state["embedding_sets"]:
+            raise ValueError(f"The server doesn't have the parties of {key[0]} runs "
+                             f"{'with' if key[1] else 'without'} duplicates")
+        embedding_set = state["embedding_sets"][key]
+        selector = select_party_indices_by_embeddings if method == "select_parties_by_embeddings" \
+            else select_party_indices_randomly
+        num_parties = _number_param(params, "num_parties", 10, 1, MAX_NUM_PARTIES, is_integer=True)
+        eps = _number_param(params, "eps", 1.0, 0.0, np.inf)
+        if eps <= 0.0:
+            raise ValueError("eps must be positive")
+        rows = selector(embedding_set["embedding_matrix"], num_parties, eps, rng=rng)
+        return {"parties": state["job_names"][embedding_set["party_indices"][rows]].tolist()}
+
+    elif method == "generate_gauntlet_runs":
+        num_gauntlets = _number_param(params, "num_gauntlets", 1, 1, MAX_NUM_GAUNTLETS, is_integer=True)
+        gauntlet_indices = generate_gauntlet_run_indices(params["run_style"], state["df_jobs"], num_gauntlets,
+                                                         rng=rng)
+        return {"gauntlets": state["job_names"][gauntlet_indices].tolist()}
+
+    raise ValueError(f"Unknown method {method}")
+
+
+def record_latency(state: dict, method: str, seconds: float, is_error: bool = False):
+    """ Add the latency of a request to the server state, keeping the last LATENCY_WINDOW of each method.
+    :param state: the server state
+    :param method: the name of the method
+    :param seconds: the time from reading the request to sending the response
+    :param is_error: did the request fail?
+    """
+
+    state["latencies"].setdefault(method, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+    state["errors"][method] = state["errors"].get(method, 0) + int(is_error)
+
+
+def get_latency_metrics(state: dict) -> dict:
+    """ Get the latency percentiles of each method over its recent requests.
+    :param state: the server state
+    :return: a dict with the "uptime_seconds" and, for each method, its "count" of recent requests, its "errors"
+    since the server started, and the "p50_ms", "p99_ms" and "max_ms" of its recent latencies
+    """
+
+    metrics = {"uptime_seconds": perf_counter() - state["start_time"], "methods": {}}
+    for method, latencies in state["latencies"].items():
+        latencies_ms = 1000.0 * np.array(latencies)
+        metrics["methods"][method] = {"count": len(latencies_ms),
+                                      "errors": state["errors"][method],
+                                      "p50_ms": float(np.percentile(latencies_ms, 50)),
+                                      "p99_ms": float(np.percentile(latencies_ms, 99)),
+                                      "max_ms": float(latencies_ms.max())}
+    return metrics
+
+
+async def serve(state: dict, host: str = "127.0.0.1", port: int = 8765, unix_socket: str = None,
+                num_threads: int = 4):
+    """ Serve requests over HTTP until cancelled. Selections are run in a pool of num_threads threads, so several
+    requests are answered at once (numpy releases the GIL for the distance calculations) and the event loop stays
+    free to accept new connections. Requests are:
+        POST /<method> with the parameters as a JSON body, see handle_request
+        GET /metrics for the latency metrics, see get_latency_metrics
+        GET /health
+    Responses are JSON, with {"error": message} and a 4xx or 5xx status when a request fails.
+    :param state: the server state from load_server_state
+    :param host: the host to listen on
+    :param port: the port to listen on
+    :param unix_socket: a Unix socket path to listen on instead of host and port
+    :param num_threads: the number of threads to run selections in
+    """
+
+    executor = ThreadPoolExecutor(max_workers=num_threads)
+
+    async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await _handle_connection(state, executor, reader, writer)
+        finally:
+            writer.close()
+
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = await asyncio.start_unix_server(handle_connection, path=unix_socket)
+    else:
+        server = await asyncio.start_server(handle_connection, host=host, port=port)
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        executor.shutdown(wait=False)
+
+
+async def _handle_connection(state: dict, executor: ThreadPoolExecutor, reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter):
+    """ Answer the HTTP requests of one connection, keeping it open between requests unless asked not to.
+    :param state: the server state
+    :param executor: the thread pool to run requests in
+    :param reader: the stream to read requests from
+    :param writer: the stream to write responses to
+    """
+
+    while True:
+        try:
+            request_line = await reader.readline()
+            if len(request_line) == 0:
+                return
+            http_method, path, version = request_line.decode("latin-1").split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in [b"\r\n", b"\n", b""]:
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+        except (ValueError, ConnectionError):
+            return
+
+        start = perf_counter()
+        method = path.strip("/")
+        status = 200
+        try:
+            content_length = int(headers.get("content-length", 0))
+            if content_length > MAX_BODY_BYTES:
+                status, response = 413, {"error": f"The request body is larger than {MAX_BODY_BYTES} bytes"}
+                await _write_response(writer, status, response, close=True)
+                return
+            body = await reader.readexactly(content_length)
+
+            if http_method == "GET" and method == "health":
+                response = {"status": "ok", "embedding_sets": [list(key) for key in state["embedding_sets"]]}
+            elif http_method == "GET" and method == "metrics":
+                response = get_latency_metrics(state)
+            elif method not in REQUEST_METHODS:
+                status, response = 404, {"error": f"Unknown method {method}"}
+            elif http_method != "POST":
+                status, response = 405, {"error": f"Use POST for {path}"}
+            else:
+                params = json.loads(body) if len(body) > 0 else {}
+                response = await asyncio.get_running_loop().run_in_executor(executor, handle_request, state,
+                                                                            method, params)
+        except KeyError as e:
+            status, response = 400, {"error": f"Missing parameter {e.args[0]}"}
+        except (ValueError, TypeError) as e:
+            status, response = 400, {"error": str(e)}
+        except asyncio.IncompleteReadError:
+            return
+        except Exception as e:
+            status, response = 500, {"error": repr(e)}
+
+        close = headers.get("connection", "").lower() == "close" or version == "HTTP/1.0"
+        try:
+            await _write_response(writer, status, response, close)
+        except ConnectionError:
+            return
+        if method in REQUEST_METHODS:
+            record_latency(state, method, perf_counter() - start, status != 200)
+        if close:
+            return
+
+
+async def _write_response(writer: asyncio.StreamWriter, status: int, response: dict, close: bool):
+    """ Write an HTTP response with a JSON body.
+    :param writer: the stream to write to
+    :param status: the HTTP status code
+    :param response: the body, to be written as JSON
+    :param close: will the connection be closed after the response?
+    """
+
+    body = json.dumps(response).encode()
+    head = (f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n")
+    writer.write(head.encode("latin-1") + body)
+    await writer.drain()
+
+
+def _number_param(params: dict, name: str, default: float, lowest: float, highest: float,
+                  is_integer: bool = False) -> float or int:
+    """ Get a number from the parameters of a request, checking that it is finite and within a range. JSON allows
+    Infinity and NaN, which would make a selection never finish.
+    :param params: the parameters of the request
+    :param name: the name of the parameter
+    :param default: the value if the parameter isn't given
+    :param lowest: the smallest allowed value
+    :param highest: the largest allowed value
+    :param is_integer: the value must be a whole number
+    :return: the value, as an int if is_integer
+    """
+
+    value = params.get(name, default)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+            (isinstance(value, float) and not math.isfinite(value)):
+        raise ValueError(f"{name} must be a finite number")
+    if is_integer and value != int(value):
+        raise ValueError(f"{name} must be a whole number")
+    if not lowest <= value <= highest:
+        raise ValueError(f"{name} must be between {lowest} and {highest}")
+    return int(value) if is_integer else float(value)
+
+
+def _embedding_set_key(run_style: str, duplicates: bool) -> (str, bool):
+    """ Get the key of the parties of a run style in the server state. Regular runs have the same parties with or
+    without duplicates, so they share a key.
+    :param run_style: the run style
+    :param duplicates: flag to allow duplicates
+    :return: the key
+    """
+
+    return run_style, duplicates and run_style != "Regular"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve party selections from embeddings kept in memory.")
+    parser.add_argument("--jobs", default="data_jobs/job_data_embeddings.csv")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix-socket", default=None, help="listen on this Unix socket instead of host and port")
+    parser.add_argument("--run-styles", nargs="+", default=RUN_STYLES)
+    parser.add_argument("--duplicates", choices=["no", "yes", "both"], default="both")
+    parser.add_argument("--equip-factor", type=float, default=0.5)
+    parser.add_argument("--cache-dir", default="data/cache")
+    parser.add_argument("--num-threads", type=int, default=4)
+    args = parser.parse_args()
+
+    df_jobs, stat_cols = load_data(args.jobs)
+    duplicates_options = {"no": [False], "yes": [True], "both": [False, True]}[args.duplicates]
+    start = perf_counter()
+    server_state = load_server_state(df_jobs, args.run_styles, duplicates_options, BROKEN_JOBS, args.equip_factor,
+                                     args.cache_dir)
+    print(f"Loaded {len(server_state['embedding_sets'])} sets of parties in {perf_counter() - start:.1f} seconds.")
+    print(f"Listening on {args.unix_socket or f'http://{args.host}:{args.port}'}")
+    try:
+        asyncio.run(serve(server_state, args.host, args.port, args.unix_socket, args.num_threads))
+    except KeyboardInterrupt:
+        pass
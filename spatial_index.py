@@ -0,0 +1,128 @@
+import numpy as np
+from numpy.linalg import norm
+
+from instrumentation import count
+
+
+def build_ball_tree(embedding_matrix: np.ndarray, leaf_size: int = 32) -> dict:
+    """ Build a ball tree over the rows of embedding_matrix, so that all parties within eps of a given
+    embedding can be found without calculating the distance to every party. The tree is built once per
+    embedding set and can be saved next to the embeddings with save_ball_tree.
+
+    Each node covers a contiguous range of the "order" array, which holds row indices into embedding_matrix.
+    A node is split in half at the median of its parties projected onto the line between two far apart
+    parties, until it has at most leaf_size parties. Every node stores a center (the mean of its parties) and a
+    radius (the largest distance from the center to one of its parties).
+
+    :param embedding_matrix: the embedding of each party, of shape (number of parties, embedding size)
+    :param leaf_size: the largest number of parties in a leaf node
+    :return: the tree as a dict of arrays: "order", "node_start", "node_end", "node_children" (-1 for leaves),
+    "node_centers" and "node_radii"
+    """
+
+    num_parties = len(embedding_matrix)
+    order = np.arange(num_parties)
+    node_start = [0]
+    node_end = [num_parties]
+    node_children = [[-1, -1]]
+
+    nodes_to_split = [0]
+    while len(nodes_to_split) > 0:
+        node = nodes_to_split.pop()
+        start, end = node_start[node], node_end[node]
+        if end - start <= leaf_size:
+            continue
+
+        # Split along the line between two far apart parties: the party furthest from the first one, and
+        # the party furthest from that
+        points = embedding_matrix[order[start:end]]
+        pivot_a = points[np.argmax(norm(points - points[0], ord=2, axis=1))]
+        pivot_b = points[np.argmax(norm(points - pivot_a, ord=2, axis=1))]
+        if np.array_equal(pivot_a, pivot_b):
+            continue  # All parties in the node have the same embedding
+
+        half = (end - start) // 2
+        order[start:end] = order[start:end][np.argpartition(points @ (pivot_b - pivot_a), half)]
+
+        node_children[node] = [len(node_start), len(node_start) + 1]
+        for child_start, child_end in [(start, start + half), (start + half, end)]:
+            nodes_to_split.append(len(node_start))
+            node_start.append(child_start)
+            node_end.append(child_end)
+            node_children.append([-1, -1])
+
+    node_centers = np.zeros((len(node_start), embedding_matrix.shape[1]), dtype=float)
+    node_radii = np.zeros((len(node_start), ), dtype=float)
+    for node, (start, end) in enumerate(zip(node_start, node_end)):
+        points = embedding_matrix[order[start:end]]
+        node_centers[node] = points.mean(axis=0)
+        node_radii[node] = norm(points - node_centers[node], ord=2, axis=1).max()
+
+    # Pad the radii a little so rounding never prunes a party that is just inside eps
+    node_radii = node_radii * (1.0 + 1e-9) + 1e-12
+
+    return {"order": order,
+            "node_start": np.array(node_start),
+            "node_end": np.array(node_end),
+            "node_children": np.array(node_children),
+            "node_centers": node_centers,
+            "node_radii": node_radii}
+
+
+def query_radius(tree: dict, embedding_matrix: np.ndarray, embedding: np.ndarray, eps: float) -> (np.ndarray, np.ndarray):
+    """ Find the parties that are closer than eps to embedding (in 2-norm). A party exactly eps away is not
+    included, the same as the definition of close in select_parties.organize_parties.
+
+    The tree is searched one level at a time. Nodes whose ball is at least eps away from embedding are skipped,
+    and exact distances are only calculated for the parties in the remaining leaves.
+
+    :param tree: the ball tree from build_ball_tree
+    :param embedding_matrix: the embedding matrix the tree was built from
+    :param embedding: the embedding to search around
+    :param eps: the radius to search within
+    :return: the row indices of the close parties and their distances to embedding
+    """
+
+    leaves = []
+    nodes = np.array([0])
+    while len(nodes) > 0:
+        count("tree_nodes_visited", len(nodes))
+        center_distances = norm(tree["node_centers"][nodes] - embedding, ord=2, axis=1)
+        nodes = nodes[center_distances - tree["node_radii"][nodes] < eps]
+
+        is_leaf = tree["node_children"][nodes, 0] == -1
+        leaves.append(nodes[is_leaf])
+        nodes = tree["node_children"][nodes[~is_leaf]].ravel()
+
+    leaves = np.concatenate(leaves)
+    if len(leaves) == 0:
+        return np.zeros((0, ), dtype=int), np.zeros((0, ), dtype=float)
+
+    candidates = np.concatenate([tree["order"][start:end]
+                                 for start, end in zip(tree["node_start"][leaves], tree["node_end"][leaves])])
+    distances = norm(embedding_matrix[candidates] - embedding, ord=2, axis=1)
+    is_close = distances < eps
+    count("parties_scanned", len(candidates))
+    count("distance_evaluations", len(candidates))
+
+    return candidates[is_close], distances[is_close]
+
+
+def save_ball_tree(filename: str, tree: dict):
+    """ Saves a ball tree to a .npz file. A good place is next to the embedding store it was built from, e.g.
+    "embeddings_meteor_eq0.5.balltree.npz" next to "embeddings_meteor_eq0.5.npy".
+    :param filename: the filename to save the tree
+    :param tree: the ball tree from build_ball_tree
+    """
+
+    np.savez(filename, **tree)
+
+
+def load_ball_tree(filename: str) -> dict:
+    """ Loads a ball tree saved with save_ball_tree.
+    :param filename: the filename of the saved tree
+    :return: the ball tree
+    """
+
+    with np.load(filename) as saved_tree:
+        return {key: saved_tree[key] for key in saved_tree.files}
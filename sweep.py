@@ -0,0 +1,195 @@
+import argparse
+import hashlib
+from itertools import product
+import json
+import os
+from time import perf_counter
+import numpy as np
+import pandas as pd
+
+from data import load_data
+from embedding_cache import embedding_cache_key
+from embeddings import (calculate_party_embedding_blocks, combine_embedding_blocks, set_equip_factor,
+                        set_special_weight_jobs)
+from experiment import run_trials_shared
+from generate_possible_parties import generate_possible_party_indices, party_indices_to_names
+
+# The values used for parameters that are not in a sweep grid
+DEFAULT_SWEEP_GRID = {"run_style": ["Regular"],
+                      "duplicates": [False],
+                      "special_weight_jobs": [[]],
+                      "equip_factor": [1.0],
+                      "num_parties": [10],
+                      "eps": [1.0]}
+
+
+def run_sweep(df_jobs: pd.DataFrame, grid: dict, output_filename: str, num_trials: int = 100, num_procs: int = 1,
+              seed: int = 0, batched: bool = False, verbose: bool = False) -> pd.DataFrame:
+    """ Run trials for every combination of the parameters in grid, e.g.
+        {"run_style": ["Regular", "Meteor"], "equip_factor": [0.5, 1.0], "eps": [2.0, 3.0, 4.0],
+         "special_weight_jobs": [[], ["Summoner", "Black Mage", "Chemist"]]}
+    Parameters that are not in grid take their values from DEFAULT_SWEEP_GRID.
+
+    The work is ordered so configurations that share data run back to back (see expand_sweep_grid). The parties
+    and the embedding blocks of each run style are calculated once, and the embedding matrix of each equip_factor
+    and special weight jobs is made from them by only rewriting the columns that change. The trials of each
+    configuration are fanned out over num_procs processes with experiment.run_trials_shared, keeping only
+    aggregated statistics.
+
+    Each finished configuration is appended as a row of the csv file output_filename, with its parameters, the
+    diversity metrics of sweep_metrics and its timings. When a sweep is run again, configurations that are already
+    in output_filename (with the same job data, num_trials and seed) are skipped.
+
+    All configurations use the same seed, so their trials start from the same random picks, which makes
+    differences between configurations less noisy.
+
+    :param df_jobs: the DataFrame of jobs data
+    :param grid: the values to try for each parameter: "run_style", "duplicates", "special_weight_jobs",
+    "equip_factor", "num_parties" and "eps"
+    :param output_filename: the csv file of results
+    :param num_trials: the number of trials per configuration
+    :param num_procs: the number of processes to run trials in
+    :param seed: the seed of the trials of every configuration
+    :param batched: run the trials with select_parties.select_party_indices_batched
+    :param verbose: print each configuration as it runs
+    :return: the results of every configuration in output_filename, including ones from earlier runs
+    """
+
+    configurations = expand_sweep_grid(grid)
+    finished_ids = set()
+    if os.path.exists(output_filename):
+        finished_ids = set(pd.read_csv(output_filename, dtype={"config_id": str})["config_id"])
+
+    current_party_set = None
+    for configuration in configurations:
+        config_id = sweep_config_id(df_jobs, configuration, num_trials, seed)
+        if config_id in finished_ids:
+            continue
+
+        # Build the party set when the run style changes, and only rewrite the embeddings for new weights
+        start = perf_counter()
+        party_set = (configuration["run_style"], configuration["duplicates"])
+        if party_set != current_party_set:
+            party_indices = generate_possible_party_indices(configuration["run_style"], df_jobs,
+                                                            configuration["duplicates"])
+            party_names = party_indices_to_names(party_indices, df_jobs)
+            blocks = calculate_party_embedding_blocks(party_indices, df_jobs)
+            embedding_matrix = combine_embedding_blocks(blocks, configuration["special_weight_jobs"],
+                                                        configuration["equip_factor"])
+            current_party_set = party_set
+        else:
+            set_equip_factor(embedding_matrix, blocks, configuration["equip_factor"])
+            set_special_weight_jobs(embedding_matrix, blocks, configuration["special_weight_jobs"])
+        embedding_seconds = perf_counter() - start
+
+        if verbose:
+            print(f"Running {configuration}")
+        start = perf_counter()
+        summary = run_trials_shared(embedding_matrix, party_names, configuration["num_parties"], num_trials,
+                                    configuration["eps"], num_procs=num_procs, seed=seed, batched=batched,
+                                    aggregate=True)
+        trial_seconds = perf_counter() - start
+
+        result = {"config_id": config_id,
+                  **configuration,
+                  "special_weight_jobs": json.dumps(configuration["special_weight_jobs"]),
+                  "num_trials": num_trials,
+                  "seed": seed,
+                  "num_valid_parties": len(party_names),
+                  **sweep_metrics(summary, len(df_jobs)),
+                  "embedding_seconds": embedding_seconds,
+                  "trial_seconds": trial_seconds}
+        pd.DataFrame([result]).to_csv(output_filename, mode="a", index=False,
+                                      header=not os.path.exists(output_filename))
+        finished_ids.add(config_id)
+
+    return pd.read_csv(output_filename, dtype={"config_id": str})
+
+
+def expand_sweep_grid(grid: dict) -> list:
+    """ Get every combination of the parameters in a sweep grid, ordered so that configurations sharing a party set
+    (run style and duplicates) are together, and within those, configurations sharing an embedding matrix
+    (special weight jobs and equip_factor).
+    :param grid: the values to try for each parameter. Missing parameters take their values from
+    DEFAULT_SWEEP_GRID.
+    :return: a list of configurations, each a dict with one value for each parameter
+    """
+
+    unknown_parameters = set(grid) - set(DEFAULT_SWEEP_GRID)
+    if len(unknown_parameters) > 0:
+        raise ValueError(f"Unknown sweep parameters {sorted(unknown_parameters)}")
+
+    grid = {**DEFAULT_SWEEP_GRID, **grid}
+    parameters = list(DEFAULT_SWEEP_GRID)
+    configurations = [dict(zip(parameters, values)) for values in product(*[grid[name] for name in parameters])]
+    for configuration in configurations:
+        configuration["special_weight_jobs"] = sorted(configuration["special_weight_jobs"])
+
+    return sorted(configurations, key=lambda c: (c["run_style"], c["duplicates"], c["special_weight_jobs"],
+                                                  c["equip_factor"], c["num_parties"], c["eps"]))
+
+
+def sweep_config_id(df_jobs: pd.DataFrame, configuration: dict, num_trials: int, seed: int) -> str:
+    """ Get an id for the results of a configuration, which changes if anything the results depend on changes,
+    including the job data.
+    :param df_jobs: the DataFrame of jobs data
+    :param configuration: the configuration, from expand_sweep_grid
+    :param num_trials: the number of trials
+    :param seed: the seed of the trials
+    :return: the id, as a hex string
+    """
+
+    embedding_key = embedding_cache_key(df_jobs, configuration["run_style"], configuration["duplicates"],
+                                        configuration["special_weight_jobs"], configuration["equip_factor"])
+    settings = {"num_parties": configuration["num_parties"], "eps": float(configuration["eps"]),
+                "num_trials": num_trials, "seed": seed}
+    return hashlib.sha256((embedding_key + json.dumps(settings, sort_keys=True)).encode()).hexdigest()[:16]
+
+
+def sweep_metrics(summary: dict, num_jobs: int) -> dict:
+    """ Get the diversity metrics of a configuration from the summary of its trials.
+        distance_mean, distance_std: the distances between the parties of a trial
+        min_distance_median: the median over trials of the smallest distance between two parties of a trial,
+        from the histogram, so only as accurate as its bins
+        job_coverage: the share of jobs that were selected at least once
+        job_evenness: the entropy of the job frequencies divided by its largest possible value, 1 if every job is
+        selected equally often
+    :param summary: the summary from experiment.summarize_trial_statistics
+    :param num_jobs: the number of jobs in the job data
+    :return: the metrics
+    """
+
+    histogram = summary["min_distance_histogram"]
+    edges = summary["histogram_edges"]
+    if histogram.sum() > 0:
+        median_bin = np.searchsorted(np.cumsum(histogram), histogram.sum() / 2.0)
+        min_distance_median = (edges[median_bin] + edges[median_bin + 1]) / 2.0
+    else:
+        min_distance_median = float("nan")
+
+    frequencies = np.array(list(summary["job_frequency"].values()))
+    entropy = -(frequencies * np.log(frequencies)).sum()
+    return {"distance_mean": summary["distance_mean"],
+            "distance_std": np.sqrt(summary["distance_variance"]),
+            "min_distance_median": min_distance_median,
+            "job_coverage": len(summary["job_counts"]) / num_jobs,
+            "job_evenness": entropy / np.log(num_jobs) if num_jobs > 1 else 1.0}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run trials for every combination of a grid of parameters.")
+    parser.add_argument("grid", help="a json file with the values to try for each parameter, see run_sweep")
+    parser.add_argument("--jobs", default="data_jobs/job_data_embeddings.csv")
+    parser.add_argument("--output", default="sweep_results.csv")
+    parser.add_argument("--num-trials", type=int, default=100)
+    parser.add_argument("--num-procs", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batched", action="store_true")
+    args = parser.parse_args()
+
+    df_jobs, stat_cols = load_data(args.jobs)
+    with open(args.grid) as f:
+        grid = json.load(f)
+    results = run_sweep(df_jobs, grid, args.output, args.num_trials, args.num_procs, args.seed, args.batched,
+                        verbose=True)
+    print(results.to_string())
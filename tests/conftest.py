@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from data import load_data  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def df_jobs():
+    df_jobs, _ = load_data(os.path.join(REPO_DIR, "data_jobs", "job_data_embeddings.csv"))
+    return df_jobs
+
+
+@pytest.fixture(scope="session")
+def typhoon_embeddings(df_jobs):
+    from embeddings import calculate_party_embedding_matrix
+    from generate_possible_parties import generate_possible_party_indices
+
+    return calculate_party_embedding_matrix(generate_possible_party_indices("Typhoon", df_jobs), df_jobs)
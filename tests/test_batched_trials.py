@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from experiment import run_trials_shared, trial_rng
+from select_parties import select_party_indices_batched, select_party_indices_by_embeddings
+
+
+@pytest.mark.parametrize("eps", [1.0, 3.0, 6.0])
+def test_batched_selection_matches_per_trial_selection(typhoon_embeddings, eps):
+    seed, num_trials, num_parties = 7, 12, 8
+    expected = np.array([select_party_indices_by_embeddings(typhoon_embeddings, num_parties, eps,
+                                                            rng=trial_rng(seed, t)) for t in range(num_trials)])
+    batched = select_party_indices_batched(typhoon_embeddings, num_parties, eps, num_trials=num_trials,
+                                           rngs=[trial_rng(seed, t) for t in range(num_trials)], batch_size=5)
+    assert np.array_equal(batched, expected)
+
+
+def test_batched_trials_match_per_trial_trials(typhoon_embeddings):
+    party_names = [str(i) for i in range(len(typhoon_embeddings))]
+    settings = {"num_parties": 6, "num_trials": 10, "eps": 4.0, "seed": 3, "chunk_size": 4}
+    trials = run_trials_shared(typhoon_embeddings, party_names, should_generate_matrix=True, **settings)
+    batched_trials = run_trials_shared(typhoon_embeddings, party_names, should_generate_matrix=True, batched=True,
+                                       **settings)
+
+    assert [parties for parties, _ in batched_trials] == [parties for parties, _ in trials]
+    for (_, matrix), (_, batched_matrix) in zip(trials, batched_trials):
+        assert np.allclose(batched_matrix, matrix)
+
+
+def test_batched_trials_reject_an_index(typhoon_embeddings):
+    with pytest.raises(AssertionError):
+        run_trials_shared(typhoon_embeddings, [], 6, 2, 4.0, batched=True, index={})
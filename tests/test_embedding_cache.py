@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+import pytest
+
+from embedding_cache import cached_party_embeddings, embedding_cache_key, evict_embedding_cache
+
+
+@pytest.mark.parametrize("corrupt_filename", ["embeddings.json", "embeddings.parties.npy", "embeddings.npy"])
+def test_corrupt_entry_is_added_again(df_jobs, tmp_path, corrupt_filename):
+    cache_dir = str(tmp_path)
+    expected_matrix, expected_party_indices, _ = cached_party_embeddings(df_jobs, "Regular", cache_dir=cache_dir)
+    entry_dir = os.path.join(cache_dir, embedding_cache_key(df_jobs, "Regular"))
+    os.remove(os.path.join(entry_dir, corrupt_filename))
+
+    embedding_matrix, party_indices, _ = cached_party_embeddings(df_jobs, "Regular", cache_dir=cache_dir)
+    assert np.array_equal(embedding_matrix, expected_matrix)
+    assert np.array_equal(party_indices, expected_party_indices)
+    assert os.path.exists(os.path.join(entry_dir, corrupt_filename))
+
+
+def test_truncated_entry_is_added_again(df_jobs, tmp_path):
+    cache_dir = str(tmp_path)
+    # Copy the arrays, since reading a memory map of a truncated file crashes
+    expected_matrix = np.array(cached_party_embeddings(df_jobs, "Regular", cache_dir=cache_dir)[0])
+    entry_filename = os.path.join(cache_dir, embedding_cache_key(df_jobs, "Regular"), "embeddings.npy")
+    with open(entry_filename, "r+b") as f:
+        f.truncate(1000)
+
+    embedding_matrix, _, _ = cached_party_embeddings(df_jobs, "Regular", cache_dir=cache_dir)
+    assert np.array_equal(embedding_matrix, expected_matrix)
+
+
+def test_eviction_removes_entries_and_interrupted_removals(df_jobs, tmp_path):
+    cache_dir = str(tmp_path)
+    expected_matrix, _, _ = cached_party_embeddings(df_jobs, "Regular", cache_dir=cache_dir)
+    os.makedirs(os.path.join(cache_dir, ".interrupted.0.evict", "part"))
+    evict_embedding_cache(cache_dir, max_bytes=0)
+    assert os.listdir(cache_dir) == []
+
+    # Arrays that were already returned stay readable
+    assert expected_matrix.sum() > 0
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from embeddings import calculate_party_embeddings
+from generate_possible_parties import generate_possible_parties
+
+STAT_COLS = ["Strength", "Agility", "Vitality", "Magic"]
+
+
+@pytest.mark.parametrize("run_style", ["Regular", "Typhoon", "Volcano"])
+@pytest.mark.parametrize("duplicates", [False, True])
+@pytest.mark.parametrize("special_weight_jobs,equip_factor", [([], 1.0),
+                                                              (["Summoner", "Black Mage", "Freelancer"], 0.5)])
+def test_batch_embeddings_match_per_party_embeddings(df_jobs, run_style, duplicates, special_weight_jobs,
+                                                     equip_factor):
+    # The per-party path is slow, so check a spread of parties. Parties are ordered by their first job, so the
+    # spread includes parties that fall back on the Freelancer.
+    valid_parties = generate_possible_parties(run_style, df_jobs, duplicates)
+    valid_parties = [valid_parties[i] for i in np.unique(np.linspace(0, len(valid_parties) - 1, num=250,
+                                                                     dtype=np.int64))]
+
+    expected = calculate_party_embeddings(valid_parties, df_jobs, STAT_COLS, special_weight_jobs, equip_factor)
+    batched = calculate_party_embeddings(valid_parties, df_jobs, STAT_COLS, special_weight_jobs, equip_factor,
+                                         batch=True)
+
+    assert [name for name, _ in batched] == [name for name, _ in expected]
+    assert np.array_equal(np.stack([embedding for _, embedding in batched]),
+                          np.stack([embedding for _, embedding in expected]))
+
+
+def test_batch_embeddings_reject_unknown_jobs(df_jobs):
+    assert calculate_party_embeddings([], df_jobs, STAT_COLS, batch=True) == []
+    with pytest.raises(KeyError):
+        calculate_party_embeddings([["Knight", "Monk", "Gladiator", "Thief"]], df_jobs, STAT_COLS, batch=True)
@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+from data import load_party_embedding_store, save_party_embedding_store
+from embeddings import calculate_party_embedding_matrix
+from generate_possible_parties import generate_possible_party_indices
+from incremental_embeddings import build_job_party_index, diff_job_tables, job_party_rows, \
+    update_party_embedding_store
+
+SPECIAL_WEIGHT_JOBS = ["Summoner", "Black Mage", "Chemist"]
+EQUIP_FACTOR = 0.5
+
+
+def edit_equip(df_jobs):
+    df_jobs.loc["Knight", "Bows"] = 1
+
+
+def edit_style(df_jobs):
+    df_jobs.loc["Thief", "Style"] = "Heavy"
+
+
+def edit_freelancer(df_jobs):
+    df_jobs.loc["Freelancer", "Whips"] = 0
+
+
+def edit_crystal(df_jobs):
+    df_jobs.loc["Knight", "Crystal"] = "Fire"
+
+
+def edit_stats(df_jobs):
+    df_jobs.loc["Knight", "Strength"] = 99
+
+
+def remove_job(df_jobs):
+    return df_jobs.drop(index="Ninja")
+
+
+def add_job(df_jobs):
+    df_jobs.loc["Gladiator"] = df_jobs.loc["Knight"]
+    df_jobs.loc["Gladiator", "Crystal"] = "Earth"
+    df_jobs.loc["Gladiator", "Bows"] = 1
+
+
+def remove_freelancer(df_jobs):
+    return df_jobs.drop(index="Freelancer")
+
+
+def reorder_jobs(df_jobs):
+    return df_jobs.sort_index(ascending=False)
+
+
+def add_equip_column(df_jobs):
+    df_jobs["Guns"] = 0
+    df_jobs.loc["Ranger", "Guns"] = 1
+
+
+def mixed_edits(df_jobs):
+    df_jobs = df_jobs.drop(index="Ninja")
+    df_jobs.loc["Oracle"] = df_jobs.loc["Summoner"]
+    df_jobs.loc["Knight", "Bows"] = 1
+    return df_jobs
+
+
+EDITS = [edit_equip, edit_style, edit_freelancer, edit_crystal, edit_stats, remove_job, add_job, remove_freelancer,
+         reorder_jobs, add_equip_column, mixed_edits]
+
+
+def edited(df_jobs, edit):
+    df_edited = df_jobs.copy()
+    result = edit(df_edited)
+    return df_edited if result is None else result
+
+
+@pytest.mark.parametrize("run_style,duplicates", [("Regular", False), ("Typhoon", False), ("Volcano", True)])
+@pytest.mark.parametrize("edit", EDITS)
+def test_update_matches_full_rebuild(df_jobs, tmp_path, run_style, duplicates, edit):
+    df_new = edited(df_jobs, edit)
+    filename = str(tmp_path / "embeddings.npy")
+    party_indices = generate_possible_party_indices(run_style, df_jobs, duplicates)
+    save_party_embedding_store(filename, calculate_party_embedding_matrix(party_indices, df_jobs, SPECIAL_WEIGHT_JOBS,
+                                                                          EQUIP_FACTOR),
+                               party_indices, list(df_jobs.index), run_style, duplicates, EQUIP_FACTOR,
+                               SPECIAL_WEIGHT_JOBS)
+
+    expected_party_indices = generate_possible_party_indices(run_style, df_new, duplicates)
+    try:
+        expected_matrix = calculate_party_embedding_matrix(expected_party_indices, df_new, SPECIAL_WEIGHT_JOBS,
+                                                           EQUIP_FACTOR)
+    except KeyError:
+        # Some parties need the Freelancer fallback, so the update can't work either
+        with pytest.raises(KeyError):
+            update_party_embedding_store(filename, df_jobs, df_new)
+        return
+
+    result = update_party_embedding_store(filename, df_jobs, df_new)
+    embedding_matrix, party_indices, header = load_party_embedding_store(filename)
+
+    assert np.array_equal(party_indices, expected_party_indices)
+    assert np.array_equal(embedding_matrix, expected_matrix)
+    assert header["jobs"] == list(df_new.index)
+    assert result["num_parties"] == len(expected_party_indices)
+    assert result["recalculated"] + result["copied"] == len(expected_party_indices)
+    if edit is edit_stats:
+        assert result["recalculated"] == 0 and result["in_place"]
+
+
+def test_stats_changes_are_not_embedding_changes(df_jobs):
+    diff = diff_job_tables(df_jobs, edited(df_jobs, edit_stats))
+    assert diff["changed_jobs"] == [] and not diff["freelancer_changed"]
+    assert diff_job_tables(df_jobs, edited(df_jobs, edit_crystal))["crystal_changed_jobs"] == ["Knight"]
+
+
+def test_job_party_index_finds_every_party_with_a_job(df_jobs):
+    party_indices = generate_possible_party_indices("Meteor", df_jobs, True)
+    index = build_job_party_index(party_indices, len(df_jobs))
+    for job in range(len(df_jobs)):
+        assert np.array_equal(index["rows"][index["offsets"][job]:index["offsets"][job+1]],
+                              np.flatnonzero((party_indices == job).any(axis=1)))
+    assert np.array_equal(job_party_rows(index, [3, 5]),
+                          np.flatnonzero(((party_indices == 3) | (party_indices == 5)).any(axis=1)))
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from party_clusters import build_party_clusters, load_party_clusters, save_party_clusters
+from select_parties import select_party_indices_by_embeddings, select_party_indices_clustered
+
+
+@pytest.fixture(scope="module")
+def typhoon_clusters(typhoon_embeddings):
+    return build_party_clusters(typhoon_embeddings, num_iterations=5)
+
+
+def test_clusters_cover_every_party(typhoon_embeddings, typhoon_clusters):
+    assert np.array_equal(np.sort(typhoon_clusters["order"]), np.arange(len(typhoon_embeddings)))
+    for cluster, (start, end) in enumerate(zip(typhoon_clusters["cluster_start"], typhoon_clusters["cluster_end"])):
+        rows = typhoon_clusters["order"][start:end]
+        assert np.all(typhoon_clusters["cluster_ids"][rows] == cluster)
+        distances = np.linalg.norm(typhoon_embeddings[rows] - typhoon_clusters["centers"][cluster], axis=1)
+        assert np.all(distances <= typhoon_clusters["radii"][cluster])
+
+
+@pytest.mark.parametrize("eps", [1.0, 2.5, 4.0, 6.0])
+@pytest.mark.parametrize("max_scan_fraction", [0.5, 1.0])
+def test_clustered_selection_matches_brute_force(typhoon_embeddings, typhoon_clusters, eps, max_scan_fraction):
+    for seed in range(3):
+        expected = select_party_indices_by_embeddings(typhoon_embeddings, 10, eps, rng=np.random.default_rng(seed))
+        clustered = select_party_indices_clustered(typhoon_embeddings, typhoon_clusters, 10, eps,
+                                                   rng=np.random.default_rng(seed),
+                                                   max_scan_fraction=max_scan_fraction)
+        assert np.array_equal(clustered, expected)
+
+
+def test_saved_clusters_load_the_same(typhoon_clusters, tmp_path):
+    filename = str(tmp_path / "embeddings.clusters.npz")
+    save_party_clusters(filename, typhoon_clusters)
+    loaded_clusters = load_party_clusters(filename)
+    assert loaded_clusters.keys() == typhoon_clusters.keys()
+    for key, value in typhoon_clusters.items():
+        assert np.array_equal(loaded_clusters[key], value)
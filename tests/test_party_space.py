@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from generate_possible_parties import generate_possible_party_indices
+from party_space import count_parties, iter_party_chunks, make_party_space, rank_parties, sample_parties, \
+    unrank_parties
+
+CONSTRAINTS = [(None, None), (["Knight"], None), (None, ["Monk"]), (["Thief", "Freelancer"], ["Monk", "Dancer"])]
+
+
+def expected_parties(df_jobs, run, duplicates, excluded_jobs, required_jobs):
+    """ The parties of a space, by filtering every generated party. """
+
+    party_indices = generate_possible_party_indices(run, df_jobs, duplicates)
+    is_kept = ~np.isin(party_indices, df_jobs.index.get_indexer(excluded_jobs or [])).any(axis=1)
+    for job in df_jobs.index.get_indexer(required_jobs or []):
+        is_kept &= (party_indices == job).any(axis=1)
+    return party_indices[is_kept]
+
+
+@pytest.mark.parametrize("run", ["Regular", "Typhoon", "Volcano"])
+@pytest.mark.parametrize("duplicates", [False, True])
+@pytest.mark.parametrize("excluded_jobs,required_jobs", CONSTRAINTS)
+def test_party_space_matches_generated_parties(df_jobs, run, duplicates, excluded_jobs, required_jobs):
+    expected = expected_parties(df_jobs, run, duplicates, excluded_jobs, required_jobs)
+    space = make_party_space(run, df_jobs, duplicates, excluded_jobs, required_jobs)
+
+    assert count_parties(space) == len(expected)
+    assert np.array_equal(np.concatenate(list(iter_party_chunks(space, chunk_size=997)) +
+                                         [np.zeros((0, 4), dtype=space["dtype"])]), expected)
+
+    # Ranking every party one at a time is slow for the larger spaces, so check a spread of ranks
+    ranks = np.unique(np.linspace(0, len(expected) - 1, num=min(len(expected), 300), dtype=np.int64))
+    assert np.array_equal(unrank_parties(space, ranks), expected[ranks])
+    assert np.array_equal(rank_parties(space, expected[ranks]), ranks)
+
+
+def test_sample_parties_are_in_the_space(df_jobs):
+    space = make_party_space("Typhoon", df_jobs, excluded_jobs=["Knight"], required_jobs=["Monk"])
+    parties = sample_parties(space, 200, np.random.default_rng(0))
+    ranks = rank_parties(space, parties)
+    assert np.array_equal(unrank_parties(space, ranks), parties)
+
+
+def test_rank_parties_rejects_parties_outside_the_space(df_jobs):
+    space = make_party_space("Regular", df_jobs, excluded_jobs=["Knight"])
+    with pytest.raises(ValueError):
+        rank_parties(space, expected_parties(df_jobs, "Regular", False, None, ["Knight"])[:1])
+    with pytest.raises(IndexError):
+        unrank_parties(space, [count_parties(space)])
@@ -0,0 +1,19 @@
+import pytest
+
+from experiment import run_trials
+from select_parties import select_parties_by_embeddings, select_parties_randomly
+
+
+@pytest.fixture(scope="module")
+def typhoon_embedding_list(typhoon_embeddings):
+    return [(str(i), embedding) for i, embedding in enumerate(typhoon_embeddings[::7])]
+
+
+@pytest.mark.parametrize("selector", [select_parties_randomly, select_parties_by_embeddings])
+def test_run_trials_gives_each_trial_its_own_random_state(typhoon_embedding_list, selector):
+    trials = run_trials(typhoon_embedding_list, 5, 8, 3.0, selector, num_procs=4, seed=11)
+    assert len({tuple(parties) for parties, _ in trials}) == 8
+
+    # The trials only depend on the seed
+    assert run_trials(typhoon_embedding_list, 5, 8, 3.0, selector, num_procs=1, seed=11) == trials
+    assert run_trials(typhoon_embedding_list, 5, 8, 3.0, selector, num_procs=2, seed=12) != trials
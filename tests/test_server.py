@@ -0,0 +1,38 @@
+import pytest
+
+from server import MAX_NUM_GAUNTLETS, MAX_NUM_PARTIES, handle_request, load_server_state
+
+
+@pytest.fixture(scope="module")
+def server_state(df_jobs, tmp_path_factory):
+    return load_server_state(df_jobs, ["Regular"], [False], cache_dir=str(tmp_path_factory.mktemp("cache")))
+
+
+def test_selection_requests(server_state):
+    params = {"run_style": "Regular", "num_parties": 5, "eps": 4.0, "seed": 1}
+    response = handle_request(server_state, "select_parties_by_embeddings", params)
+    assert len(response["parties"]) == 5
+    assert handle_request(server_state, "select_parties_by_embeddings", params) == response
+    assert len(handle_request(server_state, "generate_gauntlet_runs", {"run_style": "Regular", "num_gauntlets": 2,
+                                                                      "seed": 1})["gauntlets"]) == 2
+
+
+@pytest.mark.parametrize("params", [{"eps": float("inf")}, {"eps": float("-inf")}, {"eps": float("nan")},
+                                    {"eps": 0}, {"eps": -1.0}, {"eps": "4"}, {"num_parties": 0},
+                                    {"num_parties": MAX_NUM_PARTIES + 1}, {"num_parties": 2.5},
+                                    {"num_parties": float("inf")}, {"num_parties": 10**400}, {"num_parties": True}])
+def test_selection_requests_reject_bad_numbers(server_state, params):
+    with pytest.raises(ValueError):
+        handle_request(server_state, "select_parties_by_embeddings", dict({"run_style": "Regular"}, **params))
+
+
+@pytest.mark.parametrize("num_gauntlets", [0, MAX_NUM_GAUNTLETS + 1, float("nan")])
+def test_gauntlet_requests_reject_bad_numbers(server_state, num_gauntlets):
+    with pytest.raises(ValueError):
+        handle_request(server_state, "generate_gauntlet_runs", {"run_style": "Regular", "num_gauntlets": num_gauntlets})
+
+
+@pytest.mark.parametrize("params", [[1, 2], "Regular", 3, None])
+def test_requests_must_be_json_objects(server_state, params):
+    with pytest.raises(ValueError):
+        handle_request(server_state, "select_parties_by_embeddings", params)
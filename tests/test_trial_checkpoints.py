@@ -0,0 +1,96 @@
+import csv
+import json
+
+import numpy as np
+import pytest
+
+from distances import gemm_euclidean_metric
+from experiment import run_trials_shared
+from select_parties import select_party_indices_by_embeddings, select_party_indices_randomly
+
+# The number of selections interrupting_selector makes before it fails, or None to never fail
+_selections_left = [None]
+
+
+def interrupting_selector(embedding_matrix: np.ndarray, num_parties: int = 10, eps: float = 1.0,
+                          verbose: bool = False, rng: np.random.Generator = None) -> np.ndarray:
+    """ select_party_indices_by_embeddings, but failing like a crash after _selections_left selections. """
+
+    if _selections_left[0] is not None:
+        if _selections_left[0] == 0:
+            raise KeyboardInterrupt
+        _selections_left[0] -= 1
+    return select_party_indices_by_embeddings(embedding_matrix, num_parties, eps, verbose, rng)
+
+
+@pytest.fixture(scope="module")
+def embeddings(typhoon_embeddings):
+    return typhoon_embeddings[::5], [str(i) for i in range(len(typhoon_embeddings[::5]))]
+
+
+def run_to_file(embeddings, filename, interrupt_after=None, **settings):
+    embedding_matrix, party_names = embeddings
+    settings = dict({"num_parties": 5, "num_trials": 20, "eps": 3.0, "chunk_size": 3, "checkpoint_every": 2,
+                     "selector": interrupting_selector}, **settings)
+    _selections_left[0] = interrupt_after
+    try:
+        return run_trials_shared(embedding_matrix, party_names, output_filename=str(filename), **settings)
+    finally:
+        _selections_left[0] = None
+
+
+def read_trials(filename):
+    with open(filename, newline="") as f:
+        return sorted(tuple(row) for row in csv.reader(f))
+
+
+def test_interrupted_run_resumes_to_the_same_trials(embeddings, tmp_path):
+    run_to_file(embeddings, tmp_path / "expected.csv", seed=1)
+    with pytest.raises(KeyboardInterrupt):
+        run_to_file(embeddings, tmp_path / "trials.csv", interrupt_after=16, seed=1)
+    assert json.load(open(tmp_path / "trials.csv.checkpoint.json"))["num_completed_trials"] == 12
+    assert len(read_trials(tmp_path / "trials.csv")) == 15
+
+    checkpoint = run_to_file(embeddings, tmp_path / "trials.csv")
+    assert checkpoint["seed"] == 1 and checkpoint["num_completed_trials"] == 20
+    assert read_trials(tmp_path / "trials.csv") == read_trials(tmp_path / "expected.csv")
+
+
+def test_fresh_run_removes_the_old_checkpoint(embeddings, tmp_path):
+    run_to_file(embeddings, tmp_path / "expected.csv", seed=2)
+    run_to_file(embeddings, tmp_path / "trials.csv", seed=1)
+
+    # Interrupted before its first checkpoint, so there is nothing to resume
+    with pytest.raises(KeyboardInterrupt):
+        run_to_file(embeddings, tmp_path / "trials.csv", interrupt_after=2, seed=2, resume=False)
+    assert not (tmp_path / "trials.csv.checkpoint.json").exists()
+
+    checkpoint = run_to_file(embeddings, tmp_path / "trials.csv", seed=2)
+    assert checkpoint["seed"] == 2 and checkpoint["num_completed_trials"] == 20
+    assert read_trials(tmp_path / "trials.csv") == read_trials(tmp_path / "expected.csv")
+
+
+@pytest.mark.parametrize("settings", [{"seed": 2}, {"eps": 2.0}, {"selector": select_party_indices_randomly},
+                                      {"metric": gemm_euclidean_metric()}, {"num_trials": 21}])
+def test_resume_refuses_other_settings(embeddings, tmp_path, settings):
+    with pytest.raises(KeyboardInterrupt):
+        run_to_file(embeddings, tmp_path / "trials.csv", interrupt_after=7, seed=1)
+    with pytest.raises(ValueError):
+        run_to_file(embeddings, tmp_path / "trials.csv", **settings)
+
+
+def test_resume_refuses_other_embeddings(embeddings, tmp_path):
+    with pytest.raises(KeyboardInterrupt):
+        run_to_file(embeddings, tmp_path / "trials.csv", interrupt_after=7, seed=1)
+    embedding_matrix, party_names = embeddings
+    with pytest.raises(ValueError):
+        run_to_file((embedding_matrix * 0.5, party_names), tmp_path / "trials.csv")
+
+
+def test_resume_refuses_a_truncated_csv(embeddings, tmp_path):
+    with pytest.raises(KeyboardInterrupt):
+        run_to_file(embeddings, tmp_path / "trials.csv", interrupt_after=7, seed=1)
+    with open(tmp_path / "trials.csv", "r+") as f:
+        f.truncate(10)
+    with pytest.raises(ValueError):
+        run_to_file(embeddings, tmp_path / "trials.csv")